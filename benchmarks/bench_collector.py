@@ -0,0 +1,192 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import pylast
+import yaml
+
+import fake_lastfm
+
+"""
+End-to-end throughput benchmark of the data collector against the local stand-in for the last.fm API (fake_lastfm.py).
+
+Run it from the base directory:
+
+    python3 benchmarks/bench_collector.py --users 200 --latency 0.05
+
+The collector runs in a scratch directory with its own config and DB, so data/lastfm_raw.db is never touched. It goes through the stages of --stages like a run with a single API key and reports:
+- listens per second
+- API calls per listen
+- the share of the runtime spent in DataBaseQueries
+
+"""
+
+BASE = Path(__file__).absolute().parent.parent
+
+
+class TimedQueries(object):
+
+    """
+    Wraps dbq and adds up the time spent in every query method.
+    """
+
+    def __init__(self, dbq):
+        self.dbq = dbq
+        self.seconds = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self.dbq, name)
+        if not callable(attr):
+            return attr
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                self.seconds[name] = (
+                    self.seconds.get(name, 0.0) + time.perf_counter() - start
+                )
+
+        return timed
+
+
+def write_config(workdir, args, api_url):
+    with open(BASE.joinpath("config").joinpath("config.yaml")) as stream:
+        config = yaml.safe_load(stream)
+
+    config["api_url"] = api_url
+    config["fetch"] = args.stages.split(",")
+    config["seeds"] = ["user0", "user1", "user2"]
+    config["limits"]["users"] = args.users
+    config["speedtest"] = False
+    config["debug"] = False
+    config["engine"] = "processes"
+    config["single_writer"]["enabled"] = False
+    config["response_cache"]["mode"] = "off"
+    # the benchmark measures the collector, not the pacing of the requests
+    config["rate_control"].update(
+        initial_rate=1000,
+        max_rate=1000,
+        host_max_rate=1000,
+        retry_delay=0.1,
+        breaker_cooldown=1,
+    )
+    config["sleep"]["wait_for_work"] = 0.1
+
+    workdir.joinpath("config").mkdir(parents=True, exist_ok=True)
+    with open(workdir.joinpath("config").joinpath("config.yaml"), "w") as stream:
+        yaml.safe_dump(config, stream)
+    return config
+
+
+def run_stage(collector, stage, logger):
+    f = getattr(collector, "get_" + stage)
+    action = "repeat"
+    while action in ("repeat", "wait"):
+        try:
+            action = f()
+        except pylast.NetworkError as e:
+            logger.error(f"Caught exception: {e}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    fake_lastfm.add_arguments(parser)
+    parser.add_argument(
+        "--stages",
+        default="users,listens",
+        help="comma separated fetch stages, e.g. users,listens,tags",
+    )
+    parser.add_argument(
+        "--workdir",
+        default=None,
+        help="scratch directory (default: a new temporary directory)",
+    )
+    parser.add_argument(
+        "--output", default=None, help="write the results to this JSON file"
+    )
+    parser.add_argument(
+        "--verbose", action="store_true", help="show the log of the collector"
+    )
+    args = parser.parse_args()
+
+    api = fake_lastfm.from_arguments(args)
+    server, api_url = fake_lastfm.start_server(api)
+
+    workdir = Path(
+        args.workdir if args.workdir else tempfile.mkdtemp(prefix="lfm_bench_")
+    ).absolute()
+    config = write_config(workdir, args, api_url)
+
+    # the collector modules find their config and DB relative to the working directory
+    output = Path(args.output).absolute() if args.output else None
+    os.chdir(workdir)
+    sys.path.insert(0, str(BASE.joinpath("data_collection")))
+    from api_pylast import DataCollector, get_timeframe
+    from queries import dbq
+    from metrics import metrics
+
+    api.data.time_from, api.data.time_to = get_timeframe(config=config)
+
+    logger = logging.getLogger("data_py_logger")
+    logger.setLevel(logging.DEBUG if args.verbose else logging.WARNING)
+    if args.verbose:
+        logger.addHandler(logging.StreamHandler())
+
+    timed = TimedQueries(dbq)
+    network = pylast.LastFMNetwork(api_key="benchmark", api_secret="benchmark")
+    collector = DataCollector(network=network, config=config, pid=0, dbq=timed)
+
+    stages = {}
+    start = time.perf_counter()
+    for stage in config["fetch"]:
+        stage_start = time.perf_counter()
+        run_stage(collector, stage, logger)
+        stages[stage] = round(time.perf_counter() - stage_start, 3)
+    seconds = time.perf_counter() - start
+    server.shutdown()
+    metrics.snapshot()
+
+    dbq.db.cursor.execute("SELECT COUNT(*) FROM listens")
+    listens = dbq.db.cursor.fetchone()[0]
+    dbq.db.cursor.execute("SELECT COUNT(*) FROM users")
+    users = dbq.db.cursor.fetchone()[0]
+    api_stats = api.stats()
+    db_seconds = sum(timed.seconds.values())
+
+    results = {
+        "workdir": str(workdir),
+        "settings": vars(args),
+        "seconds": round(seconds, 3),
+        "stages": stages,
+        "users": users,
+        "listens": listens,
+        "listens_per_second": round(listens / seconds, 1) if seconds else 0.0,
+        "api_calls": api_stats["total_calls"],
+        "api_calls_per_listen": round(api_stats["total_calls"] / listens, 4)
+        if listens
+        else None,
+        "api_calls_by_method": api_stats["calls"],
+        "api_errors": api_stats["errors"],
+        "db_seconds": round(db_seconds, 3),
+        "db_time_share": round(db_seconds / seconds, 3) if seconds else 0.0,
+        "db_seconds_by_query": {
+            k: round(v, 3)
+            for k, v in sorted(timed.seconds.items(), key=lambda x: -x[1])
+        },
+    }
+
+    print(json.dumps(results, indent=2))
+    if output:
+        with open(output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,652 @@
+import argparse
+import datetime as dt
+import calendar
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import yaml
+
+from fake_lastfm import mbid, zipf_cum_weights
+
+"""
+Benchmark of the DB queries of all stages on synthetic raw databases.
+
+Run it from the base directory:
+
+    python3 benchmarks/bench_queries.py --scales 10k,1m --output results.json
+    python3 benchmarks/bench_queries.py --scales 10k,1m --compare results.json
+
+For every scale (number of listens) a raw DB like data/lastfm_raw.db is generated once and kept in --workdir, with a long tail of artists and songs (Zipf) and of listens per user (Pareto). Then we time:
+- every method of DataBaseQueries in data_collection/queries.py (with cold id caches, --repeat times)
+- merge_songs, estimate_release_date_from_listens and insert_data of data_cleaning/queries.py (once, they work on the whole DB)
+- StreamDB.create_db of data_stream/run.py (once)
+
+Every stage runs in its own subprocess on its own copy of the raw DB, because the modules of the stages have the same names and open their DB relative to the working directory. The results are written as JSON. With --compare, the results are compared to an earlier run and every query that got slower by more than --tolerance is listed (exit code 1).
+
+"""
+
+BASE = Path(__file__).absolute().parent.parent
+
+SCALES = {"10k": 10_000, "1m": 1_000_000, "50m": 50_000_000}
+
+SONGS_PER_ARTIST = 30
+
+
+def parse_scale(scale):
+    if scale in SCALES:
+        return SCALES[scale]
+    return int(float(scale.lower().replace("k", "e3").replace("m", "e6")))
+
+
+def load_config():
+    with open(BASE.joinpath("config").joinpath("config.yaml")) as stream:
+        return yaml.safe_load(stream)
+
+
+def timeframe(config):
+    start = dt.datetime(
+        config["timeframe"]["start_year"], config["timeframe"]["start_month"], 1
+    )
+    end = dt.datetime(
+        config["timeframe"]["end_year"], config["timeframe"]["end_month"], 1
+    )
+    return calendar.timegm(start.utctimetuple()), calendar.timegm(end.utctimetuple())
+
+
+def prepare_dir(path, config):
+
+    """
+    A working directory for the stages: config/config.yaml and data/
+    """
+
+    path.joinpath("config").mkdir(parents=True, exist_ok=True)
+    path.joinpath("data").mkdir(parents=True, exist_ok=True)
+    with open(path.joinpath("config").joinpath("config.yaml"), "w") as stream:
+        yaml.safe_dump(config, stream)
+
+
+def run_worker(stage, path, repeat, sizes):
+    result = subprocess.run(
+        [
+            sys.executable,
+            str(Path(__file__).absolute()),
+            "--worker",
+            stage,
+            "--repeat",
+            str(repeat),
+            "--sizes",
+            json.dumps(sizes),
+        ],
+        cwd=path,
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    # the stages print some progress, the result is the last line
+    return json.loads(str(result.stdout, "utf-8").strip().splitlines()[-1])
+
+
+def build_raw_db(path, n_listens, config, seed):
+
+    """
+    Generates a raw DB with n_listens listens. The schema comes from data_collection/db.py.
+    """
+
+    prepare_dir(path, config)
+    run_worker("schema", path, 0, {})
+
+    rng = random.Random(seed)
+    n_users = max(n_listens // 1000, 20)
+    n_artists = max(int(n_listens**0.6), 50)
+    time_from, time_to = timeframe(config)
+
+    connection = sqlite3.connect(path.joinpath("data").joinpath("lastfm_raw.db"))
+    cursor = connection.cursor()
+    cursor.execute("PRAGMA journal_mode = OFF")
+    cursor.execute("PRAGMA synchronous = OFF")
+
+    users = []
+    for i in range(n_users):
+        registered = rng.randint(time_from, time_from + (time_to - time_from) // 2)
+        users.append((f"user{i}", rng.choice(["Germany", "Brazil", ""]), registered))
+    weights = [rng.paretovariate(1.5) for _ in users]
+    total_weight = sum(weights)
+    listens_per_user = [int(n_listens * w / total_weight) for w in weights]
+    listens_per_user[0] += n_listens - sum(listens_per_user)
+
+    cursor.executemany(
+        "INSERT INTO users (name, country, registered, total_listens) VALUES (?, ?, ?, ?)",
+        [
+            (name, country, registered, n)
+            for (name, country, registered), n in zip(users, listens_per_user)
+        ],
+    )
+    statuses = [4 if rng.random() < 0.9 else rng.choice([0, 2]) for _ in users]
+    cursor.executemany(
+        "INSERT INTO data_collection (user, status) VALUES (?, ?)",
+        [(i + 1, status) for i, status in enumerate(statuses)],
+    )
+    cursor.executemany(
+        "INSERT OR IGNORE INTO friendships (user1, user2) VALUES (?, ?)",
+        [
+            tuple(sorted((i + 1, rng.randrange(n_users) + 1)))
+            for i in range(n_users)
+            for _ in range(10)
+        ],
+    )
+
+    cursor.executemany(
+        "INSERT INTO artists (name, mb_id) VALUES (?, ?)",
+        [(f"Artist {a}", mbid(f"Artist {a}", 0.7) or None) for a in range(n_artists)],
+    )
+    cursor.executemany(
+        "INSERT INTO albums (name, mb_id, artist) VALUES (?, ?, ?)",
+        [
+            (f"Album {a}-{k}", mbid(f"Album {a}-{k}", 0.7) or None, a + 1)
+            for a in range(n_artists)
+            for k in range(SONGS_PER_ARTIST // 10)
+        ],
+    )
+    # song a * SONGS_PER_ARTIST + s + 1 is song s of artist a
+    cursor.executemany(
+        "INSERT INTO songs (name, mb_id, artist, album) VALUES (?, ?, ?, ?)",
+        [
+            (
+                f"Song {a}-{s}",
+                mbid(f"Song {a}-{s}", 0.7) or None,
+                a + 1,
+                a * (SONGS_PER_ARTIST // 10) + s // 10 + 1,
+            )
+            for a in range(n_artists)
+            for s in range(SONGS_PER_ARTIST)
+        ],
+    )
+    cursor.executemany(
+        "INSERT OR IGNORE INTO tags (tag, artist, weight) VALUES (?, ?, ?)",
+        [
+            (f"tag {rng.randrange(200)}", a + 1, 100 - 10 * k)
+            for a in range(n_artists)
+            if rng.random() < 0.6
+            for k in range(rng.randint(1, 5))
+        ],
+    )
+    cursor.execute(
+        "UPDATE artists SET tag_status = 2 WHERE id_nb IN (SELECT artist FROM tags)"
+    )
+    connection.commit()
+
+    artist_weights = zipf_cum_weights(n_artists, 1.1)
+    song_weights = zipf_cum_weights(SONGS_PER_ARTIST, 1.0)
+    chunk = 100_000
+    for i, n in enumerate(listens_per_user):
+        start = max(users[i][2], time_from)
+        for offset in range(0, n, chunk):
+            k = min(chunk, n - offset)
+            artists = rng.choices(range(n_artists), cum_weights=artist_weights, k=k)
+            songs = rng.choices(range(SONGS_PER_ARTIST), cum_weights=song_weights, k=k)
+            cursor.executemany(
+                "INSERT OR IGNORE INTO listens (user, song, time) VALUES (?, ?, ?)",
+                [
+                    (
+                        i + 1,
+                        a * SONGS_PER_ARTIST + s + 1,
+                        rng.randint(start, time_to - 1),
+                    )
+                    for a, s in zip(artists, songs)
+                ],
+            )
+        connection.commit()
+
+    cursor.execute(
+        "UPDATE data_collection SET watermark = (SELECT MAX(time) FROM listens WHERE listens.user = data_collection.user) WHERE status = 4"
+    )
+    connection.commit()
+    connection.close()
+
+    return {
+        "users": n_users,
+        "artists": n_artists,
+        "songs": n_artists * SONGS_PER_ARTIST,
+    }
+
+
+def timings(f, repeat, before=None):
+    seconds = []
+    for _ in range(repeat):
+        if before:
+            before()
+        start = time.perf_counter()
+        f()
+        seconds.append(time.perf_counter() - start)
+    return {
+        "runs": repeat,
+        "min": round(min(seconds), 6),
+        "median": round(statistics.median(seconds), 6),
+        "mean": round(statistics.mean(seconds), 6),
+    }
+
+
+def collection_cases(dbq, sizes):
+
+    """
+    A call with realistic arguments for every method of data_collection/queries.py. Methods that insert get new names every time, so they insert instead of hitting a conflict.
+    """
+
+    rng = random.Random(1)
+    counter = iter(range(10**9))
+    n_users, n_artists = sizes["users"], sizes["artists"]
+
+    def user():
+        return rng.randrange(n_users) + 1
+
+    def artist_name():
+        return f"Artist {min(int(rng.paretovariate(1.1)) - 1, n_artists - 1)}"
+
+    def song():
+        a = min(int(rng.paretovariate(1.1)) - 1, n_artists - 1)
+        return a, rng.randrange(SONGS_PER_ARTIST)
+
+    def listens_batch():
+        k = next(counter)
+        artists = {}
+        albums = {}
+        songs = {}
+        listens = []
+        for i in range(200):
+            if rng.random() < 0.1:
+                # a new song of a new artist
+                a_name, s_name = f"New artist {k}-{i}", f"New song {k}-{i}"
+                artists[a_name] = None
+                albums[f"New album {k}-{i}"] = (None, a_name)
+                songs[(a_name, s_name)] = (None, f"New album {k}-{i}")
+            else:
+                a, s = song()
+                a_name, s_name = f"Artist {a}", f"Song {a}-{s}"
+            listens.append((a_name, s_name, 2_000_000_000 + k * 1000 + i))
+        return {
+            "user": user(),
+            "artists": artists,
+            "albums": albums,
+            "songs": songs,
+            "listens": listens,
+        }
+
+    # a shard with 2,000 listens for merge_db (see data_collection/shards.py)
+    shard_path = Path("data").joinpath("bench_shard.db").absolute()
+    shard_path.unlink(missing_ok=True)
+    shard = type(dbq)(path=shard_path)
+    for _ in range(10):
+        batch = listens_batch()
+        # the shard starts empty, so it needs all artists and songs of the batch
+        for a_name, s_name, _ in batch["listens"]:
+            batch["artists"].setdefault(a_name, None)
+            batch["songs"].setdefault((a_name, s_name), (None, None))
+        shard.copy_users(dbq.get_users_by_id([batch["user"]]))
+        shard.add_listens_batch(**batch)
+
+    return {
+        "get_cache_stats": lambda: dbq.get_cache_stats(),
+        "clear_id_caches": lambda: dbq.clear_id_caches(),
+        "get_users_with_no_data": lambda: dbq.get_users_with_no_data(n=5, status=2),
+        "claim_users": lambda: dbq.claim_users(n=5, status=4, new_status=3),
+        "claim_refresh": lambda: dbq.claim_refresh(n=5, refreshed_before=2**40),
+        "finish_refresh": lambda: dbq.finish_refresh(user_id=user(), refreshed_at=0),
+        "count_users_with_status": lambda: dbq.count_users_with_status(status=4),
+        "count_users_with_status_bigger": lambda: dbq.count_users_with_status_bigger(
+            status=2
+        ),
+        "update_data_status": lambda: dbq.update_data_status(
+            user_ids=[user()], status=4
+        ),
+        "add_listen_windows": lambda: dbq.add_listen_windows(
+            user_id=user(),
+            windows=[(next(counter) * 10, 0) for _ in range(5)],
+        ),
+        "claim_listen_window": lambda: dbq.claim_listen_window(),
+        "finish_listen_window": lambda: dbq.finish_listen_window(
+            user_id=user(), time_from=0
+        ),
+        "get_user_id_from_name": lambda: dbq.get_user_id_from_name(
+            user_name=f"user{user() - 1}"
+        ),
+        "add_user": lambda: dbq.add_user(
+            user_name=f"new user {next(counter)}",
+            country="Germany",
+            registered=1100000000,
+            total_listens=1000,
+        ),
+        "add_users": lambda: dbq.add_users(
+            users=[
+                {
+                    "user_name": f"new user {next(counter)}",
+                    "country": "Germany",
+                    "registered": 1100000000,
+                    "total_listens": 1000,
+                }
+                for _ in range(50)
+            ]
+        ),
+        "add_friendship": lambda: dbq.add_friendship(user1=user(), user2=user()),
+        "add_friendships": lambda: dbq.add_friendships(
+            user=user(), friends=[user() for _ in range(50)]
+        ),
+        "get_album_id_from_name": lambda: dbq.get_album_id_from_name(
+            album_name=f"Album {song()[0]}-0"
+        ),
+        "add_album": lambda: dbq.add_album(
+            album_name=f"New album {next(counter)}", mb_id=None, artist_id=1
+        ),
+        "get_artist_id_from_name": lambda: dbq.get_artist_id_from_name(
+            artist_name=artist_name()
+        ),
+        "add_artist": lambda: dbq.add_artist(
+            artist_name=f"New artist {next(counter)}", mb_id=None
+        ),
+        "get_song_id_from_name": lambda: dbq.get_song_id_from_name(
+            song_name="Song {}-{}".format(*song()), artist_id=1
+        ),
+        "add_song": lambda: dbq.add_song(
+            song_name=f"New song {next(counter)}",
+            song_mbid=None,
+            album_id=None,
+            artist_id=1,
+        ),
+        "add_listening": lambda: dbq.add_listening(
+            user=user(), song=1, time=2_100_000_000 + next(counter)
+        ),
+        "add_listens_batch": lambda: dbq.add_listens_batch(**listens_batch()),
+        "get_artists_with_no_tags": lambda: dbq.get_artists_with_no_tags(n=100),
+        "add_tags_to_artist": lambda: dbq.add_tags_to_artist(
+            tags=[{"tag": f"tag {k}", "weight": 100 - k} for k in range(5)],
+            artist_id=rng.randrange(n_artists) + 1,
+        ),
+        "claim_artists": lambda: dbq.claim_artists(n=100),
+        "add_tags": lambda: dbq.add_tags(
+            artists=[
+                {
+                    "id": rng.randrange(n_artists) + 1,
+                    "tags": [{"tag": f"tag {k}", "weight": 100 - k} for k in range(5)],
+                    "status": 2,
+                }
+                for _ in range(100)
+            ]
+        ),
+        "add_negative_results": lambda: dbq.add_negative_results(
+            kind="user",
+            names=[f"Missing user {next(counter)}" for _ in range(10)],
+            error="not_found",
+            ttl_days=30,
+        ),
+        "get_negative_results": lambda: dbq.get_negative_results(
+            kind="user", names=[f"Missing user {k}" for k in range(100)]
+        ),
+        "release_negative_results": lambda: dbq.release_negative_results(),
+        "update_tag_status": lambda: dbq.update_tag_status(
+            artist_ids=[rng.randrange(n_artists) + 1 for _ in range(100)], status=0
+        ),
+        "queue_enrichment": lambda: dbq.queue_enrichment(),
+        "claim_enrichment": lambda: dbq.claim_enrichment(n=50),
+        "finish_enrichment": lambda: dbq.finish_enrichment(
+            items=[
+                {"kind": "song", "id": song_id, "mbid": mbid(f"Enriched {song_id}", 1)}
+                for song_id in rng.sample(range(1, n_artists * SONGS_PER_ARTIST), 50)
+            ]
+        ),
+        "update_enrichment_status": lambda: dbq.update_enrichment_status(
+            items=[
+                {"kind": "artist", "id": rng.randrange(n_artists) + 1}
+                for _ in range(50)
+            ],
+            status=0,
+        ),
+        "get_users_by_id": lambda: dbq.get_users_by_id(
+            user_ids=[user() for _ in range(10)]
+        ),
+        "copy_users": lambda: dbq.copy_users(
+            users=shard.get_users_by_id(user_ids=[user() for _ in range(10)])
+        ),
+        "set_fetch_cursor": lambda: dbq.set_fetch_cursor(
+            user=user(), cursor=1_500_000_000
+        ),
+        "merge_db": lambda: dbq.merge_db(shard_path),
+        "add_leases": lambda: dbq.add_leases(
+            kind="user",
+            units=[user() for _ in range(50)],
+            holder="bench",
+            seconds=120,
+        ),
+        "renew_leases": lambda: dbq.renew_leases(holder="bench", seconds=120),
+        "extend_leases": lambda: dbq.extend_leases(seconds=1),
+        "release_leases": lambda: dbq.release_leases(
+            kind="user", units=[user() for _ in range(50)]
+        ),
+        "update_data_is_private": lambda: dbq.update_data_is_private(user_id=user()),
+        "reset_cancelled_fetching": lambda: dbq.reset_cancelled_fetching(),
+        "get_stats": lambda: dbq.get_stats(),
+        "get_remaining_listens": lambda: dbq.get_remaining_listens(),
+        "get_data_stats": lambda: dbq.get_data_stats(),
+        "count_artists_with_no_tags": lambda: dbq.count_artists_with_no_tags(),
+    }
+
+
+def worker(stage, repeat, sizes):
+
+    """
+    Runs in the working directory of a stage (see run_worker) and prints the timings as JSON.
+    """
+
+    if stage == "schema":
+        sys.path.insert(0, str(BASE.joinpath("data_collection")))
+        from db import DB
+
+        DB()
+        return {}
+
+    if stage == "collection":
+        sys.path.insert(0, str(BASE.joinpath("data_collection")))
+        from queries import dbq
+
+        cases = collection_cases(dbq, sizes)
+        results = {
+            name: timings(f, repeat, before=dbq.clear_id_caches)
+            for name, f in cases.items()
+        }
+        methods = [
+            x
+            for x in dir(type(dbq))
+            if callable(getattr(type(dbq), x))
+            and not x.startswith("_")
+            and x != "commit"
+        ]
+        results["not_benchmarked"] = sorted(set(methods) - set(cases))
+        return results
+
+    if stage == "cleaning":
+        sys.path.insert(0, str(BASE.joinpath("data_cleaning")))
+        from queries import dbq
+
+        # in the order of data_cleaning/run.py, each one needs the one before
+        return {
+            name: timings(getattr(dbq, name), 1)
+            for name in [
+                "estimate_release_date_from_listens",
+                "merge_songs",
+                "insert_data",
+            ]
+        }
+
+    if stage == "stream":
+        sys.path.insert(0, str(BASE.joinpath("data_stream")))
+        from run import StreamDB
+
+        processed = Path().absolute().joinpath("data").joinpath("lastfm_processed.db")
+        # the constructor creates the stream DB
+        return {
+            "StreamDB.create_db": timings(lambda: StreamDB(db_file_path=processed), 1)
+        }
+
+    raise Exception(f"Unknown stage {stage}")
+
+
+def compare(old, new, tolerance):
+
+    """
+    Prints every query that is slower than in old by more than tolerance and returns how many there are.
+    """
+
+    regressions = 0
+    for scale, stages in new["scales"].items():
+        for stage in ["collection", "cleaning", "stream"]:
+            for name, t in stages.get(stage, {}).items():
+                if not isinstance(t, dict):
+                    continue
+                before = old["scales"].get(scale, {}).get(stage, {}).get(name)
+                if not before or not before["median"]:
+                    continue
+                ratio = t["median"] / before["median"]
+                flag = ""
+                if ratio > 1 + tolerance:
+                    flag = "  <-- slower"
+                    regressions += 1
+                print(
+                    f"{scale:>5} {stage:<10} {name:<40} {before['median']:.6f}s -> {t['median']:.6f}s  x{ratio:.2f}{flag}"
+                )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--scales",
+        default="10k,1m",
+        help="comma separated numbers of listens, e.g. 10k,1m,50m",
+    )
+    parser.add_argument("--stages", default="collection,cleaning,stream")
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="runs per collection query"
+    )
+    parser.add_argument(
+        "--workdir", default="benchmarks/work", help="the generated DBs are kept here"
+    )
+    parser.add_argument(
+        "--rebuild", action="store_true", help="generate the raw DBs again"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--output", default=None, help="write the results to this JSON file"
+    )
+    parser.add_argument(
+        "--compare", default=None, help="compare to the results of an earlier run"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="allowed slowdown in --compare (0.2 = 20%%)",
+    )
+    parser.add_argument("--worker", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--sizes", default="{}", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(worker(args.worker, args.repeat, json.loads(args.sizes))))
+        return
+
+    config = load_config()
+    workdir = Path(args.workdir).absolute()
+    try:
+        commit = (
+            subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=BASE,
+                stdout=subprocess.PIPE,
+                check=True,
+            )
+            .stdout.decode()
+            .strip()
+        )
+    except Exception:
+        commit = None
+
+    results = {
+        "commit": commit,
+        "created": dt.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "repeat": args.repeat,
+        "scales": {},
+    }
+
+    for scale in args.scales.split(","):
+        n_listens = parse_scale(scale)
+        scale_dir = workdir.joinpath(scale)
+        raw = scale_dir.joinpath("raw").joinpath("data").joinpath("lastfm_raw.db")
+        sizes_file = scale_dir.joinpath("sizes.json")
+
+        if args.rebuild or not raw.exists() or not sizes_file.exists():
+            if scale_dir.exists():
+                shutil.rmtree(scale_dir)
+            print(f"Generating a raw DB with {n_listens} listens...", file=sys.stderr)
+            start = time.perf_counter()
+            sizes = build_raw_db(
+                scale_dir.joinpath("raw"), n_listens, config, args.seed
+            )
+            sizes["build_seconds"] = round(time.perf_counter() - start, 3)
+            with open(sizes_file, "w") as f:
+                json.dump(sizes, f)
+        with open(sizes_file) as f:
+            sizes = json.load(f)
+        sizes["listens"] = n_listens
+        sizes["raw_db_mb"] = round(os.path.getsize(raw) / 1024 / 1024, 1)
+        results["scales"][scale] = {"sizes": sizes}
+
+        for stage in ["collection", "cleaning"]:
+            if stage not in args.stages.split(","):
+                continue
+            # a fresh copy for every stage, the queries change the DB
+            stage_dir = scale_dir.joinpath(stage)
+            if stage_dir.exists():
+                shutil.rmtree(stage_dir)
+            prepare_dir(stage_dir, config)
+            shutil.copy(raw, stage_dir.joinpath("data").joinpath("lastfm_raw.db"))
+            print(f"{scale}: timing {stage}...", file=sys.stderr)
+            results["scales"][scale][stage] = run_worker(
+                stage, stage_dir, args.repeat, sizes
+            )
+
+        if "stream" in args.stages.split(","):
+            # the stream is created from the processed DB of the cleaning stage
+            stage_dir = scale_dir.joinpath("cleaning")
+            if not stage_dir.joinpath("data").joinpath("lastfm_processed.db").exists():
+                print(
+                    f"{scale}: the stream stage needs the cleaning stage",
+                    file=sys.stderr,
+                )
+            else:
+                print(f"{scale}: timing stream...", file=sys.stderr)
+                results["scales"][scale]["stream"] = run_worker(
+                    "stream", stage_dir, 1, sizes
+                )
+
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare(old, results, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,514 @@
+import argparse
+import bisect
+import calendar
+import datetime as dt
+import hashlib
+import random
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape, quoteattr
+
+"""
+A local stand-in for the last.fm API, backed by synthetic data. It answers the methods the collector uses:
+
+  user.getInfo, user.getFriends, user.getRecentTracks (paginated), artist.getTopTags, artist.getInfo, track.getInfo, album.getInfo
+
+Run it on its own with ```python3 benchmarks/fake_lastfm.py --port 8080``` and set api_url in config.yaml to http://127.0.0.1:8080/2.0/, or let benchmarks/bench_collector.py start it.
+
+The data is generated from a seed, so every run sees the same users, friends and listening histories:
+- listens per user follow a Pareto distribution (a few heavy users, many light ones)
+- artists and songs are drawn from Zipf distributions (a few hits, a long tail)
+- some users listed as friends don't exist (error 6 "User not found") and some listening histories are private (error 17)
+
+Latency, random rate limit errors (error 29) and a real per key rate limit can be switched on to see how the collector copes with them.
+
+"""
+
+COUNTRIES = [
+    "Germany",
+    "United States",
+    "United Kingdom",
+    "Brazil",
+    "Poland",
+    "Japan",
+    "",
+]
+TAGS = [f"tag {i}" for i in range(200)]
+
+
+def zipf_cum_weights(n, s):
+    cum_weights = []
+    total = 0.0
+    for rank in range(1, n + 1):
+        total += 1 / rank**s
+        cum_weights.append(total)
+    return cum_weights
+
+
+def mbid(name, rate):
+
+    """
+    A deterministic fake musicbrainz ID. Only a share of rate of all entities has one, like on last.fm.
+    """
+
+    digest = hashlib.md5(name.encode("utf-8")).hexdigest()
+    if int(digest[:4], 16) / 0xFFFF >= rate:
+        return ""
+    return (
+        f"{digest[:8]}-{digest[8:12]}-{digest[12:16]}-{digest[16:20]}-{digest[20:32]}"
+    )
+
+
+class SyntheticData(object):
+    def __init__(
+        self,
+        n_users=200,
+        n_artists=5000,
+        songs_per_artist=20,
+        mean_listens=2000,
+        max_listens=60000,
+        private_rate=0.02,
+        missing_rate=0.02,
+        mbid_rate=0.7,
+        time_from=calendar.timegm(dt.datetime(2002, 1, 1).utctimetuple()),
+        time_to=calendar.timegm(dt.datetime(2014, 1, 1).utctimetuple()),
+        seed=1,
+    ):
+        self.n_users = n_users
+        self.n_artists = n_artists
+        self.songs_per_artist = songs_per_artist
+        self.mean_listens = mean_listens
+        self.max_listens = max_listens
+        self.private_rate = private_rate
+        self.missing_rate = missing_rate
+        self.mbid_rate = mbid_rate
+        self.time_from = time_from
+        self.time_to = time_to
+        self.seed = seed
+        self.artist_weights = zipf_cum_weights(n_artists, 1.1)
+        self.song_weights = zipf_cum_weights(songs_per_artist, 1.0)
+        # the histories of the last few users that were asked for
+        self.histories = OrderedDict()
+        self.lock = threading.Lock()
+
+    def rng(self, *key):
+        return random.Random(f"{self.seed} {key}")
+
+    def user_index(self, user_name):
+        if not user_name.startswith("user"):
+            return None
+        try:
+            i = int(user_name[4:])
+        except ValueError:
+            return None
+        return i if 0 <= i < self.n_users else None
+
+    def user(self, i):
+        rng = self.rng("user", i)
+        # Pareto with alpha 1.5 has a mean of 3 * xm
+        listens = min(
+            int(self.mean_listens / 3 * rng.paretovariate(1.5)), self.max_listens
+        )
+        registered = rng.randint(
+            self.time_from, self.time_from + (self.time_to - self.time_from) // 2
+        )
+        return {
+            "name": f"user{i}",
+            "country": rng.choice(COUNTRIES),
+            "registered": registered,
+            "listens": listens,
+            "private": rng.random() < self.private_rate,
+        }
+
+    def friends(self, i):
+        rng = self.rng("friends", i)
+        names = []
+        for k in range(rng.randint(1, 30)):
+            if rng.random() < self.missing_rate:
+                names.append(f"ghost{i}x{k}")
+            else:
+                names.append(f"user{rng.randrange(self.n_users)}")
+        return sorted(set(names) - {f"user{i}"})
+
+    def artist(self, a):
+        return f"Artist {a}"
+
+    def song(self, a, s):
+        return f"Song {a}-{s}"
+
+    def album(self, a, s):
+        return f"Album {a}-{s // 10}"
+
+    def artist_index(self, artist_name):
+        try:
+            a = int(artist_name.split(" ")[1])
+        except (IndexError, ValueError):
+            return None
+        return a if artist_name == self.artist(a) and a < self.n_artists else None
+
+    def history(self, i):
+
+        """
+        The listening history of a user, oldest first: [(time, artist, song)]
+        """
+
+        with self.lock:
+            if i in self.histories:
+                self.histories.move_to_end(i)
+                return self.histories[i]
+
+        user = self.user(i)
+        rng = self.rng("history", i)
+        start = max(user["registered"], self.time_from)
+        times = sorted(
+            rng.randint(start, self.time_to - 1) for _ in range(user["listens"])
+        )
+        artists = rng.choices(
+            range(self.n_artists), cum_weights=self.artist_weights, k=len(times)
+        )
+        songs = rng.choices(
+            range(self.songs_per_artist), cum_weights=self.song_weights, k=len(times)
+        )
+        history = list(zip(times, artists, songs))
+
+        with self.lock:
+            self.histories[i] = history
+            while len(self.histories) > 64:
+                self.histories.popitem(last=False)
+        return history
+
+
+class FakeLastFM(object):
+
+    """
+    Builds the XML responses. handle() returns (HTTP status, body).
+    """
+
+    def __init__(self, data, latency=0.0, error_rate=0.0, rate=0.0):
+        self.data = data
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate = rate  # requests per second and API key, 0 = no limit
+        self.buckets = {}  # api key -> (tokens, last refill)
+        self.lock = threading.Lock()
+        self.rng = random.Random(data.seed)
+        self.calls = {}
+        self.errors = {}
+
+    def stats(self):
+        with self.lock:
+            return {
+                "calls": dict(self.calls),
+                "total_calls": sum(self.calls.values()),
+                "errors": dict(self.errors),
+            }
+
+    def count(self, counter, key):
+        with self.lock:
+            counter[key] = counter.get(key, 0) + 1
+
+    def rate_limited(self, api_key):
+        if not self.rate:
+            return False
+        with self.lock:
+            now = time.monotonic()
+            tokens, last = self.buckets.get(api_key, (self.rate, now))
+            tokens = min(self.rate, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[api_key] = (tokens, now)
+                return True
+            self.buckets[api_key] = (tokens - 1, now)
+            return False
+
+    def handle(self, params):
+        method = params.get("method", "")
+        self.count(self.calls, method)
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            inject = self.rng.random() < self.error_rate
+        if inject or self.rate_limited(params.get("api_key", "")):
+            return self.error(429, 29, "Rate Limit Exceeded")
+
+        handler = {
+            "user.getInfo": self.user_get_info,
+            "user.getFriends": self.user_get_friends,
+            "user.getRecentTracks": self.user_get_recent_tracks,
+            "artist.getTopTags": self.artist_get_top_tags,
+            "artist.getInfo": self.artist_get_info,
+            "track.getInfo": self.track_get_info,
+            "album.getInfo": self.album_get_info,
+        }.get(method)
+        if handler is None:
+            return self.error(
+                400, 3, "Invalid Method - No method with that name in this package"
+            )
+        return handler(params)
+
+    def error(self, status, code, message):
+        self.count(self.errors, code)
+        return (
+            status,
+            f'<?xml version="1.0" encoding="UTF-8"?>\n<lfm status="failed"><error code="{code}">{escape(message)}</error></lfm>',
+        )
+
+    def ok(self, body):
+        return (
+            200,
+            f'<?xml version="1.0" encoding="UTF-8"?>\n<lfm status="ok">{body}</lfm>',
+        )
+
+    def user_xml(self, user):
+        return (
+            f"<user><name>{escape(user['name'])}</name>"
+            f"<country>{escape(user['country'])}</country>"
+            f"<playcount>{user['listens']}</playcount>"
+            f"<registered unixtime=\"{user['registered']}\">{user['registered']}</registered></user>"
+        )
+
+    def find_user(self, params):
+        i = self.data.user_index(params.get("user", ""))
+        if i is None:
+            return None, self.error(400, 6, "User not found")
+        return i, None
+
+    def user_get_info(self, params):
+        i, error = self.find_user(params)
+        if error:
+            return error
+        return self.ok(self.user_xml(self.data.user(i)))
+
+    def user_get_friends(self, params):
+        i, error = self.find_user(params)
+        if error:
+            return error
+        limit = int(params.get("limit", 50))
+        page = int(params.get("page", 1))
+        names = self.data.friends(i)
+        total_pages = max(-(-len(names) // limit), 1)
+        users = []
+        for name in names[(page - 1) * limit : page * limit]:
+            j = self.data.user_index(name)
+            if j is None:
+                # a friend that can't be looked up any more, like on last.fm
+                users.append(
+                    f"<user><name>{escape(name)}</name><country></country><playcount>0</playcount><registered></registered></user>"
+                )
+            else:
+                users.append(self.user_xml(self.data.user(j)))
+        return self.ok(
+            f'<friends user="user{i}" page="{page}" perPage="{limit}" totalPages="{total_pages}" total="{len(names)}">{"".join(users)}</friends>'
+        )
+
+    def user_get_recent_tracks(self, params):
+        i, error = self.find_user(params)
+        if error:
+            return error
+        user = self.data.user(i)
+        if user["private"]:
+            return self.error(403, 17, "Login: User required to be logged in")
+
+        limit = min(int(params.get("limit", 50)), 200)
+        page = int(params.get("page", 1))
+        history = self.data.history(i)
+        start = bisect.bisect_left(history, (int(params.get("from", 0)),))
+        end = bisect.bisect_left(history, (int(params.get("to", 2**40)) + 1,))
+        total = end - start
+        total_pages = max(-(-total // limit), 1)
+
+        tracks = []
+        if page == 1 and i % 10 == 0:
+            # every tenth user is listening to something right now
+            tracks.append(self.track_xml(0, 0, None))
+        # newest first
+        first = end - (page - 1) * limit
+        for t, a, s in reversed(history[max(first - limit, start) : max(first, start)]):
+            tracks.append(self.track_xml(a, s, t))
+        return self.ok(
+            f'<recenttracks user="user{i}" page="{page}" perPage="{limit}" totalPages="{total_pages}" total="{total}">{"".join(tracks)}</recenttracks>'
+        )
+
+    def track_xml(self, a, s, t):
+        data = self.data
+        artist, song, album = data.artist(a), data.song(a, s), data.album(a, s)
+        rate = data.mbid_rate
+        if t is None:
+            head = '<track nowplaying="true">'
+            date = ""
+        else:
+            head = "<track>"
+            date = f'<date uts="{t}">{time.strftime("%d %b %Y, %H:%M", time.gmtime(t))}</date>'
+        return (
+            f"{head}<artist mbid={quoteattr(mbid(artist, rate))}>{escape(artist)}</artist>"
+            f"<name>{escape(song)}</name><mbid>{mbid(song + artist, rate)}</mbid>"
+            f"<album mbid={quoteattr(mbid(album, rate))}>{escape(album)}</album>{date}</track>"
+        )
+
+    def find_artist(self, params):
+        a = self.data.artist_index(params.get("artist", ""))
+        if a is None:
+            return None, self.error(
+                400, 6, "The artist you supplied could not be found"
+            )
+        return a, None
+
+    def artist_get_top_tags(self, params):
+        a, error = self.find_artist(params)
+        if error:
+            return error
+        rng = self.data.rng("tags", a)
+        tags = rng.sample(TAGS, rng.randint(0, 8))
+        body = "".join(
+            f"<tag><name>{escape(tag)}</name><count>{100 - 10 * k}</count></tag>"
+            for k, tag in enumerate(tags)
+        )
+        return self.ok(
+            f"<toptags artist={quoteattr(self.data.artist(a))}>{body}</toptags>"
+        )
+
+    def artist_get_info(self, params):
+        a, error = self.find_artist(params)
+        if error:
+            return error
+        artist = self.data.artist(a)
+        return self.ok(
+            f"<artist><name>{escape(artist)}</name><mbid>{mbid(artist, self.data.mbid_rate)}</mbid></artist>"
+        )
+
+    def track_get_info(self, params):
+        a, error = self.find_artist(params)
+        if error:
+            return error
+        artist, song = self.data.artist(a), params.get("track", "")
+        rate = self.data.mbid_rate
+        return self.ok(
+            f"<track><name>{escape(song)}</name><mbid>{mbid(song + artist, rate)}</mbid>"
+            f"<artist><name>{escape(artist)}</name><mbid>{mbid(artist, rate)}</mbid></artist></track>"
+        )
+
+    def album_get_info(self, params):
+        a, error = self.find_artist(params)
+        if error:
+            return error
+        artist, album = self.data.artist(a), params.get("album", "")
+        return self.ok(
+            f"<album><name>{escape(album)}</name><artist>{escape(artist)}</artist>"
+            f"<mbid>{mbid(album, self.data.mbid_rate)}</mbid></album>"
+        )
+
+
+def make_handler(api):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+        # the headers and the body are sent separately. With Nagle, the body waits for the delayed ACK of the client on a kept-alive connection.
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self.answer(urllib.parse.urlsplit(self.path).query)
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            self.answer(str(self.rfile.read(length), "utf-8"))
+
+        def answer(self, query):
+            params = dict(urllib.parse.parse_qsl(query))
+            status, body = api.handle(params)
+            body = body.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "text/xml; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(api, host="127.0.0.1", port=0):
+
+    """
+    Starts the server in a background thread. Returns the server and the URL to put into api_url.
+    """
+
+    server = ThreadingHTTPServer((host, port), make_handler(api))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}/2.0/"
+
+
+def add_arguments(parser):
+    parser.add_argument("--users", type=int, default=200, help="number of users")
+    parser.add_argument("--artists", type=int, default=5000, help="number of artists")
+    parser.add_argument(
+        "--mean-listens", type=int, default=2000, help="mean number of listens per user"
+    )
+    parser.add_argument(
+        "--max-listens", type=int, default=60000, help="listens of the heaviest users"
+    )
+    parser.add_argument(
+        "--private-rate",
+        type=float,
+        default=0.02,
+        help="share of users with a private listening history",
+    )
+    parser.add_argument(
+        "--missing-rate",
+        type=float,
+        default=0.02,
+        help="share of friends that can't be found",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="seconds every request takes"
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="share of requests answered with error 29 (rate limit)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0.0,
+        help="requests per second and API key before error 29, 0 = no limit",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def from_arguments(args):
+    data = SyntheticData(
+        n_users=args.users,
+        n_artists=args.artists,
+        mean_listens=args.mean_listens,
+        max_listens=args.max_listens,
+        private_rate=args.private_rate,
+        missing_rate=args.missing_rate,
+        seed=args.seed,
+    )
+    return FakeLastFM(
+        data, latency=args.latency, error_rate=args.error_rate, rate=args.rate
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the last.fm API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server, url = start_server(from_arguments(args), host=args.host, port=args.port)
+    print(f"Fake last.fm API at {url} (users: user0 ... user{args.users - 1})")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,9 +1,18 @@
 import calendar
 import datetime as dt
-from queries import dbq as dbq
+from queries import dbq as default_dbq, ENRICH_TABLES
+from buffer import ListenBuffer
+from response_cache import ResponseCache
+from metrics import metrics, error_class
 import pylast
 import logging
 import traceback
+import time
+from time import perf_counter
+import html
+import urllib.parse
+from http_pool import ConnectionPool
+from rate_control import RateController, TRANSIENT_ERRORS
 
 """
 A structured and systematic way of collecting data from lastfm
@@ -15,29 +24,323 @@ Note: the data collection can be interrupted at any point. It will pick up where
 """
 
 
+def get_timeframe(config):
+
+    """
+    Returns start and end of the configured timeframe as unix timestamps.
+    """
+
+    start = dt.datetime(
+        config["timeframe"]["start_year"],
+        config["timeframe"]["start_month"],
+        1,
+        0,
+        0,
+    )
+    end = dt.datetime(
+        config["timeframe"]["end_year"],
+        config["timeframe"]["end_month"],
+        1,
+        0,
+        0,
+    )
+    return calendar.timegm(start.utctimetuple()), calendar.timegm(end.utctimetuple())
+
+
+def registered_timestamp(registered):
+
+    """
+    The registration date of a user as unix timestamp. Depending on the API version it is stored as unix timestamp or as "YYYY-MM-DD HH:MM". Returns None if it can't be read.
+    """
+
+    if registered is None:
+        return None
+    try:
+        return int(registered)
+    except ValueError:
+        pass
+    try:
+        date = dt.datetime.strptime(str(registered).strip(), "%Y-%m-%d %H:%M")
+    except ValueError:
+        return None
+    return calendar.timegm(date.utctimetuple())
+
+
+def split_timeframe(user, time_from, time_to, threshold):
+
+    """
+    Cuts the timeframe of a heavy user into windows that can be fetched independently. Nobody listens before they registered, so the windows start at the registration date.
+
+    Returns [(time_from, time_to)] or None if the user doesn't need to be split.
+    """
+
+    if not threshold or not user["listens"] or user["listens"] <= threshold:
+        return None
+
+    registered = registered_timestamp(user["registered"])
+    if registered and time_from < registered < time_to:
+        time_from = registered
+
+    n = -(-user["listens"] // threshold)  # ceil
+    step = (time_to - time_from) // n
+    if step <= 0:
+        return None
+    # the windows overlap by a second so that nothing at the borders is lost, duplicates are ignored by the DB
+    windows = [(time_from + i * step, time_from + (i + 1) * step + 1) for i in range(n)]
+    windows[-1] = (windows[-1][0], time_to)
+    return windows
+
+
+def parse_response(network, response):
+
+    """
+    Parses the XML text of an API response and raises the same exceptions as pylast if the API returned an error.
+    """
+
+    try:
+        doc = pylast._parse_response(response)
+    except Exception as e:
+        raise pylast.MalformedResponseError(network, e) from e
+
+    element = doc.getElementsByTagName("lfm")[0]
+    if element.getAttribute("status") != "ok":
+        element = doc.getElementsByTagName("error")[0]
+        raise pylast.WSError(
+            network, element.getAttribute("code"), element.firstChild.data.strip()
+        )
+    return doc
+
+
+def parse_top_tags(doc, limit):
+
+    """
+    Reads the tags and their weights from an artist.getTopTags response.
+    """
+
+    tags = []
+    for node in doc.getElementsByTagName("tag")[:limit]:
+        tags.append(
+            {
+                "tag": pylast._extract(node, "name"),
+                "weight": pylast._number(pylast._extract(node, "count")),
+            }
+        )
+    return tags
+
+
+def parse_mbid(doc, kind):
+
+    """
+    Reads the mbid of an album.getInfo or track.getInfo response. Only the mbid right below the album or track counts, the artist has one as well.
+    """
+
+    opus = _child(doc.getElementsByTagName("lfm")[0], kind)
+    if opus is None:
+        return None
+    return _text(_child(opus, "mbid"))
+
+
+def parse_user_info(node):
+
+    """
+    Reads name, country, playcount and registration date from a <user> node. The node can come from user.getInfo or from a page of user.getFriends, which carries the same fields for every friend.
+    """
+
+    country = pylast._extract(node, "country")
+    if country == "None":
+        country = None
+
+    return {
+        "user_name": pylast._extract(node, "name"),
+        "country": country,
+        "registered": pylast._extract(node, "registered"),
+        "total_listens": pylast._number(pylast._extract(node, "playcount")),
+    }
+
+
+def _child(node, name):
+    for child in node.childNodes:
+        if child.nodeType == child.ELEMENT_NODE and child.tagName == name:
+            return child
+    return None
+
+
+def _text(node):
+    if node is None or not node.firstChild:
+        return None
+    return html.unescape(node.firstChild.data.strip())
+
+
+def parse_listen(node):
+
+    """
+    Reads a <track> node of user.getRecentTracks. Besides the names, the node carries the mbids of the track, its artist and its album, so we don't need any further API calls for them.
+    Returns None for the track that is playing right now.
+
+    In extended mode the artist is a node with <name> and <mbid> children, otherwise it's the artist name with an mbid attribute.
+    """
+
+    if node.getAttribute("nowplaying") == "true":
+        return None
+
+    artist = _child(node, "artist")
+    if _child(artist, "name") is not None:
+        artist_name = _text(_child(artist, "name"))
+        artist_mbid = _text(_child(artist, "mbid"))
+    else:
+        artist_name = _text(artist)
+        artist_mbid = artist.getAttribute("mbid")
+
+    album = _child(node, "album")
+
+    return {
+        "artist": artist_name,
+        "artist_mbid": artist_mbid or None,
+        "song": _text(_child(node, "name")),
+        "song_mbid": _text(_child(node, "mbid")),
+        "album": _text(album) or None,
+        "album_mbid": (album.getAttribute("mbid") if album is not None else None)
+        or None,
+        "time": _child(node, "date").getAttribute("uts"),
+    }
+
+
 class DataCollector(object):
-    def __init__(self, network, config, pid):
+    def __init__(self, network, config, pid, dbq=None, host_limiter=None):
         self.pid = pid
+        # the queries to use, either the DB of this process or a queue to the single writer (see writer.py)
+        self.dbq = dbq if dbq else default_dbq
         self.logger = logging.getLogger("data_py_logger")
         self.config = config
         self.nw = network
-        start = dt.datetime(
-            self.config["timeframe"]["start_year"],
-            self.config["timeframe"]["start_month"],
-            1,
-            0,
-            0,
+        self.utc_start, self.utc_end = get_timeframe(config=config)
+        self.debug = self.config["debug"]
+        self.api_calls = 0  # requests that went to the API, the pipeline shares them between the stages
+        self.cache = None
+        if config["response_cache"]["mode"] != "off":
+            self.cache = ResponseCache(
+                mode=config["response_cache"]["mode"],
+                ttl_hours=config["response_cache"]["ttl_hours"],
+                max_mb=config["response_cache"]["max_mb"],
+            )
+        # with api_url in config.yaml, the requests go to that URL (e.g. a local stand-in, see benchmarks/fake_lastfm.py) instead of last.fm
+        host, path = self.nw.ws_server
+        self.pool = ConnectionPool(
+            url=config["api_url"] if config["api_url"] else f"https://{host}{path}",
+            size=config["http"]["pool_size"],
+            connect_timeout=config["http"]["connect_timeout"],
+            read_timeout=config["http"]["read_timeout"],
+            keepalive_expiry=config["http"]["keepalive_expiry"],
+            key=pid,
         )
-        end = dt.datetime(
-            self.config["timeframe"]["end_year"],
-            self.config["timeframe"]["end_month"],
-            1,
-            0,
-            0,
+        # host_limiter: the rate_control.HostLimiter that all keys of the run share
+        self.rate = RateController(
+            config=config["rate_control"], key=pid, host=host_limiter
+        )
+
+    def _request(self, method, params):
+
+        """
+        All API calls of the collector go through here. Returns the parsed XML document and raises the same exceptions as pylast.
+
+        The requests are paced by the rate controller of the key and transient errors are retried (see rate_control.py). If all retries failed, a NetworkError is raised. The unit it belongs to is then not marked as done: it is handed back, or it stays in progress and the batch is repeated.
+        """
+
+        if self.cache:
+            response = self.cache.get(method, params)
+            if response is not None:
+                metrics.count_request(method=method, key=self.pid, result="cached")
+                return parse_response(self.nw, response)
+            if self.cache.mode == "replay":
+                metrics.count_request(
+                    method=method, key=self.pid, result="not_recorded"
+                )
+                raise pylast.WSError(self.nw, "replay", f"{method} was not recorded")
+
+        attempt = 0
+        while True:
+            time.sleep(self.rate.delay())
+            self.api_calls += 1
+            start = perf_counter()
+            try:
+                response = self._download(method, params)
+                doc = parse_response(self.nw, response)
+                break
+            except Exception as E:
+                metrics.count_request(
+                    method=method,
+                    key=self.pid,
+                    result=error_class(E),
+                    seconds=perf_counter() - start,
+                )
+                wait = self.rate.retry(E, attempt)
+                if wait is None:
+                    if self.cache and isinstance(E, pylast.WSError):
+                        self.cache.put_error(method, params, E.status, E.details)
+                    if error_class(E) in TRANSIENT_ERRORS and not isinstance(
+                        E, pylast.NetworkError
+                    ):
+                        # the batch is repeated, like after a network error
+                        raise pylast.NetworkError(self.nw, E) from E
+                    raise
+                self.logger.info(
+                    f"p{self.pid}    {method} failed ({E}), retrying in {wait:.1f}s"
+                )
+                time.sleep(wait)
+                attempt += 1
+
+        self.rate.success()
+        metrics.count_request(
+            method=method, key=self.pid, result="ok", seconds=perf_counter() - start
+        )
+        if self.cache:
+            self.cache.put(method, params, response)
+        return doc
+
+    def _download(self, method, params):
+
+        """
+        Sends a request to the API over a keep-alive connection of the pool (see http_pool.py) and returns the response text.
+        """
+
+        body = dict(params)
+        body["method"] = method
+        body["api_key"] = self.nw.api_key
+        body = urllib.parse.urlencode(body).encode("utf-8")
+        try:
+            status, payload = self.pool.post(body)
+        except Exception as e:
+            raise pylast.NetworkError(self.nw, e) from e
+
+        if status in (500, 502, 503, 504):
+            raise pylast.WSError(
+                self.nw, status, f"Connection to the API failed with HTTP code {status}"
+            )
+        # the API sends its error messages with 4xx codes
+        return str(payload, "utf-8")
+
+    def known_failures(self, kind, names):
+
+        """
+        Returns the names that are known to fail (see negative_results in db.py), they don't need an API call.
+        """
+
+        known = self.dbq.get_negative_results(kind=kind, names=names)
+        if known:
+            metrics.inc(
+                "lastfm_negative_hits_total", len(known), kind=kind, key=self.pid
+            )
+        return known
+
+    def remember_failures(self, kind, names, error, ttl_days=None):
+        self.dbq.add_negative_results(
+            kind=kind,
+            names=names,
+            error=error,
+            ttl_days=(
+                self.config["negative_ttl_days"][kind] if ttl_days is None else ttl_days
+            ),
         )
-        self.utc_start = calendar.timegm(start.utctimetuple())
-        self.utc_end = calendar.timegm(end.utctimetuple())
-        self.debug = self.config["debug"]
 
     def get_users(self):
 
@@ -53,12 +356,14 @@ class DataCollector(object):
           3 = listenings are being fetched
           4 = listenings have been fetched
           5 = broken user (might have deleted their account)
+
+        Returns "repeat" after a batch, "wait" if there is nothing to claim but other processes are still adding users, "stop" when we are done.
         """
 
         self.logger.info(f"p{self.pid}    Fetching users.")
 
         # count users that have been fully processed
-        n_users = dbq.count_users_with_status_bigger(status=2)
+        n_users = self.dbq.count_users_with_status_bigger(status=2)
 
         if self.config["limits"]["users"] and self.config["limits"]["users"] <= n_users:
             self.logger.info(
@@ -68,48 +373,139 @@ class DataCollector(object):
 
         self.logger.info(f"p{self.pid}    Users processed: {n_users}")
 
-        # fetch users where we don't have the friendship data yet
-        # we use relatively small batches because we run these in parallel
-        users_to_fetch = dbq.get_users_with_no_data(n=1, status=0)
-
         # this is for the initialization if there are no users yet (we use seeds from reddit)
-        if len(users_to_fetch) == 0 and n_users == 0:
-            users_to_fetch = [{"id": 0, "name": x} for x in self.config["seeds"]]
-            for u in users_to_fetch:
-                us = self.nw.get_user(u["name"])
-                dbq.add_user(user_object=us)
-        elif len(users_to_fetch) == 0 and n_users != 0:
+        if n_users == 0:
+            for name in self.config["seeds"]:
+                if not self.dbq.get_user_id_from_name(user_name=name):
+                    self.add_user(user_name=name)
+
+        # claim users where we don't have the friendship data yet (status 0 -> 1)
+        users_to_fetch = self.dbq.claim_users(
+            n=self.config["claim_batch"]["users"], status=0, new_status=1
+        )
+
+        if len(users_to_fetch) == 0:
+            if self.dbq.count_users_with_status(status=1) > 0:
+                # other processes are still adding friends that we can continue with
+                return "wait"
             self.logger.info(f"p{self.pid}    finished processing users.")
             return "stop"
 
-        # mark these users as being fetched right now
-        dbq.update_data_status(user_ids=[x["id"] for x in users_to_fetch], status=1)
-
         # fetch the friends and add them to the db
-        for u in users_to_fetch:
+        for i, u in enumerate(users_to_fetch):
             status = 2
             try:
-                friends = self.nw.get_user(u["name"]).get_friends(limit=None)
+                for friends in self.get_friend_pages(user_name=u["name"]):
+                    friend_ids = self.add_users(users=friends)
+                    self.dbq.add_friendships(user=u["id"], friends=friend_ids)
+                    metrics.inc(
+                        "lastfm_items_total",
+                        len(friend_ids),
+                        stage="users",
+                        item="friends",
+                        key=self.pid,
+                    )
             except pylast.PyLastError as E:
-                if "Invalid API key" in str(E.__context__):
+                error = f"{E} {E.__context__}"
+                if "Invalid API key" in error:
                     self.logger.error(f"p{self.pid}    Invalid API key")
+                    # hand the rest of the batch back to the other processes
+                    self.dbq.update_data_status(
+                        user_ids=[x["id"] for x in users_to_fetch[i:]], status=0
+                    )
                     return "stop"
-                elif "no such page" in str(E.__context__):
-                    friends = []
-                elif "User not found" in str(E.__context__):
-                    friends = []
+                elif "no such page" in error:
+                    pass
+                elif "User not found" in error:
                     status = 5
                     self.logger.info(f"p{self.pid}    Removed broken user.")
+                elif isinstance(E, pylast.NetworkError):
+                    # the friend list is incomplete. The user and the rest of the batch are fetched again, the batch is repeated.
+                    self.dbq.update_data_status(
+                        user_ids=[x["id"] for x in users_to_fetch[i:]], status=0
+                    )
+                    raise
                 else:
                     print("1: NEW ERROR", E.__class__.__name__, E.__context__)
-            for fr in friends:
-                friend_id = dbq.add_user(user_object=fr)
-                if friend_id:  # sometimes a user can't be fetched
-                    dbq.add_friendship(user1=u["id"], user2=friend_id)
-            dbq.update_data_status(user_ids=[u["id"]], status=status)
+            self.dbq.update_data_status(user_ids=[u["id"]], status=status)
+            metrics.inc("lastfm_items_total", stage="users", item="users", key=self.pid)
 
         return "repeat"
 
+    def get_friend_pages(self, user_name):
+
+        """
+        Yields the friends of a user page by page. Every friend in user.getFriends already comes with country, playcount and registration date, so adding a page of friends doesn't cost any further API calls.
+        """
+
+        page = 1
+        total_pages = 1
+        while page <= total_pages:
+            doc = self._request("user.getFriends", {"user": user_name, "page": page})
+            friends = doc.getElementsByTagName("friends")
+            if not friends:
+                return
+            total_pages = pylast._number(friends[0].getAttribute("totalPages"))
+            yield [parse_user_info(x) for x in friends[0].getElementsByTagName("user")]
+            page += 1
+
+    def get_user_info(self, user_name):
+
+        """
+        Fetches country, playcount and registration date of a user with a single user.getInfo call.
+        Returns None if the user can't be found.
+        """
+
+        if self.known_failures(kind="user", names=[user_name]):
+            return None
+
+        # failed connections are retried by _request, they end up as NetworkError
+        try:
+            doc = self._request("user.getInfo", {"user": user_name})
+        except pylast.WSError as E:
+            # User is not found error. It sometimes seems to happen that a user object is found in the friends list but data about it can't be retrieved.
+            if error_class(E) == "not_found":
+                self.remember_failures(
+                    kind="user", names=[user_name], error="not_found"
+                )
+            return None
+
+        user_info = parse_user_info(doc.getElementsByTagName("user")[0])
+        user_info["user_name"] = user_name
+        return user_info
+
+    def add_user(self, user_name):
+
+        """
+        Adds a user to the db if it isn't there yet and returns its id (None if the user can't be fetched).
+        """
+
+        user_id = self.dbq.get_user_id_from_name(user_name=user_name)
+        if user_id:
+            return user_id
+
+        user_info = self.get_user_info(user_name=user_name)
+        if not user_info:
+            return None
+
+        return self.dbq.add_user(**user_info)
+
+    def add_users(self, users):
+
+        """
+        Adds a page of users (as returned by parse_user_info) in one go and returns their ids. Only users whose page entry is incomplete are looked up with user.getInfo.
+        """
+
+        complete = []
+        for user_info in users:
+            if user_info["registered"] is None:
+                user_info = self.get_user_info(user_name=user_info["user_name"])
+                if not user_info:  # sometimes a user can't be fetched
+                    continue
+            complete.append(user_info)
+
+        return self.dbq.add_users(users=complete)
+
     # @profile  # activate for speedtest
     def get_listens(self):
 
@@ -118,170 +514,484 @@ class DataCollector(object):
         Then we fetch a user that are not done yet.
         We fetch their listens and add them.
 
+        Users with more than splitting_threshold listens are not fetched in one go. Their timeframe is split into windows (see split_timeframe) that every process picks up, so that several keys work on the same user. Open windows are always served before new users.
+
         Data status:
          <2 = friends have not been fetched (not ready)
           2 = listenings have not been fetched
-          3 = listenings are being fetched
+          3 = listenings are being fetched (or split into windows)
           4 = listenings have been fetched
           5 = broken user (might have deleted their account)
         """
 
         self.logger.info(f"p{self.pid}    Fetching listens.")
 
+        # windows of split users come first
+        window = self.dbq.claim_listen_window()
+        if window:
+            return self.get_listen_window(window)
+
         # count users that have been fully processed
-        n_users = dbq.count_users_with_status(status=4)
+        n_users = self.dbq.count_users_with_status(status=4)
         self.logger.info(f"p{self.pid}    User listenings processed: {n_users}")
 
-        # fetch users where we don't have the listening data yet
-        # we use relatively small batches because we run these in parallel
-        users_to_fetch = dbq.get_users_with_no_data(n=1, status=2)
+        # claim users where we don't have the listening data yet (status 2 -> 3)
+        users_to_fetch = self.dbq.claim_users(
+            n=self.config["claim_batch"]["listens"], status=2, new_status=3
+        )
 
-        # this is for when we are done
-        if len(users_to_fetch) == 0 and n_users != 0:
+        # this is for when we are done (or, with the pipeline, when there is nothing to do right now)
+        if len(users_to_fetch) == 0:
             self.logger.info(f"p{self.pid}    Finished processing user listenings.")
             return "stop"
 
-        # mark these users as being fetched right now
-        dbq.update_data_status(user_ids=[x["id"] for x in users_to_fetch], status=3)
-
         # fetch the listenings and add them to the db
-        for user in users_to_fetch:
+        for i, user in enumerate(users_to_fetch):
 
             if self.debug:
                 self.logger.debug(f"p{self.pid}    --user {user['id']}")
 
-            user_obj = self.nw.get_user(user["name"])
-
-            try:
-                tracks = user_obj.get_recent_tracks(
-                    time_from=self.utc_start,
-                    time_to=self.utc_end,
-                    limit=None,
-                    stream=True,
+            windows = split_timeframe(
+                user=user,
+                time_from=self.utc_start,
+                time_to=self.utc_end,
+                threshold=self.config["splitting_threshold"],
+            )
+            if windows:
+                # the user stays at status 3 until all windows are done
+                self.dbq.add_listen_windows(user_id=user["id"], windows=windows)
+                self.logger.info(
+                    f"p{self.pid}    User {user['name']} has {user['listens']} listens, split into {len(windows)} windows."
                 )
-            except Exception:
-                self.logger.info(f"p{self.pid}    User listening history is private.")
-                dbq.update_data_is_private(user_id=user["id"])
-                # sometimes we get an error "user must be logged in". Probably this means that the listening history of that user is private.
-                tracks = []
-
-            try:  # if we are using a stream of listenings, they are not evaluated immediately, hence, the error is thrown at this point. In the outer try loop we catch any weird and rare errors and retry to fetch the listenings
-                try:  # In the inner try loop we catch the specific error where the user listening history requires a login (is private)
-                    for v, track in enumerate(tracks):
-
-                        if self.config["speedtest"]:
-                            if v >= self.config["speedtest_sample"]:
-                                print("Finished Speedtest")
-                                return
-
-                        # check if the artist is already in the db. if not, fetch it from the api and add it.
-                        artist_name = track.track.artist.name
-                        artist_id = dbq.get_artist_id_from_name(artist_name=artist_name)
-
-                        if not artist_id:
-                            try:
-                                artist_mbid = track.track.artist.get_mbid()
-                            except Exception:
-                                # sometimes the artist can't be accessed. Don't know why, might have been removed from the data. This is NOT handling the case where an artist doesn't have a mbid, which happens much more frequently, but rather the case where an artist exists in the listens history but can't be found in the table of artists.
-                                artist_mbid = None
-                            artist_id = dbq.add_artist(
-                                artist_name=artist_name, mb_id=artist_mbid
-                            )
+                continue
 
-                        album_id = None
-                        if self.config["include_albums"]:
-                            # check if the album is already in the db. if not, fetch it from the api and add it.
-                            try:
-                                album = track.track.get_album()
-                            except Exception:
-                                # sometimes the album can't be accessed. Don't know why, might have been removed from the data. This is NOT handling the case where a song doesn't have an album, which happens much more frequently, but rather the case where an album exists in the listens history but can't be found in the table of albums.
-                                album = None
-                            if album:
-                                album_id = dbq.get_album_id_from_name(
-                                    album_name=album.title
-                                )
-                                if not album_id:
-                                    album_mbid = album.get_mbid()
-                                    album_id = dbq.add_album(
-                                        album_name=album.title,
-                                        mb_id=album_mbid,
-                                        artist_id=artist_id,
-                                    )
-
-                        # check if the song is already in the db. if not, fetch and add to db.
-                        song_name = track.track.title
-                        song_id = dbq.get_song_id_from_name(
-                            song_name=song_name, artist_id=artist_id
-                        )
-                        if not song_id:
-                            try:
-                                song_mbid = track.track.get_mbid()
-                            except Exception:
-                                # again - sometimes this fails as the song seems to be missing from the records. Not the case where a song doesn't have an mbid, but rather where the song is missing entirely.
-                                song_mbid = None
-                            song_id = dbq.add_song(
-                                song_name=song_name,
-                                song_mbid=song_mbid,
-                                album_id=album_id,
-                                artist_id=artist_id,
-                            )
+            result = self.fetch_listens(
+                user=user, time_from=self.utc_start, time_to=self.utc_end
+            )
+            if result == "speedtest":
+                return
+            if result == "failed":
+                # the failed user stays at status 3, the rest of the batch is handed back
+                if users_to_fetch[i + 1 :]:
+                    self.dbq.update_data_status(
+                        user_ids=[x["id"] for x in users_to_fetch[i + 1 :]], status=2
+                    )
+                return "repeat"
 
-                        # add the listening event to the DB
-                        dbq.add_listening(
-                            user=user["id"], song=song_id, time=track.timestamp
-                        )
+            # the user is only marked as done once everything is in the db
+            self.dbq.update_data_status(user_ids=[user["id"]], status=4)
+            metrics.inc(
+                "lastfm_items_total", stage="listens", item="users", key=self.pid
+            )
+
+        self.logger.info(f"p{self.pid}    Finished batch.")
+        self.log_cache_stats()
+        return "repeat"
+
+    def get_refresh(self):
+
+        """
+        Fetches the listens that are newer than the watermark of a user (the newest listen we have) up to now. Users that haven't been refreshed for the longest time come first. A user counts as up to date for refresh.min_age_hours.
+
+        Data status:
+          4 = listenings have been fetched
+          6 = listenings are being refreshed
+        """
+
+        self.logger.info(f"p{self.pid}    Refreshing listens.")
+
+        now = int(time.time())
+        users_to_fetch = self.dbq.claim_refresh(
+            n=self.config["claim_batch"]["listens"],
+            refreshed_before=now - self.config["refresh"]["min_age_hours"] * 3600,
+        )
+
+        if len(users_to_fetch) == 0:
+            self.logger.info(f"p{self.pid}    Finished refreshing user listenings.")
+            return "stop"
+
+        for i, user in enumerate(users_to_fetch):
+
+            result = self.fetch_listens(
+                user=user,
+                time_from=user["watermark"] if user["watermark"] else self.utc_start,
+                time_to=now,
+                stage="refresh",
+            )
+            if result == "speedtest":
+                return
+            if result == "failed":
+                # the failed user stays at status 6, the rest of the batch is handed back
+                if users_to_fetch[i + 1 :]:
+                    self.dbq.update_data_status(
+                        user_ids=[x["id"] for x in users_to_fetch[i + 1 :]], status=4
+                    )
+                return "repeat"
+
+            self.dbq.finish_refresh(user_id=user["id"], refreshed_at=now)
+            metrics.inc(
+                "lastfm_items_total", stage="refresh", item="users", key=self.pid
+            )
 
+        self.log_cache_stats()
+        return "repeat"
+
+    def get_listen_window(self, window):
+
+        """
+        Fetches one window of a split user. The user is marked as done together with their last window.
+        """
+
+        self.logger.info(
+            f"p{self.pid}    Fetching window {window['time_from']}-{window['time_to']} of user {window['name']}."
+        )
+
+        result = self.fetch_listens(
+            user=window,
+            time_from=window["time_from"],
+            time_to=window["time_to"],
+            window=window["time_from"],
+        )
+        if result == "speedtest":
+            return
+        if result == "failed":
+            # the window stays at status 1 and is repeated after a restart
+            return "repeat"
+        if result == "private":
+            # the other windows would fail the same way
+            self.dbq.finish_listen_window(user_id=window["id"])
+        else:
+            self.dbq.finish_listen_window(
+                user_id=window["id"], time_from=window["time_from"]
+            )
+        metrics.inc("lastfm_items_total", stage="listens", item="windows", key=self.pid)
+
+        self.log_cache_stats()
+        return "repeat"
+
+    def fetch_listens(self, user, time_from, time_to, window=None, stage="listens"):
+
+        """
+        Fetches the listens of a user (or of the window starting at window) between time_from and time_to and writes them to the DB.
+
+        If an earlier run was interrupted, only the listens older than the fetch cursor (user["cursor"]) are fetched. The second of the cursor itself is fetched again, duplicates are ignored by the DB.
+
+        Returns "done", "private" (the listening history is private), "failed" (everything up to the error is in the DB) or "speedtest" (the speedtest sample is complete).
+        """
+
+        if user.get("cursor"):
+            time_to = min(time_to, user["cursor"] + 1)
+            self.logger.info(
+                f"p{self.pid}    Resuming user {user['name']} at {user['cursor']}."
+            )
+
+        # listens, new songs and new artists are collected here and written in batches
+        buffer = ListenBuffer(
+            dbq=self.dbq,
+            user_id=user["id"],
+            batch_size=self.config["ingestion"]["batch_size"],
+            flush_interval=self.config["ingestion"]["flush_interval"],
+            window=window,
+        )
+
+        if self.known_failures(kind="private", names=[user["name"]]):
+            self.dbq.update_data_is_private(user_id=user["id"])
+            return "private"
+
+        try:  # In the outer try loop we catch any weird and rare errors and retry to fetch the listenings
+            try:  # In the inner try loop we catch the specific error where the user listening history requires a login (is private)
+                v = 0
+                for listens in self.get_recent_track_pages(
+                    user_name=user["name"],
+                    time_from=time_from,
+                    time_to=time_to,
+                ):
+                    for listen in listens:
+                        buffer.add_listen(
+                            listen=listen,
+                            include_albums=self.config["include_albums"],
+                            lookup_mbid=self.lookup_mbid,
+                        )
                         if self.debug:
                             self.logger.debug(
-                                f"p{self.pid} New song\n  user {user['name']} \n   artist {track.track.artist.name} \n   {track.track.__dict__}"
+                                f"p{self.pid} New song\n  user {user['name']} \n   artist {listen['artist']} \n   {listen}"
                             )
-                except pylast.PyLastError as E:
-                    # same as before but this is needed if we stream the events and fetch them from the generator rather than fetching them all at once
-                    if "Login: User required to be logged in" in str(E.__context__):
-                        self.logger.info(
-                            f"p{self.pid}    User listening history is private."
-                        )
-                        dbq.update_data_is_private(user_id=user["id"])
-            except Exception:
-                self.logger.info(
-                    f"p{self.pid}    Failed to fetch stream of listenings."
+
+                    # the buffer is only written after complete pages
+                    if buffer.is_full():
+                        buffer.flush()
+
+                    v += len(listens)
+                    metrics.inc(
+                        "lastfm_items_total",
+                        len(listens),
+                        stage=stage,
+                        item="listens",
+                        key=self.pid,
+                    )
+                    if self.config["speedtest"]:
+                        if v >= self.config["speedtest_sample"]:
+                            buffer.flush()
+                            print("Finished Speedtest")
+                            return "speedtest"
+            except pylast.PyLastError as E:
+                # sometimes we get an error "user must be logged in". Probably this means that the listening history of that user is private.
+                if "Login: User required to be logged in" in f"{E} {E.__context__}":
+                    self.logger.info(
+                        f"p{self.pid}    User listening history is private."
+                    )
+                    self.dbq.update_data_is_private(user_id=user["id"])
+                    self.remember_failures(
+                        kind="private", names=[user["name"]], error="private"
+                    )
+                    buffer.flush()
+                    return "private"
+                # anything else, e.g. a NetworkError after all retries, means the history is incomplete
+                raise
+        except Exception:
+            self.logger.info(f"p{self.pid}    Failed to fetch stream of listenings.")
+            traceback.print_exc()
+            buffer.flush()  # the user stays at status 3, nothing we have so far is lost
+            return "failed"
+
+        buffer.flush()
+        return "done"
+
+    def log_cache_stats(self):
+        for stats in self.dbq.get_cache_stats():
+            self.logger.info(
+                f"p{self.pid}    {stats['name']} cache: {stats['entries']} entries ({stats['mb']} MB), hit rate {stats['hit_rate']} ({stats['hits']} hits, {stats['misses']} misses)"
+            )
+        if self.cache:
+            stats = self.cache.stats()
+            self.logger.info(
+                f"p{self.pid}    response cache ({stats['mode']}): {stats['mb']} MB, hit rate {stats['hit_rate']} ({stats['hits']} hits, {stats['misses']} misses)"
+            )
+
+    def get_recent_track_pages(self, user_name, time_from, time_to):
+
+        """
+        Yields the listening history of a user page by page (200 listens per page, newest first). Each listen is a dict as returned by parse_listen.
+        """
+
+        page = 1
+        total_pages = 1
+        while page <= total_pages:
+            params = {
+                "user": user_name,
+                "from": time_from,
+                "to": time_to,
+                "limit": 200,
+                "page": page,
+            }
+            doc = self._request("user.getRecentTracks", params)
+            tracks = doc.getElementsByTagName("recenttracks")
+            if not tracks:
+                return
+            total_pages = pylast._number(tracks[0].getAttribute("totalPages"))
+            listens = [parse_listen(x) for x in tracks[0].getElementsByTagName("track")]
+            yield [x for x in listens if x]
+            page += 1
+
+    def lookup_mbid(self, kind, mbid, artist_name, name):
+
+        """
+        Called by the buffer for every new artist, album and song. Returns the mbid from the listening history page unless listen_metadata asks for a lookup, in which case we ask the API for it.
+
+        kind is "artist", "album" or "song"
+        """
+
+        if self.config["listen_metadata"]["inline"] and (
+            mbid or not self.config["listen_metadata"]["mbid_fallback"]
+        ):
+            return mbid
+
+        if "enrich" in self.config["fetch"]:
+            # the enrich stage looks up the missing ones later, without holding up the listens
+            return mbid
+
+        if self.known_failures(kind="artist", names=[artist_name]):
+            return None
+
+        try:
+            return self.fetch_mbid(kind=kind, artist_name=artist_name, name=name)
+        except Exception as E:
+            if kind == "artist" and error_class(E) == "not_found":
+                # the tag stage doesn't need to ask again
+                self.remember_failures(
+                    kind="artist", names=[artist_name], error="not_found"
                 )
-                traceback.print_exc()
-                return "repeat"
+            # sometimes the entity can't be accessed. Don't know why, might have been removed from the data. This is NOT handling the case where an entity doesn't have a mbid, which happens much more frequently, but rather the case where it exists in the listens history but can't be found in the API.
+            return None
 
-            dbq.update_data_status(user_ids=[user["id"]], status=4)
+    def fetch_mbid(self, kind, artist_name, name):
 
-        self.logger.info(f"p{self.pid}    Finished batch.")
-        return "repeat"
+        """
+        Asks the API for the mbid of an artist, album or song. Returns None if it doesn't have one, raises the errors of the API.
+        """
+
+        if kind == "artist":
+            doc = self._request("artist.getInfo", {"artist": artist_name})
+            return pylast._extract(doc, "mbid") or None
+        elif kind == "album":
+            doc = self._request("album.getInfo", {"artist": artist_name, "album": name})
+            return parse_mbid(doc, "album")
+        else:
+            doc = self._request("track.getInfo", {"artist": artist_name, "track": name})
+            return parse_mbid(doc, "track")
 
     def get_tags(self):
 
         """
-        Fetch the tags of the artists.
+        Fetch the tags of the artists. The artists are claimed (tag_status 1), so every process fetches different artists. The tags of the whole batch are written at once.
         """
 
         self.logger.info(f"p{self.pid}    Fetching tags.")
 
-        artists = dbq.get_artists_with_no_tags(n=100)
+        artists = self.dbq.claim_artists(n=self.config["claim_batch"]["tags"])
 
         if len(artists) == 0:
             self.logger.info(f"p{self.pid}    Finished fetching tags.")
             return "stop"
 
-        for artist in artists:
-            try:
-                artist_obj = self.nw.get_artist(artist["name"])
-                tags = artist_obj.get_top_tags(limit=5)
-            except pylast.WSError as E:  # sometimes the artists are not in the DB.
-                if "The artist you supplied could not be found" in str(E):
-                    tags = []
-                else:
-                    self.logger.error(f"       Caught exception on fetching tags: {E},")
+        # artists we already know the API can't find don't cost a call
+        known = self.known_failures(kind="artist", names=[x["name"] for x in artists])
+        fetched = [
+            {"id": x["id"], "tags": [], "status": 3}
+            for x in artists
+            if x["name"] in known
+        ]
+        broken = []  # failed for good, tag_status 4
+        try:
+            for artist in artists:
+                if artist["name"] in known:
                     continue
+                try:
+                    doc = self._request("artist.getTopTags", {"artist": artist["name"]})
+                    fetched.append(
+                        {
+                            "id": artist["id"],
+                            "tags": parse_top_tags(doc, limit=5),
+                            "status": 2,
+                        }
+                    )
+                except pylast.WSError as E:  # sometimes the artists are not in the DB.
+                    if "The artist you supplied could not be found" in str(E):
+                        fetched.append({"id": artist["id"], "tags": [], "status": 3})
+                        self.remember_failures(
+                            kind="artist", names=[artist["name"]], error="not_found"
+                        )
+                    elif E.status == "replay":
+                        # not recorded, the negative result expires at once so that the next run tries again
+                        broken.append(artist["id"])
+                        self.remember_failures(
+                            kind="artist",
+                            names=[artist["name"]],
+                            error="not_recorded",
+                            ttl_days=0,
+                        )
+                    else:
+                        # the transient errors were retried and raised as NetworkError, this one won't go away
+                        self.logger.error(
+                            f"       Caught exception on fetching tags: {E},"
+                        )
+                        broken.append(artist["id"])
+                        self.remember_failures(
+                            kind="artist", names=[artist["name"]], error=error_class(E)
+                        )
+        finally:
+            # what wasn't fetched goes back to the queue, also when the batch was cancelled
+            done = {x["id"] for x in fetched} | set(broken)
+            failed = [x["id"] for x in artists if x["id"] not in done]
+            if fetched:
+                self.dbq.add_tags(artists=fetched)
+            if broken:
+                self.dbq.update_tag_status(artist_ids=broken, status=4)
+            if failed:
+                self.dbq.update_tag_status(artist_ids=failed, status=0)
+
+        metrics.inc(
+            "lastfm_items_total",
+            len(fetched),
+            stage="tags",
+            item="artists",
+            key=self.pid,
+        )
+        metrics.inc(
+            "lastfm_items_total",
+            sum(len(x["tags"]) for x in fetched),
+            stage="tags",
+            item="tags",
+            key=self.pid,
+        )
+
+        self.logger.info(f"p{self.pid}    Finished batch.")
+
+        return "repeat"
+
+    def get_enrich(self):
 
-            dbq.add_tags_to_artist(
-                tags=[{"tag": x.item.name, "weight": x.weight} for x in tags],
-                artist_id=artist["id"],
+        """
+        Looks up the mbids of the artists, albums and songs that came without one, those with the most listens first. The queue (enrich_queue, see db.py) is filled with the new entities whenever it runs empty.
+        """
+
+        self.logger.info(f"p{self.pid}    Fetching mbids.")
+
+        items = self.dbq.claim_enrichment(n=self.config["claim_batch"]["enrich"])
+
+        if len(items) == 0:
+            if self.dbq.queue_enrichment():
+                return "repeat"
+            self.logger.info(f"p{self.pid}    Finished fetching mbids.")
+            return "stop"
+
+        # artists we already know the API can't find don't cost a call
+        known = self.known_failures(
+            kind="artist", names=[x["artist"] or x["name"] for x in items]
+        )
+        fetched = []
+        failed = []
+        try:
+            for item in items:
+                artist_name = item["artist"] or item["name"]
+                if artist_name in known:
+                    fetched.append(
+                        {"kind": item["kind"], "id": item["id"], "mbid": None}
+                    )
+                    continue
+                try:
+                    mbid = self.fetch_mbid(
+                        kind=item["kind"], artist_name=artist_name, name=item["name"]
+                    )
+                except pylast.WSError as E:
+                    if error_class(E) != "not_found":
+                        self.logger.error(
+                            f"       Caught exception on fetching mbids: {E},"
+                        )
+                        failed.append(item)
+                        continue
+                    mbid = None
+                    if item["kind"] == "artist":
+                        self.remember_failures(
+                            kind="artist", names=[artist_name], error="not_found"
+                        )
+                fetched.append({"kind": item["kind"], "id": item["id"], "mbid": mbid})
+        finally:
+            # what wasn't fetched goes back to the queue, also when the batch was cancelled
+            done = {(x["kind"], x["id"]) for x in fetched + failed}
+            failed += [x for x in items if (x["kind"], x["id"]) not in done]
+            if fetched:
+                self.dbq.finish_enrichment(items=fetched)
+            if failed:
+                self.dbq.update_enrichment_status(items=failed, status=0)
+
+        for kind in ENRICH_TABLES:
+            metrics.inc(
+                "lastfm_items_total",
+                sum(1 for x in fetched if x["kind"] == kind and x["mbid"]),
+                stage="enrich",
+                item=f"{kind}_mbids",
+                key=self.pid,
             )
 
         self.logger.info(f"p{self.pid}    Finished batch.")
@@ -0,0 +1,790 @@
+import asyncio
+import functools
+import logging
+import urllib.parse
+from time import perf_counter
+from time import time as timer
+from concurrent.futures import ThreadPoolExecutor
+import pylast
+from api_pylast import (
+    get_timeframe,
+    parse_listen,
+    parse_mbid,
+    parse_response,
+    parse_top_tags,
+    parse_user_info,
+    split_timeframe,
+)
+from buffer import ListenBuffer
+from http_pool import ConnectionPool
+from response_cache import ResponseCache
+from metrics import metrics, error_class
+from rate_control import HostLimiter, RateController, TRANSIENT_ERRORS
+from queries import DataBaseQueries
+
+"""
+An alternative to running one process per API key (engine: asyncio in config.yaml).
+
+All API keys are driven from a single process. Each key gets a rate controller that paces its requests (see rate_control.py), and several requests per key can be in flight at the same time over the keep-alive connections of its pool (see http_pool.py). The requests wait for the network in threads, so the event loop keeps going. That way the time we spend parsing and inserting no longer leaves gaps in the request budget.
+
+The queries run in a thread of their own with its own DB connection (ThreadedQueries), one at a time. A query that waits for a DB lock only holds up the tasks that wait for a query, the requests of all keys go on.
+
+The work loops are the same as in api_pylast.DataCollector, rewritten as coroutines.
+
+"""
+
+
+class ThreadedQueries(object):
+
+    """
+    Runs the queries of the asyncio engine one by one in a separate thread. Every method of DataBaseQueries becomes a coroutine, e.g. await db.claim_users(...).
+    """
+
+    def __init__(self):
+        self.dbq = None
+        # sqlite connections can't be shared between threads, the thread opens its own
+        self.executor = ThreadPoolExecutor(max_workers=1, initializer=self.connect)
+
+    def connect(self):
+        self.dbq = DataBaseQueries()
+
+    async def run(self, f, *args, **kwargs):
+
+        """
+        Runs f in the DB thread, for code that makes several queries (e.g. ListenBuffer.flush).
+        """
+
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, functools.partial(f, *args, **kwargs)
+        )
+
+    def __getattr__(self, name):
+        async def call(*args, **kwargs):
+            return await self.run(lambda: getattr(self.dbq, name)(*args, **kwargs))
+
+        return call
+
+    def close(self):
+        self.executor.shutdown()
+
+
+class AsyncClient(object):
+
+    """
+    Sends API requests for one API key. Raises the same exceptions as pylast.
+    """
+
+    def __init__(
+        self,
+        credentials,
+        pid,
+        rate_control,
+        connections,
+        http,
+        cache=None,
+        api_url=None,
+        host_limiter=None,
+    ):
+        self.pid = pid
+        self.credentials = credentials
+        self.cache = cache  # see response_cache.py
+        self.network = pylast.LastFMNetwork(
+            api_key=credentials["key"], api_secret=credentials["secret"]
+        )
+        self.logger = logging.getLogger("data_py_logger")
+        self.rate = RateController(config=rate_control, key=pid, host=host_limiter)
+        # the same pool as in the collector processes, a thread per connection waits for the responses
+        host, path = self.network.ws_server
+        self.pool = ConnectionPool(
+            url=api_url if api_url else f"https://{host}{path}",
+            size=connections,
+            connect_timeout=http["connect_timeout"],
+            read_timeout=http["read_timeout"],
+            keepalive_expiry=http["keepalive_expiry"],
+            key=pid,
+        )
+        self.executor = ThreadPoolExecutor(max_workers=connections)
+
+    async def request(self, method, params):
+
+        # cached responses don't cost any of the request budget
+        if self.cache:
+            response = self.cache.get(method, params)
+            if response is not None:
+                metrics.count_request(method=method, key=self.pid, result="cached")
+                return parse_response(self.network, response)
+            if self.cache.mode == "replay":
+                metrics.count_request(
+                    method=method, key=self.pid, result="not_recorded"
+                )
+                raise pylast.WSError(
+                    self.network, "replay", f"{method} was not recorded"
+                )
+
+        body = dict(params)
+        body["method"] = method
+        body["api_key"] = self.network.api_key
+        body = urllib.parse.urlencode(body).encode("utf-8")
+
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.rate.delay())
+            # the latency doesn't include the wait for the rate controller
+            start = perf_counter()
+            try:
+                try:
+                    status, payload = await asyncio.get_running_loop().run_in_executor(
+                        self.executor, self.pool.post, body
+                    )
+                except Exception as e:
+                    raise pylast.NetworkError(self.network, e) from e
+
+                if status in (500, 502, 503, 504):
+                    raise pylast.WSError(
+                        self.network,
+                        status,
+                        f"Connection to the API failed with HTTP code {status}",
+                    )
+                response = str(payload, "utf-8")
+                doc = parse_response(self.network, response)
+                break
+            except Exception as E:
+                metrics.count_request(
+                    method=method,
+                    key=self.pid,
+                    result=error_class(E),
+                    seconds=perf_counter() - start,
+                )
+                wait = self.rate.retry(E, attempt)
+                if wait is None:
+                    if self.cache and isinstance(E, pylast.WSError):
+                        self.cache.put_error(method, params, E.status, E.details)
+                    if error_class(E) in TRANSIENT_ERRORS and not isinstance(
+                        E, pylast.NetworkError
+                    ):
+                        # the task repeats its unit, like after a network error
+                        raise pylast.NetworkError(self.network, E) from E
+                    raise
+                self.logger.info(
+                    f"p{self.pid}    {method} failed ({E}), retrying in {wait:.1f}s"
+                )
+                await asyncio.sleep(wait)
+                attempt += 1
+
+        self.rate.success()
+        metrics.count_request(
+            method=method, key=self.pid, result="ok", seconds=perf_counter() - start
+        )
+        if self.cache:
+            self.cache.put(method, params, response)
+        return doc
+
+    def close(self):
+        self.pool.close()
+        self.executor.shutdown()
+
+
+class AsyncCollector(object):
+    def __init__(self, accounts, config):
+        self.logger = logging.getLogger("data_py_logger")
+        self.config = config
+        self.utc_start, self.utc_end = get_timeframe(config=config)
+        settings = config["asyncio"]
+        cache = None
+        if config["response_cache"]["mode"] != "off":
+            cache = ResponseCache(
+                mode=config["response_cache"]["mode"],
+                ttl_hours=config["response_cache"]["ttl_hours"],
+                max_mb=config["response_cache"]["max_mb"],
+            )
+        # last.fm limits the requests per IP address, all keys share one limit
+        host_limiter = HostLimiter(rate=config["rate_control"]["host_max_rate"])
+        self.clients = [
+            AsyncClient(
+                credentials=accounts[a],
+                pid=pid,
+                rate_control=config["rate_control"],
+                connections=settings["in_flight"],
+                http=config["http"],
+                cache=cache,
+                api_url=config["api_url"],
+                host_limiter=host_limiter,
+            )
+            for pid, a in enumerate(accounts)
+        ]
+        self.db = ThreadedQueries()
+        self.busy = 0  # number of tasks that are working on a claimed unit right now
+        self.artists = (
+            []
+        )  # claimed artists (tag_status 1) that still wait for their tags
+        self.enrich_items = (
+            []
+        )  # claimed entities (enrich_queue status 1) that still wait for their mbid
+
+    def run(self):
+        asyncio.run(self.run_stages())
+
+    async def run_stages(self):
+
+        for client in self.clients:
+            await self.test_credentials(client)
+
+        # fetching data of one type must finish before the next step starts
+        for stage in self.config["fetch"]:
+            f = getattr(self, "get_" + stage)
+            workers = [
+                self.loop(f, client, f"p{client.pid}.{i}")
+                for client in self.clients
+                for i in range(self.config["asyncio"]["in_flight"])
+            ]
+            # the tasks run concurrently, so we count the time of the whole stage once
+            with metrics.stage_timer(stage=stage):
+                await asyncio.gather(*workers)
+            metrics.snapshot()
+
+        for client in self.clients:
+            client.close()
+        self.db.close()
+
+    async def test_credentials(self, client):
+
+        # a replay only answers from the recorded responses and has no call for the check
+        if self.config["response_cache"]["mode"] == "replay":
+            return
+        try:
+            await client.request(
+                "user.getInfo", {"user": client.credentials["username"]}
+            )
+        except Exception:
+            raise Exception(
+                f"Invalid user credentials on user {client.credentials['username']}"
+            )
+
+    async def loop(self, f, client, wid):
+
+        """
+        Same as LastFM.loop but for one task.
+        """
+
+        action = "repeat"
+        while action == "repeat":
+            try:
+                action = await f(client, wid)
+            except pylast.NetworkError as e:
+                # the rate controller of the key already retried and holds back the next requests if the key keeps failing
+                self.logger.error(f" {wid}    Caught exception: {e},")
+
+    async def known_failures(self, kind, names, client):
+
+        """
+        See DataCollector.known_failures
+        """
+
+        known = await self.db.get_negative_results(kind=kind, names=names)
+        if known:
+            metrics.inc(
+                "lastfm_negative_hits_total", len(known), kind=kind, key=client.pid
+            )
+        return known
+
+    async def remember_failures(self, kind, names, error, ttl_days=None):
+        await self.db.add_negative_results(
+            kind=kind,
+            names=names,
+            error=error,
+            ttl_days=(
+                self.config["negative_ttl_days"][kind] if ttl_days is None else ttl_days
+            ),
+        )
+
+    async def get_user_info(self, client, user_name):
+
+        if await self.known_failures(kind="user", names=[user_name], client=client):
+            return None
+
+        # failed connections are retried by the client, they end up as NetworkError
+        try:
+            doc = await client.request("user.getInfo", {"user": user_name})
+        except pylast.WSError as E:
+            # User is not found error.
+            if error_class(E) == "not_found":
+                await self.remember_failures(
+                    kind="user", names=[user_name], error="not_found"
+                )
+            return None
+
+        user_info = parse_user_info(doc.getElementsByTagName("user")[0])
+        user_info["user_name"] = user_name
+        return user_info
+
+    async def get_users(self, client, wid):
+
+        """
+        See DataCollector.get_users
+        """
+
+        n_users = await self.db.count_users_with_status_bigger(status=2)
+
+        if self.config["limits"]["users"] and self.config["limits"]["users"] <= n_users:
+            self.logger.info(
+                f"{wid}    Users processed: {n_users}. Reached limit. Continuing with listenings."
+            )
+            return "stop"
+
+        users_to_fetch = await self.db.claim_users(
+            n=self.config["claim_batch"]["users"], status=0, new_status=1
+        )
+
+        # this is for the initialization if there are no users yet. Only one task adds the seeds.
+        if len(users_to_fetch) == 0 and n_users == 0 and self.busy == 0:
+            self.busy += 1
+            try:
+                for name in self.config["seeds"]:
+                    if not await self.db.get_user_id_from_name(user_name=name):
+                        user_info = await self.get_user_info(client, name)
+                        if user_info:
+                            await self.db.add_user(**user_info)
+            finally:
+                self.busy -= 1
+            return "repeat"
+        elif len(users_to_fetch) == 0:
+            if self.busy > 0:
+                # other tasks are still adding friends that we can continue with
+                await asyncio.sleep(1)
+                return "repeat"
+            self.logger.info(f"{wid}    finished processing users.")
+            return "stop"
+
+        self.busy += 1
+        try:
+            for i, u in enumerate(users_to_fetch):
+                status = 2
+                try:
+                    page = 1
+                    total_pages = 1
+                    while page <= total_pages:
+                        doc = await client.request(
+                            "user.getFriends", {"user": u["name"], "page": page}
+                        )
+                        friends = doc.getElementsByTagName("friends")
+                        if not friends:
+                            break
+                        total_pages = pylast._number(
+                            friends[0].getAttribute("totalPages")
+                        )
+                        complete = []
+                        for user_info in [
+                            parse_user_info(x)
+                            for x in friends[0].getElementsByTagName("user")
+                        ]:
+                            if user_info["registered"] is None:
+                                user_info = await self.get_user_info(
+                                    client, user_info["user_name"]
+                                )
+                                if not user_info:
+                                    continue
+                            complete.append(user_info)
+                        friend_ids = await self.db.add_users(users=complete)
+                        await self.db.add_friendships(user=u["id"], friends=friend_ids)
+                        metrics.inc(
+                            "lastfm_items_total",
+                            len(friend_ids),
+                            stage="users",
+                            item="friends",
+                            key=client.pid,
+                        )
+                        page += 1
+                except pylast.WSError as E:
+                    if "Invalid API key" in str(E):
+                        self.logger.error(f"{wid}    Invalid API key")
+                        # hand the rest of the batch back to the other tasks
+                        await self.db.update_data_status(
+                            user_ids=[x["id"] for x in users_to_fetch[i:]], status=0
+                        )
+                        return "stop"
+                    elif "User not found" in str(E):
+                        status = 5
+                        self.logger.info(f"{wid}    Removed broken user.")
+                    elif "no such page" not in str(E):
+                        self.logger.error(f"{wid}    Caught exception: {E}")
+                except pylast.NetworkError:
+                    # the friend list is incomplete, the user and the rest of the batch are fetched again
+                    await self.db.update_data_status(
+                        user_ids=[x["id"] for x in users_to_fetch[i:]], status=0
+                    )
+                    raise
+                await self.db.update_data_status(user_ids=[u["id"]], status=status)
+                metrics.inc(
+                    "lastfm_items_total", stage="users", item="users", key=client.pid
+                )
+        finally:
+            self.busy -= 1
+
+        return "repeat"
+
+    async def get_listens(self, client, wid):
+
+        """
+        See DataCollector.get_listens
+        """
+
+        # windows of split users come first
+        window = await self.db.claim_listen_window()
+        if window:
+            return await self.get_listen_window(client, wid, window)
+
+        users_to_fetch = await self.db.claim_users(
+            n=self.config["claim_batch"]["listens"], status=2, new_status=3
+        )
+
+        if len(users_to_fetch) == 0:
+            self.logger.info(f"{wid}    Finished processing user listenings.")
+            return "stop"
+
+        for i, user in enumerate(users_to_fetch):
+
+            windows = split_timeframe(
+                user=user,
+                time_from=self.utc_start,
+                time_to=self.utc_end,
+                threshold=self.config["splitting_threshold"],
+            )
+            if windows:
+                await self.db.add_listen_windows(user_id=user["id"], windows=windows)
+                self.logger.info(
+                    f"{wid}    User {user['name']} has {user['listens']} listens, split into {len(windows)} windows."
+                )
+                continue
+
+            result = await self.fetch_listens(
+                client, wid, user, self.utc_start, self.utc_end
+            )
+            if result == "failed":
+                # the failed user stays at status 3, the rest of the batch is handed back
+                if users_to_fetch[i + 1 :]:
+                    await self.db.update_data_status(
+                        user_ids=[x["id"] for x in users_to_fetch[i + 1 :]], status=2
+                    )
+                return "repeat"
+
+            # the user is only marked as done once everything is in the db
+            await self.db.update_data_status(user_ids=[user["id"]], status=4)
+            metrics.inc(
+                "lastfm_items_total", stage="listens", item="users", key=client.pid
+            )
+            self.logger.info(
+                f"{wid}    User listenings processed: {user['name']} ({user['listens']} listens)"
+            )
+
+        return "repeat"
+
+    async def get_refresh(self, client, wid):
+
+        """
+        See DataCollector.get_refresh
+        """
+
+        now = int(timer())
+        users_to_fetch = await self.db.claim_refresh(
+            n=self.config["claim_batch"]["listens"],
+            refreshed_before=now - self.config["refresh"]["min_age_hours"] * 3600,
+        )
+
+        if len(users_to_fetch) == 0:
+            self.logger.info(f"{wid}    Finished refreshing user listenings.")
+            return "stop"
+
+        for i, user in enumerate(users_to_fetch):
+            result = await self.fetch_listens(
+                client,
+                wid,
+                user,
+                user["watermark"] if user["watermark"] else self.utc_start,
+                now,
+                stage="refresh",
+            )
+            if result == "failed":
+                # the failed user stays at status 6, the rest of the batch is handed back
+                if users_to_fetch[i + 1 :]:
+                    await self.db.update_data_status(
+                        user_ids=[x["id"] for x in users_to_fetch[i + 1 :]], status=4
+                    )
+                return "repeat"
+            await self.db.finish_refresh(user_id=user["id"], refreshed_at=now)
+            metrics.inc(
+                "lastfm_items_total", stage="refresh", item="users", key=client.pid
+            )
+
+        return "repeat"
+
+    async def get_listen_window(self, client, wid, window):
+
+        """
+        See DataCollector.get_listen_window
+        """
+
+        result = await self.fetch_listens(
+            client,
+            wid,
+            window,
+            window["time_from"],
+            window["time_to"],
+            window["time_from"],
+        )
+        if result == "failed":
+            return "repeat"
+        if result == "private":
+            await self.db.finish_listen_window(user_id=window["id"])
+        else:
+            await self.db.finish_listen_window(
+                user_id=window["id"], time_from=window["time_from"]
+            )
+        metrics.inc(
+            "lastfm_items_total", stage="listens", item="windows", key=client.pid
+        )
+        return "repeat"
+
+    async def fetch_listens(
+        self, client, wid, user, time_from, time_to, window=None, stage="listens"
+    ):
+
+        """
+        See DataCollector.fetch_listens
+        """
+
+        if user.get("cursor"):
+            time_to = min(time_to, user["cursor"] + 1)
+
+        if await self.known_failures(
+            kind="private", names=[user["name"]], client=client
+        ):
+            await self.db.update_data_is_private(user_id=user["id"])
+            return "private"
+
+        # the buffer is filled and written in the DB thread, it looks up the ids of artists and songs
+        buffer = ListenBuffer(
+            dbq=self.db.dbq,
+            user_id=user["id"],
+            batch_size=self.config["ingestion"]["batch_size"],
+            flush_interval=self.config["ingestion"]["flush_interval"],
+            window=window,
+        )
+
+        try:
+            page = 1
+            total_pages = 1
+            while page <= total_pages:
+                params = {
+                    "user": user["name"],
+                    "from": time_from,
+                    "to": time_to,
+                    "limit": 200,
+                    "page": page,
+                }
+                doc = await client.request("user.getRecentTracks", params)
+                tracks = doc.getElementsByTagName("recenttracks")
+                if not tracks:
+                    break
+                total_pages = pylast._number(tracks[0].getAttribute("totalPages"))
+                n = await self.db.run(
+                    self.add_page, buffer, tracks[0].getElementsByTagName("track")
+                )
+                metrics.inc(
+                    "lastfm_items_total", n, stage=stage, item="listens", key=client.pid
+                )
+                page += 1
+        except pylast.WSError as E:
+            await self.db.run(
+                buffer.flush
+            )  # the user (or window) stays at status 3 (1)
+            if "Login: User required to be logged in" in str(E):
+                self.logger.info(f"{wid}    User listening history is private.")
+                await self.db.update_data_is_private(user_id=user["id"])
+                await self.remember_failures(
+                    kind="private", names=[user["name"]], error="private"
+                )
+                return "private"
+            self.logger.info(f"{wid}    Failed to fetch stream of listenings: {E}")
+            return "failed"
+        except pylast.NetworkError:
+            await self.db.run(buffer.flush)
+            raise
+
+        await self.db.run(buffer.flush)
+        return "done"
+
+    def add_page(self, buffer, nodes):
+
+        """
+        Adds the listens of a page of the listening history to the buffer and writes it once it is full. Returns the number of listens. Runs in the DB thread.
+        """
+
+        n = 0
+        for node in nodes:
+            listen = parse_listen(node)
+            if listen:
+                # the mbids are taken from the page, see listen_metadata in config.yaml
+                buffer.add_listen(
+                    listen=listen, include_albums=self.config["include_albums"]
+                )
+                n += 1
+        # the buffer is only written after complete pages
+        if buffer.is_full():
+            buffer.flush()
+        return n
+
+    async def claim_artist(self):
+
+        """
+        Hands out artists without tags one by one. They are claimed in batches, so no other process gets them.
+        """
+
+        if not self.artists:
+            # another task may claim at the same time, both batches are kept
+            claimed = await self.db.claim_artists(n=self.config["claim_batch"]["tags"])
+            self.artists.extend(claimed)
+        if not self.artists:
+            return None
+        return self.artists.pop(0)
+
+    async def get_tags(self, client, wid):
+
+        """
+        See DataCollector.get_tags
+        """
+
+        artist = await self.claim_artist()
+        if not artist:
+            self.logger.info(f"{wid}    Finished fetching tags.")
+            return "stop"
+
+        status = 2
+        try:
+            if await self.known_failures(
+                kind="artist", names=[artist["name"]], client=client
+            ):
+                tags = []
+                status = 3
+            else:
+                doc = await client.request(
+                    "artist.getTopTags", {"artist": artist["name"]}
+                )
+                tags = parse_top_tags(doc, limit=5)
+        except pylast.WSError as E:  # sometimes the artists are not in the DB.
+            if "The artist you supplied could not be found" in str(E):
+                tags = []
+                status = 3
+                await self.remember_failures(
+                    kind="artist", names=[artist["name"]], error="not_found"
+                )
+            elif E.status == "replay":
+                # not recorded, the negative result expires at once so that the next run tries again
+                await self.remember_failures(
+                    kind="artist",
+                    names=[artist["name"]],
+                    error="not_recorded",
+                    ttl_days=0,
+                )
+                await self.db.update_tag_status(artist_ids=[artist["id"]], status=4)
+                return "repeat"
+            else:
+                # the transient errors were retried and raised as NetworkError, this one won't go away
+                self.logger.error(f"       Caught exception on fetching tags: {E},")
+                await self.remember_failures(
+                    kind="artist", names=[artist["name"]], error=error_class(E)
+                )
+                await self.db.update_tag_status(artist_ids=[artist["id"]], status=4)
+                return "repeat"
+        except BaseException:
+            await self.db.update_tag_status(artist_ids=[artist["id"]], status=0)
+            raise
+
+        await self.db.add_tags_to_artist(
+            tags=tags, artist_id=artist["id"], status=status
+        )
+        metrics.inc("lastfm_items_total", stage="tags", item="artists", key=client.pid)
+        metrics.inc(
+            "lastfm_items_total",
+            len(tags),
+            stage="tags",
+            item="tags",
+            key=client.pid,
+        )
+
+        return "repeat"
+
+    async def claim_enrichment_item(self):
+
+        """
+        Hands out the queued artists, albums and songs one by one, like claim_artist. Queues the new ones when the queue runs empty.
+        """
+
+        if not self.enrich_items:
+            n = self.config["claim_batch"]["enrich"]
+            # another task may claim at the same time, both batches are kept
+            claimed = await self.db.claim_enrichment(n=n)
+            if not claimed and await self.db.queue_enrichment():
+                claimed = await self.db.claim_enrichment(n=n)
+            self.enrich_items.extend(claimed)
+        if not self.enrich_items:
+            return None
+        return self.enrich_items.pop(0)
+
+    async def get_enrich(self, client, wid):
+
+        """
+        See DataCollector.get_enrich
+        """
+
+        item = await self.claim_enrichment_item()
+        if not item:
+            self.logger.info(f"{wid}    Finished fetching mbids.")
+            return "stop"
+
+        artist_name = item["artist"] or item["name"]
+        mbid = None
+        try:
+            if not await self.known_failures(
+                kind="artist", names=[artist_name], client=client
+            ):
+                if item["kind"] == "artist":
+                    doc = await client.request(
+                        "artist.getInfo", {"artist": artist_name}
+                    )
+                    mbid = pylast._extract(doc, "mbid") or None
+                elif item["kind"] == "album":
+                    doc = await client.request(
+                        "album.getInfo", {"artist": artist_name, "album": item["name"]}
+                    )
+                    mbid = parse_mbid(doc, "album")
+                else:
+                    doc = await client.request(
+                        "track.getInfo", {"artist": artist_name, "track": item["name"]}
+                    )
+                    mbid = parse_mbid(doc, "track")
+        except pylast.WSError as E:
+            if error_class(E) == "not_found":
+                if item["kind"] == "artist":
+                    await self.remember_failures(
+                        kind="artist", names=[artist_name], error="not_found"
+                    )
+            else:
+                self.logger.error(f"       Caught exception on fetching mbids: {E},")
+                await self.db.update_enrichment_status(items=[item], status=0)
+                return "repeat"
+        except BaseException:
+            await self.db.update_enrichment_status(items=[item], status=0)
+            raise
+
+        await self.db.finish_enrichment(
+            items=[{"kind": item["kind"], "id": item["id"], "mbid": mbid}]
+        )
+        if mbid:
+            metrics.inc(
+                "lastfm_items_total",
+                stage="enrich",
+                item=f"{item['kind']}_mbids",
+                key=client.pid,
+            )
+
+        return "repeat"
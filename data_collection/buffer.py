@@ -0,0 +1,132 @@
+from time import time as timer
+
+"""
+Buffered ingestion of listening events.
+
+Instead of writing (and committing) every scrobble, song and artist on its own, the collector adds them to a ListenBuffer. The buffer is written to the DB in one transaction once it holds batch_size listens or once flush_interval seconds have passed.
+
+New artists, albums and songs are kept by name until the flush because they don't have an id yet.
+
+Listens have to be added in the order of the listening history (newest first), the flush also moves the fetch cursor of the user (see DataBaseQueries.add_listens_batch).
+
+"""
+
+
+class ListenBuffer(object):
+    def __init__(self, dbq, user_id, batch_size, flush_interval, window=None):
+        self.dbq = dbq
+        self.user_id = user_id
+        self.window = window  # time_from of the listen window that is fetched, if the user is split
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.clear()
+
+    def clear(self):
+        self.artists = {}  # artist name -> mbid
+        self.albums = {}  # album name -> (mbid, artist name)
+        self.songs = {}  # (artist name, song name) -> (mbid, album name)
+        self.listens = []  # (artist name, song name, time)
+        self.started = timer()
+
+    def has_artist(self, artist_name):
+        return artist_name in self.artists
+
+    def has_album(self, album_name):
+        return album_name in self.albums
+
+    def has_song(self, artist_name, song_name):
+        return (artist_name, song_name) in self.songs
+
+    def add_artist(self, artist_name, mb_id):
+        self.artists[artist_name] = mb_id
+
+    def add_album(self, album_name, mb_id, artist_name):
+        self.albums[album_name] = (mb_id, artist_name)
+
+    def add_song(self, song_name, song_mbid, album_name, artist_name):
+        self.songs[(artist_name, song_name)] = (song_mbid, album_name)
+
+    def add_listening(self, artist_name, song_name, time):
+        self.listens.append((artist_name, song_name, time))
+
+    def add_listen(self, listen, include_albums, lookup_mbid=None):
+
+        """
+        Adds a listen (as returned by api_pylast.parse_listen) and, if they are new, its artist, album and song.
+
+        lookup_mbid(kind, mbid, artist_name, name) is called for every new artist, album and song and returns the mbid to store. Without it, the mbids of the listening history page are used.
+        """
+
+        artist_name = listen["artist"]
+        song_name = listen["song"]
+
+        # check if the artist is already in the db or in the buffer. if not, add it.
+        artist_id = None
+        if not self.has_artist(artist_name):
+            artist_id = self.dbq.get_artist_id_from_name(artist_name=artist_name)
+            if not artist_id:
+                artist_mbid = listen["artist_mbid"]
+                if lookup_mbid:
+                    artist_mbid = lookup_mbid("artist", artist_mbid, artist_name, None)
+                self.add_artist(artist_name=artist_name, mb_id=artist_mbid)
+
+        album_name = None
+        if include_albums and listen["album"]:
+            # check if the album is already in the db or in the buffer. if not, add it.
+            album_name = listen["album"]
+            if not self.has_album(album_name) and not self.dbq.get_album_id_from_name(
+                album_name=album_name
+            ):
+                album_mbid = listen["album_mbid"]
+                if lookup_mbid:
+                    album_mbid = lookup_mbid(
+                        "album", album_mbid, artist_name, album_name
+                    )
+                self.add_album(
+                    album_name=album_name, mb_id=album_mbid, artist_name=artist_name
+                )
+
+        # check if the song is already in the db or in the buffer. if not, add it.
+        # a song of an artist that is still in the buffer can't be in the db yet.
+        if not self.has_song(artist_name, song_name) and (
+            not artist_id
+            or not self.dbq.get_song_id_from_name(
+                song_name=song_name, artist_id=artist_id
+            )
+        ):
+            song_mbid = listen["song_mbid"]
+            if lookup_mbid:
+                song_mbid = lookup_mbid("song", song_mbid, artist_name, song_name)
+            self.add_song(
+                song_name=song_name,
+                song_mbid=song_mbid,
+                album_name=album_name,
+                artist_name=artist_name,
+            )
+
+        self.add_listening(
+            artist_name=artist_name, song_name=song_name, time=listen["time"]
+        )
+
+    def is_full(self):
+        return (
+            len(self.listens) >= self.batch_size
+            or timer() - self.started >= self.flush_interval
+        )
+
+    def flush(self):
+
+        """
+        Writes everything that is buffered in a single transaction.
+        """
+
+        if self.listens or self.artists or self.songs or self.albums:
+            self.dbq.add_listens_batch(
+                user=self.user_id,
+                artists=self.artists,
+                albums=self.albums,
+                songs=self.songs,
+                listens=self.listens,
+                window=self.window,
+            )
+        self.clear()
@@ -0,0 +1,478 @@
+from queries import dbq as default_dbq
+from metrics import metrics
+from shards import remove_db
+import db
+import inspect
+import ipaddress
+import json
+import math
+import logging
+import os
+import random
+import socket
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from time import monotonic
+from pathlib import Path
+
+"""
+Several collectors, on one machine or on many, crawling one dataset together (coordinator in config.yaml).
+
+The coordinator owns data/lastfm_raw.db of the machine it runs on:
+
+    python3 data_collection/coordinator.py
+
+Every collector with coordinator.url in its config.yaml sends its queries there instead of opening the DB itself. The listens go to the shards of the collector's machine (see shards.py). After the listens (refresh) stage, the collector merges them into one file and sends it to the coordinator, which merges it into the shared DB. finish_refresh runs before the new listens are in the shared DB, the merge moves the watermarks of the refreshed users to them. So the next stages (tags, enrich) see the artists, albums and songs of all machines. A machine that finishes the listens stage early starts the tags stage without the artists of the others, the machines that finish later tag those.
+
+Every unit of work a collector claims (a user, a listen window, an artist, an enrich_queue entry) gets a lease of lease_seconds in the leases table. The collectors renew the leases of all their units every heartbeat_seconds. The call that completes a unit (e.g. update_data_status for a user, add_tags for an artist) acknowledges it and ends its lease. Every reap_seconds, the coordinator hands back the units whose lease expired, because the collector holding them stopped or lost its connection. They go to the next collector that asks. A unit that is still leased is never handed back, also not by reset_cancelled_fetching when a collector starts.
+
+All collectors that use the DB must go through the coordinator while it runs. The units of a collector that writes to the DB on its own have no lease and would be handed back.
+
+The coordinator speaks JSON over HTTP and executes one call at a time over its single DB connection:
+  POST /call        {"holder", "method", "args", "kwargs"} -> {"result"}, runs a method of DataBaseQueries
+  POST /heartbeat   {"holder"} -> {"leases"}, renews the leases of holder
+  POST /merge       the file of a collection DB -> {"listens"}, merges it into the DB and returns the number of new listens
+
+Only the methods in METHODS can be called, and their arguments are checked before they reach the DB. With coordinator.token, every request has to carry it in the X-Coordinator-Token header. The coordinator doesn't start on a host other than a loopback address (e.g. 0.0.0.0 for the other machines) without a token.
+
+"""
+
+
+def integer(x):
+    return isinstance(x, int) and not isinstance(x, bool)
+
+
+def number(x):
+    return isinstance(x, (int, float)) and not isinstance(x, bool)
+
+
+def text(x):
+    return isinstance(x, str)
+
+
+def optional(check):
+    return lambda x: x is None or check(x)
+
+
+def either(*checks):
+    return lambda x: any(check(x) for check in checks)
+
+
+def list_of(check):
+    return lambda x: isinstance(x, list) and all(check(y) for y in x)
+
+
+def pair(check):
+    return lambda x: isinstance(x, list) and len(x) == 2 and all(check(y) for y in x)
+
+
+def record(**checks):
+    return lambda x: isinstance(x, dict) and all(
+        k in x and check(x[k]) for k, check in checks.items()
+    )
+
+
+USER = record(
+    user_name=text,
+    country=optional(text),
+    registered=optional(either(text, integer)),
+    total_listens=optional(integer),
+)
+TAG = record(tag=text, weight=number)
+ENRICH_ITEM = record(kind=text, id=integer)
+
+# the calls that the collectors can make through the coordinator: method -> {argument: check of its value}
+# the arguments come from the network and end up in the queries, every other call is refused
+METHODS = {
+    "add_friendship": {"user1": integer, "user2": integer},
+    "add_friendships": {"user": integer, "friends": list_of(integer)},
+    "add_listen_windows": {"user_id": integer, "windows": list_of(pair(number))},
+    "add_negative_results": {
+        "kind": text,
+        "names": list_of(text),
+        "error": optional(text),
+        "ttl_days": number,
+    },
+    "add_tags": {
+        "artists": list_of(record(id=integer, tags=list_of(TAG), status=integer))
+    },
+    "add_tags_to_artist": {
+        "tags": list_of(TAG),
+        "artist_id": integer,
+        "status": integer,
+    },
+    "add_user": {
+        "user_name": text,
+        "country": optional(text),
+        "registered": optional(either(text, integer)),
+        "total_listens": optional(integer),
+    },
+    "add_users": {"users": list_of(USER)},
+    "claim_artists": {"n": integer},
+    "claim_enrichment": {"n": integer},
+    "claim_listen_window": {},
+    "claim_refresh": {"n": integer, "refreshed_before": number},
+    "claim_users": {"n": integer, "status": integer, "new_status": integer},
+    "copy_users": {
+        "users": list_of(
+            record(
+                id_nb=integer,
+                name=text,
+                country=optional(text),
+                registered=optional(either(text, integer)),
+                total_listens=optional(integer),
+                history_is_private=optional(integer),
+            )
+        )
+    },
+    "count_artists_with_no_tags": {},
+    "count_users_with_status": {"status": integer},
+    "count_users_with_status_bigger": {"status": integer},
+    "finish_enrichment": {
+        "items": list_of(record(kind=text, id=integer, mbid=optional(text)))
+    },
+    "finish_listen_window": {"user_id": integer, "time_from": optional(number)},
+    "finish_refresh": {"user_id": integer, "refreshed_at": number},
+    "get_artists_with_no_tags": {"n": integer},
+    "get_cache_stats": {},
+    "get_data_stats": {},
+    "get_negative_results": {"kind": text, "names": list_of(text)},
+    "get_remaining_listens": {},
+    "get_stats": {},
+    "get_user_id_from_name": {"user_name": text},
+    "get_users_by_id": {"user_ids": list_of(integer)},
+    "get_users_with_no_data": {"n": integer, "status": integer},
+    "queue_enrichment": {},
+    "set_fetch_cursor": {
+        "user": integer,
+        "cursor": optional(number),
+        "window": optional(number),
+    },
+    "update_data_is_private": {"user_id": integer},
+    "update_data_status": {
+        "status": integer,
+        "user_ids": optional(list_of(integer)),
+        "listens": optional(number),
+        "songs": optional(number),
+    },
+    "update_enrichment_status": {"items": list_of(ENRICH_ITEM), "status": integer},
+    "update_tag_status": {"artist_ids": list_of(integer), "status": integer},
+}
+
+# the calls that claim units: method -> function(arguments, result) returning the kind of the units and their ids
+CLAIMS = {
+    "claim_users": lambda args, result: ("user", [x["id"] for x in result]),
+    "claim_refresh": lambda args, result: ("user", [x["id"] for x in result]),
+    "claim_listen_window": lambda args, result: (
+        "window",
+        [f"{result['id']}:{result['time_from']}"] if result else [],
+    ),
+    "claim_artists": lambda args, result: ("artist", [x["id"] for x in result]),
+    "claim_enrichment": lambda args, result: (
+        "enrich",
+        [f"{x['kind']}:{x['id']}" for x in result],
+    ),
+}
+
+# the calls that complete (or hand back) units: method -> function(arguments) returning the kind of the units and their ids
+ACKS = {
+    "update_data_status": lambda args: ("user", args["user_ids"] or []),
+    "finish_refresh": lambda args: ("user", [args["user_id"]]),
+    # a split user is done with its windows
+    "add_listen_windows": lambda args: ("user", [args["user_id"]]),
+    "finish_listen_window": lambda args: (
+        "window",
+        [f"{args['user_id']}:{args['time_from']}"]
+        if args["time_from"] is not None
+        else [],
+    ),
+    "add_tags": lambda args: ("artist", [x["id"] for x in args["artists"]]),
+    "add_tags_to_artist": lambda args: ("artist", [args["artist_id"]]),
+    "update_tag_status": lambda args: ("artist", args["artist_ids"]),
+    "finish_enrichment": lambda args: (
+        "enrich",
+        [f"{x['kind']}:{x['id']}" for x in args["items"]],
+    ),
+    "update_enrichment_status": lambda args: (
+        "enrich",
+        [f"{x['kind']}:{x['id']}" for x in args["items"]],
+    ),
+}
+
+
+class Coordinator(object):
+    def __init__(self, dbq, config):
+        self.logger = logging.getLogger("data_py_logger")
+        self.dbq = dbq
+        self.config = config
+        self.last_reap = monotonic()
+
+    def call(self, holder, method, args, kwargs):
+        checks = METHODS.get(method)
+        if checks is None:
+            raise ValueError(f"{method} can't be called through the coordinator")
+
+        f = getattr(self.dbq, method)
+        arguments = inspect.signature(f).bind(*args, **kwargs)
+        arguments.apply_defaults()
+        arguments = arguments.arguments
+        for name, value in arguments.items():
+            if not checks[name](value):
+                raise ValueError(f"{method}: invalid {name}: {value!r:.100}")
+
+        result = f(*args, **kwargs)
+        metrics.inc("lastfm_coordinator_calls_total", method=method)
+
+        if method in CLAIMS:
+            kind, units = CLAIMS[method](arguments, result)
+            if units:
+                self.dbq.add_leases(
+                    kind=kind,
+                    units=units,
+                    holder=holder,
+                    seconds=self.config["lease_seconds"],
+                )
+        if method in ACKS:
+            kind, units = ACKS[method](arguments)
+            if units:
+                self.dbq.release_leases(kind=kind, units=units)
+        return result
+
+    def merge(self, path):
+        start = monotonic()
+        try:
+            new_listens = self.dbq.merge_db(path)
+        finally:
+            # no heartbeat was answered during the merge, the leases must not expire because of that
+            self.dbq.extend_leases(seconds=math.ceil(monotonic() - start))
+        metrics.inc("lastfm_coordinator_calls_total", method="merge_db")
+        return new_listens
+
+    def heartbeat(self, holder):
+        return self.dbq.renew_leases(
+            holder=holder, seconds=self.config["lease_seconds"]
+        )
+
+    def maybe_reap(self):
+
+        """
+        Hands back the units whose lease expired, at most every reap_seconds.
+        """
+
+        if monotonic() - self.last_reap < self.config["reap_seconds"]:
+            return
+        self.last_reap = monotonic()
+        self.dbq.reset_cancelled_fetching()
+
+    def serve(self):
+
+        """
+        Serves the collectors until the process is stopped. One request at a time, the DB connection belongs to this thread.
+        """
+
+        coordinator = self
+        token = self.config["token"]
+        if not token and not is_loopback(self.config["host"]):
+            raise Exception(
+                f"The coordinator only accepts connections from other machines (host {self.config['host']}) with coordinator.token set."
+            )
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if token and self.headers.get("X-Coordinator-Token") != token:
+                    self.answer(403, {"error": "wrong token"})
+                    return
+                request = {}
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    if self.path == "/merge":
+                        self.merge(length)
+                        return
+                    request = json.loads(str(self.rfile.read(length), "utf-8"))
+                    if not isinstance(request, dict) or not text(request.get("holder")):
+                        raise ValueError("the request has no holder")
+                    if self.path == "/call" and not text(request.get("method")):
+                        raise ValueError("the request has no method")
+                    if self.path == "/call":
+                        result = coordinator.call(
+                            holder=request["holder"],
+                            method=request["method"],
+                            args=request.get("args", []),
+                            kwargs=request.get("kwargs", {}),
+                        )
+                        self.answer(200, {"result": result})
+                    elif self.path == "/heartbeat":
+                        leases = coordinator.heartbeat(holder=request["holder"])
+                        self.answer(200, {"leases": leases})
+                    else:
+                        self.answer(404, {"error": f"no such path: {self.path}"})
+                except json.JSONDecodeError as E:
+                    self.answer(400, {"error": f"the request isn't valid JSON: {E}"})
+                except (ValueError, TypeError) as E:
+                    self.answer(400, {"error": str(E)})
+                except Exception as E:
+                    coordinator.logger.error(
+                        f"Caught exception on {request.get('method')}: {E}"
+                    )
+                    self.answer(500, {"error": str(E)})
+
+            def merge(self, length):
+                # the DB is written to a file next to the collection DB, merged and deleted
+                handle, path = tempfile.mkstemp(suffix=".db", dir=db.file_path.parent)
+                try:
+                    with os.fdopen(handle, "wb") as f:
+                        while length > 0:
+                            chunk = self.rfile.read(min(length, 1 << 20))
+                            if not chunk:
+                                raise Exception("the upload was cut off")
+                            f.write(chunk)
+                            length -= len(chunk)
+                    self.answer(200, {"listens": coordinator.merge(path)})
+                except Exception as E:
+                    coordinator.logger.error(f"Caught exception on merge: {E}")
+                    self.answer(500, {"error": str(E)})
+                finally:
+                    remove_db(path)
+
+            def answer(self, status, body):
+                # sets (e.g. get_negative_results) become lists
+                body = json.dumps(body, default=list).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(HTTPServer):
+            def service_actions(self):
+                # runs between the requests, in the thread that owns the DB connection
+                coordinator.maybe_reap()
+
+        server = Server((self.config["host"], self.config["port"]), Handler)
+        self.logger.info(
+            f"Coordinator at http://{self.config['host']}:{self.config['port']}/"
+        )
+        server.serve_forever(poll_interval=1)
+
+
+def is_loopback(host):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+class RemoteQueries(object):
+
+    """
+    Stands in for dbq in the collector processes with coordinator.url. Every method call is sent to the coordinator, and a thread keeps the leases of this process alive.
+    """
+
+    def __init__(self, config, pid):
+        self.logger = logging.getLogger("data_py_logger")
+        self.config = config["coordinator"]
+        self.url = self.config["url"].rstrip("/")
+        # unique over all machines and runs
+        self.holder = f"{socket.gethostname()}-{os.getpid()}-{pid}"
+        self.heartbeat = None
+
+    def post(self, path, payload, upload=None):
+
+        """
+        Sends a request to the coordinator, with upload (a file) as its body instead of payload. While it can't be reached (e.g. it's restarting), we back off exponentially with jitter, like retry_if_locked.
+        """
+
+        body = json.dumps(payload).encode("utf-8")
+        headers = {"Content-Type": "application/json"}
+        if upload:
+            headers = {
+                "Content-Type": "application/octet-stream",
+                "Content-Length": str(upload.stat().st_size),
+            }
+        if self.config["token"]:
+            headers["X-Coordinator-Token"] = self.config["token"]
+        delay = 1
+        while True:
+            data = upload.open("rb") if upload else body
+            request = urllib.request.Request(
+                self.url + path, data=data, headers=headers, method="POST"
+            )
+            try:
+                # merging an upload takes a while, the coordinator answers once it's done
+                with urllib.request.urlopen(
+                    request, timeout=None if upload else self.config["timeout"]
+                ) as response:
+                    return json.loads(str(response.read(), "utf-8"))
+            except urllib.error.HTTPError as E:
+                # the coordinator got the call and refused it
+                try:
+                    message = json.loads(str(E.read(), "utf-8"))["error"]
+                except (ValueError, TypeError, KeyError):
+                    # e.g. a proxy in between
+                    message = f"HTTP {E.code} {E.reason}"
+                raise Exception(
+                    f"Coordinator: {payload.get('method', path)} failed: {message}"
+                )
+            except (urllib.error.URLError, OSError) as E:
+                wait = random.uniform(0, delay)
+                self.logger.error(
+                    f"           Coordinator not reachable ({E}), waiting {wait:.2f} seconds."
+                )
+                time.sleep(wait)
+                delay = min(delay * 2, 60)
+            finally:
+                if upload:
+                    data.close()
+
+    def merge(self, path):
+
+        """
+        Sends the DB at path (the merged shards of this machine) to the coordinator, which merges it into the shared DB. Returns the number of new listens.
+        """
+
+        # the file alone, without its WAL
+        database = db.DB(path=path)
+        database.checkpoint()
+        database.connection.close()
+        return self.post("/merge", {}, upload=Path(path))["listens"]
+
+    def keep_alive(self):
+        while True:
+            time.sleep(self.config["heartbeat_seconds"])
+            try:
+                self.post("/heartbeat", {"holder": self.holder})
+            except Exception as E:
+                self.logger.error(f"           Heartbeat failed: {E}")
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            if self.heartbeat is None:
+                self.heartbeat = threading.Thread(target=self.keep_alive, daemon=True)
+                self.heartbeat.start()
+            response = self.post(
+                "/call",
+                {"holder": self.holder, "method": name, "args": args, "kwargs": kwargs},
+            )
+            return response["result"]
+
+        return call
+
+
+if __name__ == "__main__":
+    logger = logging.getLogger("data_py_logger")
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+    # units of collectors that stopped while the coordinator was down, leases that are still valid are kept
+    default_dbq.reset_cancelled_fetching()
+    default_dbq.release_negative_results()
+    Coordinator(dbq=default_dbq, config=default_dbq.config["coordinator"]).serve()
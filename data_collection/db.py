@@ -1,17 +1,93 @@
 import sqlite3  # is included in core
 from pathlib import Path
-import os
 
 """
 Here we define and initialize the database tables for the data collector.
 
 Remember that song names are not unique. Hence also no unique indexing.
 
+The schema version is stored in the DB (PRAGMA user_version). DB_INIT always describes the latest schema and is only run if the version of the DB file is older. An existing DB is first brought up to date with the MIGRATIONS of every newer version, then DB_INIT adds the tables and indexes that are still missing.
+
+data_collection.watermark is the time of the newest listen we have of a user. The set_watermark trigger sets it once the listens of a user are complete, the refresh stage moves it forward.
+
+artists.tag_status is the work queue of the tag stage: 0 = tags not fetched, 1 = being fetched, 2 = fetched, 3 = artist not found by the API, 4 = failed for good (e.g. not recorded in replay mode). Artists without tags get a single "NONE" tag, the failed ones get none. Artists at 3 and 4 are queued again once their negative result expired.
+
+enrich_queue is the work queue of the enrich stage, which fills in the musicbrainz IDs of artists, albums and songs that came without one. priority is the number of listens of the entity when it was queued. status: 0 = pending, 1 = being looked up, 2 = done.
+
+negative_results remembers the API calls that failed for good (users and artists that can't be found, private listening histories), so they aren't paid for again. Every entry expires after the time negative_ttl_days in config.yaml gives its kind.
+
+leases are the work units (users, listen windows, artists, enrich_queue entries) that collectors claimed through the coordinator (see coordinator.py), unit is the id of the unit as text. A unit that is being fetched is only handed back once its lease expired, so several collectors can share one DB.
+
+The stats table holds the row counts of the COUNTED_TABLES, the number of artists with tags (tagged_artists) and the number of users per data status (status_<status>). Triggers keep it up to date on every insert and delete, so progress can be read without scanning the tables.
+
 """
 
 file_path = Path().absolute().joinpath("data").joinpath("lastfm_raw.db")
-if not file_path.exists():
-    os.mkdir(Path().absolute().joinpath("data"))
+file_path.parent.mkdir(exist_ok=True)
+
+SCHEMA_VERSION = 11
+
+# the values of the storage settings in config.yaml that SQLite knows
+JOURNAL_MODES = ["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"]
+SYNCHRONOUS_MODES = ["OFF", "NORMAL", "FULL", "EXTRA"]
+
+# tables whose row count is kept in the stats table
+COUNTED_TABLES = [
+    "users",
+    "artists",
+    "albums",
+    "songs",
+    "listens",
+    "tags",
+    "friendships",
+]
+
+# data status of the users, see api_pylast.DataCollector.get_users
+STATUSES = range(7)
+
+# version -> statements that bring an existing DB of the previous version to this version
+# a migration of a table that doesn't exist yet is skipped, DB_INIT creates that table in its latest form
+MIGRATIONS = {
+    4: """
+    ALTER TABLE data_collection ADD COLUMN fetch_cursor INTEGER NULL;
+    ALTER TABLE listen_windows ADD COLUMN fetch_cursor INTEGER NULL
+    """,
+    5: """
+    ALTER TABLE data_collection ADD COLUMN watermark INTEGER NULL;
+    ALTER TABLE data_collection ADD COLUMN refreshed_at INTEGER NULL;
+    UPDATE data_collection
+    SET watermark = (SELECT MAX(time) FROM listens WHERE listens.user = data_collection.user)
+    WHERE status = 4
+    """,
+    # counting the existing rows is a full scan of every table, but only once
+    6: """
+    CREATE TABLE IF NOT EXISTS stats(
+        name TEXT NOT NULL PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    );
+    """
+    + "".join(
+        f"INSERT OR REPLACE INTO stats (name, value) SELECT '{t}', COUNT(*) FROM {t};"
+        for t in COUNTED_TABLES
+    )
+    + """
+    INSERT OR REPLACE INTO stats (name, value)
+    SELECT 'tagged_artists', COUNT(DISTINCT artist) FROM tags;
+    INSERT OR REPLACE INTO stats (name, value)
+    SELECT 'status_' || status, COUNT(*) FROM data_collection GROUP BY status
+    """,
+    7: """
+    ALTER TABLE artists ADD COLUMN tag_status INTEGER NOT NULL DEFAULT 0;
+    UPDATE artists
+    SET tag_status = 2
+    WHERE id_nb IN (SELECT artist FROM tags)
+    """,
+    # the cursors of finished users and windows used to be kept, a reset user would have resumed at its oldest listen
+    11: """
+    UPDATE data_collection SET fetch_cursor = NULL WHERE status = 4;
+    UPDATE listen_windows SET fetch_cursor = NULL WHERE status = 2
+    """,
+}
 
 
 DB_INIT = """
@@ -54,12 +130,16 @@ CREATE TABLE IF NOT EXISTS listens(
 CREATE TABLE IF NOT EXISTS artists(
     id_nb INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
     name TEXT NOT NULL UNIQUE,
-    mb_id TEXT NULL
+    mb_id TEXT NULL,
+    tag_status INTEGER NOT NULL DEFAULT 0
 );
 
 CREATE UNIQUE INDEX IF NOT EXISTS index_artist_name
 ON artists(name);
 
+CREATE INDEX IF NOT EXISTS index_artist_tag_status
+ON artists(tag_status);
+
 CREATE TABLE IF NOT EXISTS albums(
     id_nb INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT,
     name TEXT NOT NULL UNIQUE,
@@ -82,6 +162,9 @@ CREATE TABLE IF NOT EXISTS tags(
     CONSTRAINT UC_tag UNIQUE (tag, artist)
 );
 
+CREATE INDEX IF NOT EXISTS index_tag_artist
+ON tags(artist);
+
 CREATE TABLE IF NOT EXISTS friendships(
     user1 INTEGER NOT NULL,
     user2 INTEGER NOT NULL,
@@ -101,15 +184,179 @@ CREATE TABLE IF NOT EXISTS song_merges(
 CREATE TABLE IF NOT EXISTS data_collection(
     user INTEGER UNIQUE NOT NULL PRIMARY KEY,
     status INTEGER DEFAULT 0,
+    fetch_cursor INTEGER NULL,
+    watermark INTEGER NULL,
+    refreshed_at INTEGER NULL,
     FOREIGN KEY(user) REFERENCES users(id_nb)
 );
 
+CREATE INDEX IF NOT EXISTS index_data_status
+ON data_collection(status);
+
+CREATE INDEX IF NOT EXISTS index_data_watermark
+ON data_collection(watermark);
+
+CREATE TRIGGER IF NOT EXISTS set_watermark
+AFTER UPDATE OF status ON data_collection
+WHEN NEW.status = 4 AND OLD.status = 3
+BEGIN
+    UPDATE data_collection
+    SET watermark = (SELECT MAX(time) FROM listens WHERE listens.user = NEW.user)
+    WHERE user = NEW.user;
+END;
+
+CREATE TABLE IF NOT EXISTS listen_windows(
+    user INTEGER NOT NULL,
+    time_from INTEGER NOT NULL,
+    time_to INTEGER NOT NULL,
+    status INTEGER DEFAULT 0,
+    fetch_cursor INTEGER NULL,
+    FOREIGN KEY(user) REFERENCES users(id_nb),
+    CONSTRAINT UC_window UNIQUE (user, time_from)
+);
+
+CREATE INDEX IF NOT EXISTS index_window_status
+ON listen_windows(status);
+
+CREATE TABLE IF NOT EXISTS enrich_queue(
+    kind TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    priority INTEGER NOT NULL,
+    status INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (kind, id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS index_enrich_status
+ON enrich_queue(status, priority);
+
+CREATE TABLE IF NOT EXISTS negative_results(
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    error TEXT NOT NULL,
+    expires INTEGER NOT NULL,
+    PRIMARY KEY (kind, name)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS leases(
+    kind TEXT NOT NULL,
+    unit TEXT NOT NULL,
+    holder TEXT NOT NULL,
+    expires INTEGER NOT NULL,
+    PRIMARY KEY (kind, unit)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS index_lease_holder
+ON leases(holder);
+
+CREATE TABLE IF NOT EXISTS stats(
+    name TEXT NOT NULL PRIMARY KEY,
+    value INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TRIGGER IF NOT EXISTS count_tagged_artists_insert
+AFTER INSERT ON tags
+WHEN NOT EXISTS (SELECT 1 FROM tags WHERE artist = NEW.artist AND id_nb != NEW.id_nb)
+BEGIN
+    UPDATE stats SET value = value + 1 WHERE name = 'tagged_artists';
+END;
+
+CREATE TRIGGER IF NOT EXISTS count_tagged_artists_delete
+AFTER DELETE ON tags
+WHEN NOT EXISTS (SELECT 1 FROM tags WHERE artist = OLD.artist)
+BEGIN
+    UPDATE stats SET value = value - 1 WHERE name = 'tagged_artists';
+END;
+
+CREATE TRIGGER IF NOT EXISTS count_status_insert
+AFTER INSERT ON data_collection
+BEGIN
+    UPDATE stats SET value = value + 1 WHERE name = 'status_' || NEW.status;
+END;
+
+CREATE TRIGGER IF NOT EXISTS count_status_update
+AFTER UPDATE OF status ON data_collection
+WHEN NEW.status IS NOT OLD.status
+BEGIN
+    UPDATE stats SET value = value - 1 WHERE name = 'status_' || OLD.status;
+    UPDATE stats SET value = value + 1 WHERE name = 'status_' || NEW.status;
+END;
+
+CREATE TRIGGER IF NOT EXISTS count_status_delete
+AFTER DELETE ON data_collection
+BEGIN
+    UPDATE stats SET value = value - 1 WHERE name = 'status_' || OLD.status;
+END;
+
+"""
+
+# the triggers only update existing counters (an upsert in every trigger would make inserts twice as slow), so all of them are created here
+for name in COUNTED_TABLES + ["tagged_artists"] + [f"status_{x}" for x in STATUSES]:
+    DB_INIT += f"""
+INSERT OR IGNORE INTO stats (name, value) VALUES ('{name}', 0);
 """
 
+# row counts of the COUNTED_TABLES
+for t in COUNTED_TABLES:
+    DB_INIT += f"""
+CREATE TRIGGER IF NOT EXISTS count_{t}_insert
+AFTER INSERT ON {t}
+BEGIN
+    UPDATE stats SET value = value + 1 WHERE name = '{t}';
+END;
+
+CREATE TRIGGER IF NOT EXISTS count_{t}_delete
+AFTER DELETE ON {t}
+BEGIN
+    UPDATE stats SET value = value - 1 WHERE name = '{t}';
+END;
+"""
+
+
+def split_statements(script):
+
+    """
+    Splits a script into single statements. Trigger bodies contain semicolons, so we can't just split at every one of them.
+    """
+
+    statements = []
+    statement = ""
+    for part in script.split(";"):
+        statement += part + ";"
+        if sqlite3.complete_statement(statement):
+            statements.append(statement)
+            statement = ""
+    return statements
+
+
+def storage_mode(storage, name, modes):
+
+    """
+    The value of a storage setting that is one of modes. SQLite ignores unknown values without an error, so we check them here.
+    """
+
+    # YAML reads an unquoted OFF as False
+    value = "OFF" if storage[name] is False else str(storage[name]).upper()
+    if value not in modes:
+        raise Exception(
+            f"Unknown storage.{name} {storage[name]} in config.yaml, use one of {modes}"
+        )
+    return value
+
+
+def storage_number(storage, name, factor=1):
+    try:
+        return int(float(storage[name]) * factor)
+    except (TypeError, ValueError):
+        raise Exception(
+            f"storage.{name} in config.yaml must be a number, not {storage[name]}"
+        )
+
 
 class DB(object):
-    def __init__(self):
-        self.file_path = file_path
+    def __init__(self, storage=None, path=None):
+        # another file than data/lastfm_raw.db with the same schema, e.g. a shard (see shards.py)
+        self.file_path = path if path else file_path
+        self.storage = storage if storage else {}
         self.connect()
 
     def connect(self):
@@ -118,6 +365,74 @@ class DB(object):
             sqlite3.Row
         )  # DICT query results (Hey what's a good name for this method that returns dictionaries instead of rows? IDK, let's call it row_factory!)
         self.cursor = self.connection.cursor()
-        for cmd in DB_INIT.split(";"):
-            self.cursor.execute(cmd)
+        self.apply_storage_profile()
+        self.init_schema()
+
+    def apply_storage_profile(self):
+
+        """
+        Applies the storage settings of config.yaml. The busy timeout comes first so that switching the journal mode waits for other connections as well.
+        """
+
+        if "busy_timeout" in self.storage:
+            self.cursor.execute(
+                f"PRAGMA busy_timeout = {storage_number(self.storage, 'busy_timeout')}"
+            )
+        if "journal_mode" in self.storage:
+            self.cursor.execute(
+                f"PRAGMA journal_mode = {storage_mode(self.storage, 'journal_mode', JOURNAL_MODES)}"
+            )
+        if "synchronous" in self.storage:
+            self.cursor.execute(
+                f"PRAGMA synchronous = {storage_mode(self.storage, 'synchronous', SYNCHRONOUS_MODES)}"
+            )
+        if "cache_size_mb" in self.storage:
+            # negative values are KiB instead of pages
+            self.cursor.execute(
+                f"PRAGMA cache_size = {-storage_number(self.storage, 'cache_size_mb', 1024)}"
+            )
+        if "mmap_size_mb" in self.storage:
+            self.cursor.execute(
+                f"PRAGMA mmap_size = {storage_number(self.storage, 'mmap_size_mb', 1024 * 1024)}"
+            )
+
+    def checkpoint(self):
+
+        """
+        Moves everything in the WAL into the DB file, e.g. before the file is copied.
+        """
+
+        self.cursor.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def get_schema_version(self):
+        self.cursor.execute("PRAGMA user_version")
+        return self.cursor.fetchone()[0]
+
+    def init_schema(self):
+
+        if self.get_schema_version() >= SCHEMA_VERSION:
+            return
+
+        # several processes may connect at the same time, only one of them migrates
+        self.cursor.execute("BEGIN IMMEDIATE")
+        try:
+            version = self.get_schema_version()
+            if version < SCHEMA_VERSION:
+                self.cursor.execute(
+                    "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'users'"
+                )
+                if self.cursor.fetchone():
+                    for v in range(version + 1, SCHEMA_VERSION + 1):
+                        for cmd in split_statements(MIGRATIONS.get(v, "")):
+                            try:
+                                self.cursor.execute(cmd)
+                            except sqlite3.OperationalError as E:
+                                if "no such table" not in str(E):
+                                    raise
+                for cmd in split_statements(DB_INIT):
+                    self.cursor.execute(cmd)
+                self.cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
             self.connection.commit()
+        except Exception:
+            self.connection.rollback()
+            raise
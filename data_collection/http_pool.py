@@ -0,0 +1,117 @@
+import http.client
+import os
+import ssl
+import threading
+import urllib.parse
+from time import monotonic
+from metrics import metrics
+
+"""
+Keep-alive HTTP(S) connections to the API (http in config.yaml), for the collector processes and the asyncio engine.
+
+pylast opens a new HTTPS connection for every call, so every request pays for a TCP and TLS handshake, and handshake timeouts are the most common network error of a long crawl. A ConnectionPool keeps the connections of one API key open and sends all of its requests over them.
+
+Connections that have been idle for longer than keepalive_expiry are closed instead of reused, the server has most likely dropped them by then. If a reused connection fails anyway, the request is sent once more over a new connection. That's safe because all calls of the collector are reads.
+
+A pool can be used from several threads at once, the asyncio engine sends up to size requests of a key at the same time.
+
+"""
+
+# the headers of pylast, but asking to keep the connection open
+HEADERS = {
+    "Content-Type": "application/x-www-form-urlencoded",
+    "Accept-Charset": "utf-8",
+    "User-Agent": "lastfm-data-downloader",
+    "Connection": "keep-alive",
+}
+
+
+class ConnectionPool(object):
+    def __init__(self, url, size, connect_timeout, read_timeout, keepalive_expiry, key):
+        url = urllib.parse.urlsplit(url)
+        self.use_ssl = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port if url.port else (443 if self.use_ssl else 80)
+        self.path = url.path
+        self.size = size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.keepalive_expiry = keepalive_expiry
+        self.key = key  # the API key (pid) for the metrics
+        self.ssl = ssl.create_default_context() if self.use_ssl else None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+
+        # a child process must not share the sockets of its parent
+        self.pid = os.getpid()
+        self.idle = []  # (connection, time it was returned)
+        self.semaphore = threading.BoundedSemaphore(self.size)
+
+    def open(self):
+        if self.use_ssl:
+            connection = http.client.HTTPSConnection(
+                self.host, self.port, timeout=self.connect_timeout, context=self.ssl
+            )
+        else:
+            connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.connect_timeout
+            )
+        connection.connect()
+        # the handshake is done, from now on we wait for responses
+        connection.sock.settimeout(self.read_timeout)
+        metrics.inc("lastfm_http_connections_total", key=self.key)
+        return connection
+
+    def get(self):
+
+        """
+        Returns an idle connection and True, or a new one and False.
+        """
+
+        with self.lock:
+            while self.idle:
+                connection, returned = self.idle.pop()
+                if monotonic() - returned < self.keepalive_expiry:
+                    return connection, True
+                connection.close()
+        return self.open(), False
+
+    def put(self, connection):
+        with self.lock:
+            self.idle.append((connection, monotonic()))
+
+    def post(self, body):
+
+        """
+        Sends a form-encoded POST and returns the status code and the response body. Raises the exceptions of http.client and socket.
+        """
+
+        if os.getpid() != self.pid:
+            self.reset()
+
+        with self.semaphore:
+            for attempt in range(2):
+                connection, reused = self.get()
+                try:
+                    connection.request("POST", self.path, body=body, headers=HEADERS)
+                    response = connection.getresponse()
+                    payload = response.read()
+                except (http.client.HTTPException, OSError) as e:
+                    connection.close()
+                    # the server may have closed the connection while it was idle. A timeout is no such case, we don't wait twice.
+                    if reused and attempt == 0 and not isinstance(e, TimeoutError):
+                        continue
+                    raise
+                if response.will_close:
+                    connection.close()
+                else:
+                    self.put(connection)
+                return response.status, payload
+
+    def close(self):
+        with self.lock:
+            for connection, _ in self.idle:
+                connection.close()
+            self.idle = []
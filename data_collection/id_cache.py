@@ -0,0 +1,72 @@
+from collections import OrderedDict
+import sys
+
+"""
+In-memory LRU cache for name -> id lookups (artists, songs, albums).
+
+The same popular artists and songs show up in almost every listening history, so most lookups in the hot loop of get_listens can be answered without a query. Ids never change once a row is inserted, so a cached id is always correct, even if other processes write to the DB at the same time. A miss simply falls back to the DB.
+
+The cache is bounded by an approximate memory budget rather than by the number of entries, because song names vary a lot in length.
+
+"""
+
+ENTRY_OVERHEAD = 100  # rough size of the linked list node and hash table slot of an OrderedDict entry
+
+
+def entry_size(key, value):
+    size = ENTRY_OVERHEAD + sys.getsizeof(key) + sys.getsizeof(value)
+    if isinstance(key, tuple):
+        size += sum(sys.getsizeof(x) for x in key)
+    return size
+
+
+class IdCache(object):
+    def __init__(self, name, max_mb):
+        self.name = name
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.max_bytes <= 0 or value is None:
+            return
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+        self.entries[key] = value
+        self.size += entry_size(key, value)
+        while self.size > self.max_bytes and self.entries:
+            old_key, old_value = self.entries.popitem(last=False)
+            self.size -= entry_size(old_key, old_value)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "name": self.name,
+            "entries": len(self.entries),
+            "mb": round(self.size / 1024 / 1024, 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,369 @@
+import bisect
+import json
+import os
+import sqlite3
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from time import perf_counter
+from time import time as timer
+import pylast
+import yaml
+
+"""
+Counters and latency histograms of the data collection (metrics in config.yaml).
+
+Every process keeps its own metrics in memory and writes a snapshot of them to data/metrics.db every metrics.snapshot_seconds (and when a stage ends). The rows of a run are the sum over its processes, so the metrics of all API keys can be read from there, e.g. by quick_check.py. With metrics.port, the main process additionally serves them in the Prometheus text format at http://127.0.0.1:<port>/metrics.
+
+What is measured:
+  lastfm_api_requests_total{method, key, result}   API calls by result: ok, cached or the error class (see error_class)
+  lastfm_api_request_seconds{method, key}          latency of the API calls that went over the network
+  lastfm_http_connections_total{key}               connections opened to the API (see http_pool.py)
+  lastfm_api_retries_total{key, reason}            requests that were retried after a transient error (see rate_control.py)
+  lastfm_rate_limited_total{key}                   rate limit errors, each one lowers the request rate of the key
+  lastfm_rate_wait_seconds_total{key}              time the requests waited for the rate controller
+  lastfm_circuit_opens_total{key}                  how often a key was paused because its requests kept failing
+  lastfm_negative_hits_total{kind, key}            API calls skipped because they are known to fail (negative_results, see db.py)
+  lastfm_db_query_seconds{query}                   every query of queries.py
+  lastfm_db_commit_seconds                         commits
+  lastfm_db_lock_waits_total{query}                queries that failed because the DB was locked and were retried...
+  lastfm_db_lock_wait_seconds{query}               ...and how long they waited
+  lastfm_items_total{stage, item, key}             users, friends, listens, windows, artists and tags processed per stage
+  lastfm_stage_seconds_total{stage}                time spent in the work loops of a stage
+
+The time of a stage that is neither spent in the API nor in the DB is Python overhead.
+
+The metrics have their own SQLite file, so that writing them never waits for the lock of the collection DB they measure.
+
+"""
+
+file_path = Path().absolute().joinpath("data").joinpath("metrics.db")
+
+# upper bounds of the histogram buckets in seconds
+BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# last.fm error codes, see https://www.last.fm/api/errorcodes
+ERROR_CLASSES = {
+    "6": "not_found",
+    "8": "server",
+    "10": "invalid_key",
+    "11": "server",
+    "16": "server",
+    "17": "private",
+    "26": "invalid_key",
+    "29": "rate_limit",
+    "replay": "not_recorded",
+}
+
+METRICS_INIT = """
+CREATE TABLE IF NOT EXISTS metrics(
+    run INTEGER NOT NULL,
+    pid INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    labels TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    value REAL NOT NULL,
+    count INTEGER NOT NULL,
+    buckets TEXT NULL,
+    updated INTEGER NOT NULL,
+    PRIMARY KEY (run, pid, name, labels)
+);
+"""
+
+
+def error_class(E):
+
+    """
+    Groups the exceptions of an API call for lastfm_api_requests_total.
+    """
+
+    if isinstance(E, pylast.WSError):
+        status = str(E.status)
+        if status in ERROR_CLASSES:
+            return ERROR_CLASSES[status]
+        if status.startswith("5"):  # HTTP errors
+            return "server"
+        return f"error_{status}"
+    if isinstance(E, pylast.MalformedResponseError):
+        return "malformed"
+    if isinstance(E, pylast.NetworkError):
+        return "network"
+    return "exception"
+
+
+class Metrics(object):
+    def __init__(self):
+        config_path = Path().absolute().joinpath("config").joinpath("config.yaml")
+        with open(config_path, "r") as stream:
+            self.config = yaml.safe_load(stream)["metrics"]
+
+        self.enabled = self.config["enabled"]
+        # the start of the main process. Processes started from it share the run.
+        self.run = int(timer())
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+
+        # a child process starts with an empty copy of the metrics of its parent
+        self.pid = os.getpid()
+        self.counters = {}  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [count per bucket, ..., count, sum]
+        self.connection = None
+        # snapshots can be taken from several threads (e.g. the DB thread of the asyncio engine), one at a time
+        self.snapshot_lock = threading.Lock()
+        self.last_snapshot = timer()
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        if os.getpid() != self.pid:
+            self.reset()
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self.maybe_snapshot()
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        if os.getpid() != self.pid:
+            self.reset()
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = [0] * (len(BUCKETS) + 3)
+                self.histograms[key] = h
+            h[bisect.bisect_left(BUCKETS, seconds)] += 1
+            h[-2] += 1
+            h[-1] += seconds
+        self.maybe_snapshot()
+
+    def timer(self, name, **labels):
+        return Timer(self, name, labels)
+
+    def count_request(self, method, key, result, seconds=None):
+
+        """
+        Counts an API call. seconds is the latency of calls that went over the network.
+        """
+
+        if seconds is not None:
+            self.observe("lastfm_api_request_seconds", seconds, method=method, key=key)
+        self.inc("lastfm_api_requests_total", method=method, key=key, result=result)
+
+    def stage_timer(self, stage):
+        return Timer(self, "lastfm_stage_seconds_total", {"stage": stage}, counter=True)
+
+    def maybe_snapshot(self):
+        if timer() - self.last_snapshot > self.config["snapshot_seconds"]:
+            self.snapshot()
+
+    def connect(self):
+        file_path.parent.mkdir(exist_ok=True)
+        self.connection = sqlite3.connect(file_path, check_same_thread=False)
+        self.connection.execute("PRAGMA busy_timeout = 30000")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.executescript(METRICS_INIT)
+
+    def snapshot(self):
+
+        """
+        Writes the current values of this process to data/metrics.db.
+        """
+
+        if not self.enabled:
+            return
+        if os.getpid() != self.pid:
+            self.reset()
+        self.last_snapshot = timer()
+        with self.snapshot_lock:
+            if self.connection is None:
+                self.connect()
+            self.write_snapshot()
+
+    def write_snapshot(self):
+
+        rows = []
+        with self.lock:
+            for (name, labels), value in self.counters.items():
+                rows.append((name, labels, "counter", value, 0, None))
+            for (name, labels), h in self.histograms.items():
+                rows.append(
+                    (name, labels, "histogram", h[-1], h[-2], json.dumps(h[:-2]))
+                )
+
+        query = """
+        INSERT OR REPLACE INTO metrics
+            (run, pid, name, labels, kind, value, count, buckets, updated)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ;
+        """
+        params = [
+            (
+                self.run,
+                self.pid,
+                x[0],
+                json.dumps(x[1]),
+                x[2],
+                x[3],
+                x[4],
+                x[5],
+                int(timer()),
+            )
+            for x in rows
+        ]
+        try:
+            self.connection.executemany(query, params)
+            self.connection.commit()
+        except sqlite3.OperationalError:
+            # the metrics must never stop the collection, the next snapshot will have the values
+            self.connection.rollback()
+
+    def latest_run(self):
+
+        """
+        The start time of the latest run that wrote metrics, None if there is none.
+        """
+
+        file_path.parent.mkdir(exist_ok=True)
+        connection = sqlite3.connect(file_path)
+        connection.executescript(METRICS_INIT)
+        run = connection.execute("SELECT MAX(run) FROM metrics").fetchone()[0]
+        connection.close()
+        return run
+
+    def read(self, run=None):
+
+        """
+        Returns the metrics of a run (default: the latest one), summed over its processes: {(name, labels): value} for counters and {(name, labels): [count per bucket, ..., count, sum]} for histograms.
+        """
+
+        if run is None:
+            run = self.latest_run()
+        file_path.parent.mkdir(exist_ok=True)
+        connection = sqlite3.connect(file_path)
+        connection.executescript(METRICS_INIT)
+
+        query = """
+        SELECT
+            name,
+            labels,
+            kind,
+            value,
+            count,
+            buckets
+        FROM metrics
+        WHERE run = ?
+        ;
+        """
+        counters = {}
+        histograms = {}
+        for name, labels, kind, value, count, buckets in connection.execute(
+            query, (run,)
+        ):
+            key = (name, tuple(tuple(x) for x in json.loads(labels)))
+            if kind == "counter":
+                counters[key] = counters.get(key, 0) + value
+            else:
+                h = histograms.setdefault(key, [0] * (len(BUCKETS) + 3))
+                for i, n in enumerate(json.loads(buckets)):
+                    h[i] += n
+                h[-2] += count
+                h[-1] += value
+        connection.close()
+        return counters, histograms
+
+    def render(self):
+
+        """
+        The metrics of the current run in the Prometheus text format.
+        """
+
+        counters, histograms = self.read(run=self.run)
+        lines = []
+        for name in sorted({x[0] for x in counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    lines.append(f"{name}{format_labels(labels)} {value:g}")
+        for name in sorted({x[0] for x in histograms}):
+            lines.append(f"# TYPE {name} histogram")
+            for (n, labels), h in sorted(histograms.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for le, count in zip(list(BUCKETS) + ["+Inf"], h[:-2]):
+                    cumulative += count
+                    bucket_labels = labels + (("le", str(le)),)
+                    lines.append(
+                        f"{name}_bucket{format_labels(bucket_labels)} {cumulative}"
+                    )
+                lines.append(f"{name}_sum{format_labels(labels)} {h[-1]:g}")
+                lines.append(f"{name}_count{format_labels(labels)} {h[-2]}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port):
+
+        """
+        Serves /metrics on 127.0.0.1:port in a background thread.
+        """
+
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class Timer(object):
+
+    """
+    with metrics.timer(name, **labels): observes the time the block took. A counter timer adds it to a counter instead.
+    """
+
+    def __init__(self, metrics, name, labels, counter=False):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.counter = counter
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        if self.counter:
+            self.metrics.inc(self.name, perf_counter() - self.start, **self.labels)
+        else:
+            self.metrics.observe(self.name, perf_counter() - self.start, **self.labels)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    values = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        values.append(f'{k}="{v}"')
+    return "{" + ",".join(values) + "}"
+
+
+metrics = Metrics()
@@ -0,0 +1,79 @@
+"""
+Pipelined execution of the fetch stages (pipeline.enabled in config.yaml).
+
+Without the pipeline, every stage of config["fetch"] runs to completion in all processes before the next one starts. With it, every process works on all stages at the same time: the listens of a user are fetched as soon as their friends are in (status 2) and the tags of an artist as soon as it is inserted.
+
+Each process shares its API requests between the stages that have work according to pipeline.weights. The scheduler counts the API calls every batch of a stage took and always runs the stage that got the least calls relative to its weight (start-time fair queueing). A stage without work is skipped until another stage made progress.
+
+A stage is finished once it has no work left and all stages before it in config["fetch"] are finished in every process. Until then, the stages before it may still create work for it. That's the same guarantee as the barrier between the stages without the pipeline.
+
+"""
+
+
+class StageScheduler(object):
+    def __init__(self, stages, weights, active):
+        self.stages = stages
+        self.weights = {s: weights.get(s, 1) for s in stages}
+        # active[i] is the number of processes that haven't finished stage i yet (a multiprocessing.Array shared by all processes)
+        self.active = active
+        self.vtime = {s: 0.0 for s in stages}
+        self.clock = 0.0
+        self.finished = set()
+        self.idle = set()
+
+    def is_finished(self):
+        return len(self.finished) == len(self.stages)
+
+    def upstream_finished(self, stage):
+
+        """
+        True if all stages before stage are finished in all processes.
+        """
+
+        i = self.stages.index(stage)
+        with self.active.get_lock():
+            return all(self.active[j] == 0 for j in range(i))
+
+    def next_stage(self):
+
+        """
+        Returns the stage to run next, None if no stage has work right now.
+        """
+
+        candidates = [
+            s for s in self.stages if s not in self.finished and s not in self.idle
+        ]
+        if not candidates:
+            return None
+        stage = min(candidates, key=lambda s: self.vtime[s])
+        self.clock = self.vtime[stage]
+        return stage
+
+    def wake(self):
+
+        """
+        Makes the idle stages candidates again. They don't get credit for the time they had no work.
+        """
+
+        for s in self.idle:
+            self.vtime[s] = max(self.vtime[s], self.clock)
+        self.idle.clear()
+
+    def update(self, stage, action, calls, upstream_finished):
+
+        """
+        Records the result of a batch of stage. upstream_finished must be taken before the batch ran, a stage that had no work is only finished if nothing could have added work for it in the meantime.
+        """
+
+        self.vtime[stage] += max(calls, 1) / self.weights[stage]
+
+        if action == "repeat":
+            # the batch may have created work for the other stages
+            self.wake()
+        elif action == "stop" and upstream_finished:
+            self.finished.add(stage)
+            with self.active.get_lock():
+                self.active[self.stages.index(stage)] -= 1
+            self.wake()
+        else:
+            self.idle.add(stage)
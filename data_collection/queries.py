@@ -1,6 +1,10 @@
-import pylast
 from db import DB
+from id_cache import IdCache
+from metrics import metrics
+import functools
 import sqlite3
+import random
+from time import perf_counter
 from time import sleep
 from time import time as timer
 import logging
@@ -17,18 +21,25 @@ Be aware, that despite this being a data science project without users, we need
 
 """
 
+# the tables of the entities the enrich stage looks up
+ENRICH_TABLES = {"artist": "artists", "album": "albums", "song": "songs"}
 
-def debug_timer(func):
-    def inner1(*args, **kwargs):
 
-        if not args[0].config["debug"]:
-            return func(*args, **kwargs)
+def query_timer(func):
+
+    """
+    Records the runtime of every call as lastfm_db_query_seconds (see metrics.py).
+    """
 
-        start = timer()
-        res = func(*args, **kwargs)
-        end = timer()
-        logger.info(f"           ----t: {func.__name__} {end - start}")
-        return res
+    @functools.wraps(func)
+    def inner1(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics.observe(
+                "lastfm_db_query_seconds", perf_counter() - start, query=func.__name__
+            )
 
     return inner1
 
@@ -37,154 +48,411 @@ def retry_if_locked(func):
 
     """
     With multiple API keys fetching and inserting data simultaneously, ometimes an SQL insertion fails. This decorator makes sure that any operation that fails is repeated after a brief delay until it succeeds.
+
+    SQLite itself already waits up to storage.busy_timeout for a lock. If that wasn't enough, we back off exponentially with jitter, so that the waiting processes don't all retry at the same moment.
     """
 
+    @functools.wraps(func)
     def inner2(*args, **kwargs):
 
+        storage = args[0].config["storage"]
+        delay = storage["retry_initial"]
         while True:
             try:
                 return func(*args, **kwargs)
-            except sqlite3.OperationalError:
-                logger.info("           DB locked, waiting 3 seconds.")
-                sleep(3)
+            except sqlite3.OperationalError as E:
+                if "locked" not in str(E) and "busy" not in str(E):
+                    raise
+                if args[0].autocommit:
+                    # release whatever the failed call already holds
+                    args[0].db.connection.rollback()
+                wait = random.uniform(0, delay)
+                logger.info(f"           DB locked, waiting {wait:.2f} seconds.")
+                metrics.inc("lastfm_db_lock_waits_total", query=func.__name__)
+                metrics.observe(
+                    "lastfm_db_lock_wait_seconds", wait, query=func.__name__
+                )
+                sleep(wait)
+                delay = min(delay * 2, storage["retry_max"])
 
     return inner2
 
 
 class DataBaseQueries(object):
-    def __init__(self):
-        self.db = DB()
+    def __init__(self, path=None):
         self.logger = logging.getLogger("data_py_logger")
 
         config_path = Path().absolute().joinpath("config").joinpath("config.yaml")
         with open(config_path, "r") as stream:
             self.config = yaml.safe_load(stream)
 
+        # the DB is opened on first use, so a collector that works through the coordinator (see coordinator.py) doesn't create data/lastfm_raw.db
+        self.path = path
+        self._db = None
+
+        # name -> id caches, see id_cache.py
+        self.artist_ids = IdCache("artists", self.config["id_cache"]["artists_mb"])
+        self.song_ids = IdCache("songs", self.config["id_cache"]["songs_mb"])
+        self.album_ids = IdCache("albums", self.config["id_cache"]["albums_mb"])
+
+        # the single writer (writer.py) switches this off to commit many calls at once
+        self.autocommit = True
+
+    @property
+    def db(self):
+        if self._db is None:
+            self._db = DB(storage=self.config["storage"], path=self.path)
+        return self._db
+
+    def commit(self):
+        if self.autocommit:
+            with metrics.timer("lastfm_db_commit_seconds"):
+                self.db.connection.commit()
+
+    def get_cache_stats(self):
+        return [x.stats() for x in [self.artist_ids, self.song_ids, self.album_ids]]
+
+    def clear_id_caches(self):
+        for cache in [self.artist_ids, self.song_ids, self.album_ids]:
+            cache.clear()
+
     @retry_if_locked
-    @debug_timer
+    @query_timer
     def get_users_with_no_data(self, n, status):
 
-        query = f"""
+        query = """
         SELECT
             us.id_nb,
             us.name,
-            us.total_listens
+            us.total_listens,
+            us.registered
         FROM users us
         INNER JOIN data_collection fd
         ON fd.user = us.id_nb
-        WHERE fd.status = {status}
-        LIMIT {n}
+        WHERE fd.status = ?
+        LIMIT ?
         ;
         """
 
-        self.db.cursor.execute(query)
+        self.db.cursor.execute(query, (status, n))
         users = list(self.db.cursor.fetchall())
         users = [
-            {"id": x["id_nb"], "name": x["name"], "listens": x["total_listens"]}
+            {
+                "id": x["id_nb"],
+                "name": x["name"],
+                "listens": x["total_listens"],
+                "registered": x["registered"],
+            }
             for x in users
         ]
         return users
 
     @retry_if_locked
-    @debug_timer
-    def count_users_with_status(self, status):
+    @query_timer
+    def claim_users(self, n, status, new_status):
+
+        """
+        Moves up to n users from status to new_status and returns them. This is a single UPDATE, so two processes never claim the same user.
+        """
+
+        query = """
+        UPDATE data_collection
+        SET status = ?
+        WHERE user IN (
+            SELECT user
+            FROM data_collection
+            WHERE status = ?
+            LIMIT ?
+        )
+        RETURNING user
+        ;
+        """
+        params = (new_status, status, n)
+        self.db.cursor.execute(query, params)
+        user_ids = [x["user"] for x in self.db.cursor.fetchall()]
+        if not user_ids:
+            self.commit()
+            return []
 
         query = f"""
         SELECT
-            COUNT(us.name)
+            us.id_nb,
+            us.name,
+            us.total_listens,
+            us.registered,
+            fd.fetch_cursor
         FROM users us
         INNER JOIN data_collection fd
         ON fd.user = us.id_nb
-        WHERE fd.status = {status}
+        WHERE us.id_nb IN ({", ".join(["?"] * len(user_ids))})
         ;
         """
-
-        self.db.cursor.execute(query)
-        return self.db.cursor.fetchone()[0]
+        self.db.cursor.execute(query, user_ids)
+        users = [
+            {
+                "id": x["id_nb"],
+                "name": x["name"],
+                "listens": x["total_listens"],
+                "registered": x["registered"],
+                "cursor": x["fetch_cursor"],
+            }
+            for x in self.db.cursor.fetchall()
+        ]
+        self.commit()
+        return users
 
     @retry_if_locked
-    @debug_timer
-    def count_users_with_status_bigger(self, status):
+    @query_timer
+    def claim_refresh(self, n, refreshed_before):
+
+        """
+        Claims up to n users for a refresh (status 4 -> 6), the stalest first. Users that were refreshed after refreshed_before (unix timestamp) are up to date.
+
+        Returns [{"id", "name", "watermark", "cursor"}], watermark is the time of the newest listen we have of the user.
+        """
+
+        query = """
+        UPDATE data_collection
+        SET status = 6, fetch_cursor = NULL
+        WHERE user IN (
+            SELECT fd.user
+            FROM data_collection fd
+            INNER JOIN users us
+            ON us.id_nb = fd.user
+            WHERE fd.status = 4
+            AND NOT us.history_is_private
+            AND COALESCE(fd.refreshed_at, 0) < ?
+            ORDER BY fd.refreshed_at, fd.watermark
+            LIMIT ?
+        )
+        RETURNING user, watermark
+        ;
+        """
+        params = (refreshed_before, n)
+        self.db.cursor.execute(query, params)
+        watermarks = {x["user"]: x["watermark"] for x in self.db.cursor.fetchall()}
+        if not watermarks:
+            self.commit()
+            return []
 
         query = f"""
         SELECT
-            COUNT(us.name)
-        FROM users us
-        INNER JOIN data_collection fd
-        ON fd.user = us.id_nb
-        WHERE fd.status >= {status}
+            id_nb,
+            name
+        FROM users
+        WHERE id_nb IN ({", ".join(["?"] * len(watermarks))})
         ;
         """
+        self.db.cursor.execute(query, list(watermarks))
+        users = [
+            {
+                "id": x["id_nb"],
+                "name": x["name"],
+                "watermark": watermarks[x["id_nb"]],
+                "cursor": None,
+            }
+            for x in self.db.cursor.fetchall()
+        ]
+        self.commit()
+        return users
+
+    @retry_if_locked
+    @query_timer
+    def finish_refresh(self, user_id, refreshed_at):
+
+        """
+        Marks a refreshed user as done again and moves the watermark to the newest listen.
+        """
 
-        self.db.cursor.execute(query)
-        return self.db.cursor.fetchone()[0]
+        query = """
+        UPDATE data_collection
+        SET
+            status = 4,
+            fetch_cursor = NULL,
+            refreshed_at = ?,
+            watermark = (SELECT MAX(time) FROM listens WHERE listens.user = ?)
+        WHERE user = ?
+        ;
+        """
+        params = (refreshed_at, user_id, user_id)
+        self.db.cursor.execute(query, params)
+        self.commit()
+
+    def count_users_with_status(self, status):
+
+        return self.get_stats().get(f"status_{status}", 0)
+
+    def count_users_with_status_bigger(self, status):
+
+        return sum(
+            v
+            for k, v in self.get_stats().items()
+            if k.startswith("status_") and int(k[7:]) >= status
+        )
 
     @retry_if_locked
-    @debug_timer
+    @query_timer
     def update_data_status(self, status, user_ids=None, listens=None, songs=None):
 
         if user_ids:
 
-            query = f"""
-            UPDATE data_collection
-            SET status = ?
-            WHERE user IN ({", ".join([str(x) for x in user_ids])});
-            """
+            user_ids = list(user_ids)
+            # chunks of 500 ids to stay below the SQLite variable limit
+            for i in range(0, len(user_ids), 500):
+                chunk = user_ids[i : i + 500]
+                # the cursor of a finished user is cleared. A user that is handed back to 2 keeps it, so the next fetch resumes where this one stopped
+                query = f"""
+                UPDATE data_collection
+                SET
+                    status = ?,
+                    fetch_cursor = CASE WHEN ? = 4 THEN NULL ELSE fetch_cursor END
+                WHERE user IN ({", ".join(["?"] * len(chunk))});
+                """
+
+                params = [status, status] + chunk
+                self.db.cursor.execute(query, params)
+            self.commit()
 
-            params = [status]
-            self.db.cursor.execute(query, params)
-            self.db.connection.commit()
+    @retry_if_locked
+    @query_timer
+    def add_listen_windows(self, user_id, windows):
+
+        """
+        Splits the listening history of a heavy user into windows that are fetched independently.
+
+        windows: [(time_from, time_to)]
+
+        The windows of an earlier crawl of the user (e.g. a user that was reset to status 2 to fetch them again) are replaced.
+        """
+
+        query = """
+        DELETE FROM listen_windows
+        WHERE user = ?
+        ;
+        """
+        self.db.cursor.execute(query, (user_id,))
+
+        query = """
+        INSERT INTO listen_windows
+            (user, time_from, time_to, status)
+        VALUES (?, ?, ?, 0)
+        ;
+        """
+        params = [(user_id, x[0], x[1]) for x in windows]
+        self.db.cursor.executemany(query, params)
+        self.commit()
 
     @retry_if_locked
-    @debug_timer
-    def add_user(self, user_object):
+    @query_timer
+    def claim_listen_window(self):
+
+        """
+        Returns a window that nobody is fetching yet and marks it as being fetched, or None. Like claim_users, this is a single UPDATE.
+
+        Window status:
+          0 = not fetched
+          1 = being fetched
+          2 = fetched
+        """
+
+        query = """
+        UPDATE listen_windows
+        SET status = 1
+        WHERE rowid = (
+            SELECT rowid
+            FROM listen_windows
+            WHERE status = 0
+            ORDER BY user, time_from
+            LIMIT 1
+        )
+        RETURNING user, time_from, time_to, fetch_cursor
+        ;
+        """
+        self.db.cursor.execute(query)
+        row = self.db.cursor.fetchone()
+        if row is None:
+            self.commit()
+            return None
 
         query = """
         SELECT
-            id_nb
+            name
         FROM users
-        WHERE name = ?
+        WHERE id_nb = ?
         ;
         """
-        params = [str(user_object)]
+        params = (row["user"],)
         self.db.cursor.execute(query, params)
-        user_id = self.db.cursor.fetchone()
-        exists = True if user_id else False
+        name = self.db.cursor.fetchone()["name"]
+        self.commit()
 
-        if exists:
-            return user_id[0]
+        return {
+            "id": row["user"],
+            "name": name,
+            "time_from": row["time_from"],
+            "time_to": row["time_to"],
+            "cursor": row["fetch_cursor"],
+        }
 
-        user_name = str(user_object)
-        try:
-            country = user_object.get_country()
-        except pylast.WSError as E:
-            if "Connection to the API failed" in str(E):
-                return self.add_user(user_object)
-            else:
-                # User is not found error. It sometimes seems to happen that a user object is found in the friends list but data about it can't be retrieved.
-                return None
+    @retry_if_locked
+    @query_timer
+    def finish_listen_window(self, user_id, time_from=None):
 
-        try:
-            total_listens = user_object.get_playcount()
-        except pylast.WSError as E:
-            if "Connection to the API failed" in str(E):
-                return self.add_user(user_object)
-            else:
-                # User is not found error.
-                return None
+        """
+        Marks a window as fetched (all windows of the user if time_from is None). The user is marked as done (status 4) together with their last window.
+        """
 
-        if country:
-            country = country.name
+        if time_from is None:
+            query = """
+            UPDATE listen_windows
+            SET status = 2, fetch_cursor = NULL
+            WHERE user = ?
+            ;
+            """
+            params = (user_id,)
         else:
-            country = None
-        try:
-            registered = user_object.get_registered()
-        except pylast.WSError as E:
-            if "Connection to the API failed" in str(E):
-                return self.add_user(user_object)
-            else:
-                # User is not found error.
-                return None
+            query = """
+            UPDATE listen_windows
+            SET status = 2, fetch_cursor = NULL
+            WHERE user = ? AND time_from = ?
+            ;
+            """
+            params = (user_id, time_from)
+        self.db.cursor.execute(query, params)
+
+        query = """
+        UPDATE data_collection
+        SET status = 4, fetch_cursor = NULL
+        WHERE user = ?
+        AND NOT EXISTS (
+            SELECT 1 FROM listen_windows
+            WHERE user = ? AND status < 2
+        )
+        ;
+        """
+        params = (user_id, user_id)
+        self.db.cursor.execute(query, params)
+        self.commit()
+
+    @retry_if_locked
+    @query_timer
+    def get_user_id_from_name(self, user_name):
+
+        query = """
+        SELECT
+            id_nb
+        FROM users
+        WHERE name = ?
+        ;
+        """
+        params = [user_name]
+        self.db.cursor.execute(query, params)
+        res = self.db.cursor.fetchone()
+        return res["id_nb"] if res else None
+
+    @retry_if_locked
+    @query_timer
+    def add_user(self, user_name, country, registered, total_listens):
 
         query = """
         INSERT INTO users
@@ -195,8 +463,11 @@ class DataBaseQueries(object):
         """
         params = (user_name, country, registered, total_listens)
         self.db.cursor.execute(query, params)
-        user_id = self.db.cursor.lastrowid
-        self.db.connection.commit()
+        if self.db.cursor.rowcount == 1:
+            user_id = self.db.cursor.lastrowid
+        else:
+            # the user already existed, lastrowid is meaningless in that case
+            user_id = self.get_user_id_from_name(user_name=user_name)
 
         query = """
         INSERT INTO data_collection
@@ -207,12 +478,120 @@ class DataBaseQueries(object):
         """
         params = (user_id, 0)
         self.db.cursor.execute(query, params)
-        self.db.connection.commit()
+        self.commit()
 
         return user_id
 
     @retry_if_locked
-    @debug_timer
+    @query_timer
+    def add_users(self, users):
+
+        """
+        Adds a whole page of users in one transaction and returns their ids.
+
+        users: [{"user_name", "country", "registered", "total_listens"}]
+        """
+
+        if not users:
+            return []
+
+        query = """
+        INSERT INTO users
+            (name, country, registered, total_listens)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (name)
+        DO NOTHING;
+        """
+        params = [
+            (x["user_name"], x["country"], x["registered"], x["total_listens"])
+            for x in users
+        ]
+        self.db.cursor.executemany(query, params)
+
+        names = list(set(x["user_name"] for x in users))
+        user_ids = []
+        # chunks of 500 names to stay below the SQLite variable limit
+        for i in range(0, len(names), 500):
+            chunk = names[i : i + 500]
+            query = f"""
+            SELECT
+                id_nb
+            FROM users
+            WHERE name IN ({", ".join(["?"] * len(chunk))})
+            ;
+            """
+            self.db.cursor.execute(query, chunk)
+            user_ids += [x["id_nb"] for x in self.db.cursor.fetchall()]
+
+        query = """
+        INSERT INTO data_collection
+            (user, status)
+        VALUES (?, ?)
+        ON CONFLICT (user)
+        DO NOTHING;
+        """
+        params = [(x, 0) for x in user_ids]
+        self.db.cursor.executemany(query, params)
+        self.commit()
+
+        return user_ids
+
+    @retry_if_locked
+    @query_timer
+    def get_users_by_id(self, user_ids):
+
+        user_ids = list(user_ids)
+        users = []
+        # chunks of 500 ids to stay below the SQLite variable limit
+        for i in range(0, len(user_ids), 500):
+            chunk = user_ids[i : i + 500]
+            query = f"""
+            SELECT
+                id_nb,
+                name,
+                country,
+                registered,
+                total_listens,
+                history_is_private
+            FROM users
+            WHERE id_nb IN ({", ".join(["?"] * len(chunk))})
+            ;
+            """
+            self.db.cursor.execute(query, chunk)
+            users += [dict(x) for x in self.db.cursor.fetchall()]
+        return users
+
+    @retry_if_locked
+    @query_timer
+    def copy_users(self, users):
+
+        """
+        Inserts users of another DB with their ids (see get_users_by_id). A shard needs them to tell whose listens it holds.
+        """
+
+        query = """
+        INSERT INTO users
+            (id_nb, name, country, registered, total_listens, history_is_private)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT
+        DO NOTHING;
+        """
+        params = [
+            (
+                x["id_nb"],
+                x["name"],
+                x["country"],
+                x["registered"],
+                x["total_listens"],
+                x["history_is_private"],
+            )
+            for x in users
+        ]
+        self.db.cursor.executemany(query, params)
+        self.commit()
+
+    @retry_if_locked
+    @query_timer
     def add_friendship(self, user1, user2):
 
         u1, u2 = sorted([user1, user2])
@@ -226,12 +605,31 @@ class DataBaseQueries(object):
         """
         params = (u1, u2)
         self.db.cursor.execute(query, params)
-        self.db.connection.commit()
+        self.commit()
 
     @retry_if_locked
-    @debug_timer
+    @query_timer
+    def add_friendships(self, user, friends):
+
+        query = """
+        INSERT INTO friendships
+            (user1, user2)
+        VALUES (?, ?)
+        ON CONFLICT (user1, user2)
+        DO NOTHING;
+        """
+        params = [sorted([user, x]) for x in friends]
+        self.db.cursor.executemany(query, params)
+        self.commit()
+
+    @retry_if_locked
+    @query_timer
     def get_album_id_from_name(self, album_name):
 
+        album_id = self.album_ids.get(album_name)
+        if album_id:
+            return album_id
+
         query = """
         SELECT
             id_nb
@@ -242,10 +640,13 @@ class DataBaseQueries(object):
         params = [album_name]
         self.db.cursor.execute(query, params)
         res = self.db.cursor.fetchone()
-        return res["id_nb"] if res else None
+        if not res:
+            return None
+        self.album_ids.put(album_name, res["id_nb"])
+        return res["id_nb"]
 
     @retry_if_locked
-    @debug_timer
+    @query_timer
     def add_album(self, album_name, mb_id, artist_id):
 
         query = """
@@ -260,13 +661,21 @@ class DataBaseQueries(object):
         """
         params = (album_name, mb_id, artist_id)
         self.db.cursor.execute(query, params)
-        self.db.connection.commit()
-        return self.db.cursor.lastrowid
+        self.commit()
+        if self.db.cursor.rowcount == 1:
+            self.album_ids.put(album_name, self.db.cursor.lastrowid)
+            return self.db.cursor.lastrowid
+        # the album already existed (e.g. added by another process), lastrowid is meaningless in that case
+        return self.get_album_id_from_name(album_name=album_name)
 
     @retry_if_locked
-    @debug_timer
+    @query_timer
     def get_artist_id_from_name(self, artist_name):
 
+        artist_id = self.artist_ids.get(artist_name)
+        if artist_id:
+            return artist_id
+
         query = """
         SELECT
             id_nb
@@ -278,10 +687,13 @@ class DataBaseQueries(object):
         params = [artist_name]
         self.db.cursor.execute(query, params)
         res = self.db.cursor.fetchone()
-        return res["id_nb"] if res else None
+        if not res:
+            return None
+        self.artist_ids.put(artist_name, res["id_nb"])
+        return res["id_nb"]
 
     @retry_if_locked
-    @debug_timer
+    @query_timer
     def add_artist(self, artist_name, mb_id):
 
         query = """
@@ -295,13 +707,21 @@ class DataBaseQueries(object):
         """
         params = (artist_name, mb_id)
         self.db.cursor.execute(query, params)
-        self.db.connection.commit()
-        return self.db.cursor.lastrowid
+        self.commit()
+        if self.db.cursor.rowcount == 1:
+            self.artist_ids.put(artist_name, self.db.cursor.lastrowid)
+            return self.db.cursor.lastrowid
+        # the artist already existed, lastrowid is meaningless in that case
+        return self.get_artist_id_from_name(artist_name=artist_name)
 
     @retry_if_locked
-    @debug_timer
+    @query_timer
     def get_song_id_from_name(self, song_name, artist_id):
 
+        song_id = self.song_ids.get((song_name, artist_id))
+        if song_id:
+            return song_id
+
         query = """
         SELECT
             id_nb
@@ -313,10 +733,13 @@ class DataBaseQueries(object):
         params = [song_name, artist_id]
         self.db.cursor.execute(query, params)
         res = self.db.cursor.fetchone()
-        return res["id_nb"] if res else None
+        if not res:
+            return None
+        self.song_ids.put((song_name, artist_id), res["id_nb"])
+        return res["id_nb"]
 
     @retry_if_locked
-    @debug_timer
+    @query_timer
     def add_song(self, song_name, song_mbid, album_id, artist_id):
 
         """
@@ -331,15 +754,20 @@ class DataBaseQueries(object):
             album
         )
         VALUES (?, ?, ?, ?)
-        ;
+        ON CONFLICT (name, artist)
+        DO NOTHING;
         """
         params = (song_name, song_mbid, artist_id, album_id)
         self.db.cursor.execute(query, params)
-        self.db.connection.commit()
-        return self.db.cursor.lastrowid
+        self.commit()
+        if self.db.cursor.rowcount == 1:
+            self.song_ids.put((song_name, artist_id), self.db.cursor.lastrowid)
+            return self.db.cursor.lastrowid
+        # the song already existed, lastrowid is meaningless in that case
+        return self.get_song_id_from_name(song_name=song_name, artist_id=artist_id)
 
     @retry_if_locked
-    @debug_timer
+    @query_timer
     def add_listening(self, user, song, time):
 
         query = """
@@ -354,155 +782,1071 @@ class DataBaseQueries(object):
         """
         params = (user, song, time)
         self.db.cursor.execute(query, params)
-        self.db.connection.commit()
+        self.commit()
 
-    @retry_if_locked
-    @debug_timer
-    def get_artists_with_no_tags(self, n):
+    def _get_artist_ids_from_names(self, artist_names):
 
-        query = f"""
-        SELECT
-            a.id_nb,
-            a.name
-        FROM artists a
-        LEFT JOIN tags t
-        ON t.artist = a.id_nb
-        WHERE t.tag IS NULL
-        ORDER BY a.id_nb
-        LIMIT {n}
-        ;
-        """
+        artist_ids = {}
+        missing = []
+        for name in artist_names:
+            artist_id = self.artist_ids.get(name)
+            if artist_id:
+                artist_ids[name] = artist_id
+            else:
+                missing.append(name)
 
-        self.db.cursor.execute(query)
-        users = list(self.db.cursor.fetchall())
-        users = [{"id": x["id_nb"], "name": x["name"]} for x in users]
-        return users
+        artist_names = missing
+        # chunks of 500 names to stay below the SQLite variable limit
+        for i in range(0, len(artist_names), 500):
+            chunk = artist_names[i : i + 500]
+            query = f"""
+            SELECT
+                id_nb,
+                name
+            FROM artists
+            WHERE name IN ({", ".join(["?"] * len(chunk))})
+            ;
+            """
+            self.db.cursor.execute(query, chunk)
+            for x in self.db.cursor.fetchall():
+                artist_ids[x["name"]] = x["id_nb"]
+        return artist_ids
+
+    def _get_album_ids_from_names(self, album_names):
+
+        album_ids = {}
+        missing = []
+        for name in album_names:
+            album_id = self.album_ids.get(name)
+            if album_id:
+                album_ids[name] = album_id
+            else:
+                missing.append(name)
 
-    @retry_if_locked
-    @debug_timer
-    def add_tags_to_artist(self, tags, artist_id):
+        album_names = missing
+        for i in range(0, len(album_names), 500):
+            chunk = album_names[i : i + 500]
+            query = f"""
+            SELECT
+                id_nb,
+                name
+            FROM albums
+            WHERE name IN ({", ".join(["?"] * len(chunk))})
+            ;
+            """
+            self.db.cursor.execute(query, chunk)
+            for x in self.db.cursor.fetchall():
+                album_ids[x["name"]] = x["id_nb"]
+        return album_ids
 
-        if len(tags) == 0:
-            tags = [{"tag": "NONE", "weight": 0}]
+    def _get_song_ids_from_names(self, songs):
 
-        for t in tags:
-            query = """
-            INSERT INTO tags (
-                tag,
-                artist,
-                weight
-            )
-            VALUES (?, ?, ?)
-            ON CONFLICT (artist, tag)
-            DO NOTHING;
+        """
+        songs is a list of (song name, artist id) tuples
+        """
+
+        song_ids = {}
+        missing = []
+        for song in songs:
+            song_id = self.song_ids.get(song)
+            if song_id:
+                song_ids[song] = song_id
+            else:
+                missing.append(song)
+
+        songs = missing
+        for i in range(0, len(songs), 250):
+            chunk = songs[i : i + 250]
+            query = f"""
+            SELECT
+                id_nb,
+                name,
+                artist
+            FROM songs
+            WHERE (name, artist) IN (VALUES {", ".join(["(?, ?)"] * len(chunk))})
+            ;
             """
-            params = (t["tag"], artist_id, t["weight"])
+            params = [x for song in chunk for x in song]
             self.db.cursor.execute(query, params)
-            self.db.connection.commit()
+            for x in self.db.cursor.fetchall():
+                song_ids[(x["name"], x["artist"])] = x["id_nb"]
+        return song_ids
 
     @retry_if_locked
-    @debug_timer
-    def update_data_is_private(self, user_id):
+    @query_timer
+    def add_listens_batch(self, user, artists, albums, songs, listens, window=None):
 
-        query = """
-        UPDATE users
-        SET history_is_private = TRUE
-        WHERE id_nb = ?;
         """
+        Inserts the new artists, albums, songs and the listening events of one user in a single transaction.
 
-        params = [user_id]
-        self.db.cursor.execute(query, params)
-        self.db.connection.commit()
+        artists: {artist name: mbid}
+        albums: {album name: (mbid, artist name)}
+        songs: {(artist name, song name): (mbid, album name)}
+        listens: [(artist name, song name, time)]
+        window: time_from of the listen window the listens belong to, None if the user isn't split
 
-    @retry_if_locked
-    @debug_timer
-    def reset_cancelled_fetching(self):
+        The listening history comes newest first, so everything after the oldest listen of the batch is in the DB once the batch is committed. That timestamp is stored as fetch cursor of the user (or window) in the same transaction.
+        """
 
-        query = """
-        UPDATE data_collection
-        SET status = 0
-        WHERE status = 1
+        try:
+            query = """
+            INSERT INTO artists (
+                name,
+                mb_id
+            )
+            VALUES (?, ?)
+            ON CONFLICT (name)
+            DO NOTHING;
+            """
+            params = list(artists.items())
+            self.db.cursor.executemany(query, params)
+
+            artist_names = set(artists)
+            artist_names.update(x[1] for x in albums.values())
+            artist_names.update(x[0] for x in songs)
+            artist_names.update(x[0] for x in listens)
+            artist_ids = self._get_artist_ids_from_names(artist_names)
+
+            query = """
+            INSERT INTO albums (
+                name,
+                mb_id,
+                artist
+            )
+            VALUES (?, ?, ?)
+            ON CONFLICT (name)
+            DO NOTHING;
+            """
+            params = [
+                (name, mb_id, artist_ids[artist_name])
+                for name, (mb_id, artist_name) in albums.items()
+            ]
+            self.db.cursor.executemany(query, params)
+
+            album_ids = self._get_album_ids_from_names(
+                set(x[1] for x in songs.values() if x[1])
+            )
+
+            query = """
+            INSERT INTO songs (
+                name,
+                mb_id,
+                artist,
+                album
+            )
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (name, artist)
+            DO NOTHING;
+            """
+            params = [
+                (song_name, mb_id, artist_ids[artist_name], album_ids.get(album_name))
+                for (artist_name, song_name), (mb_id, album_name) in songs.items()
+            ]
+            self.db.cursor.executemany(query, params)
+
+            song_ids = self._get_song_ids_from_names(
+                set((x[1], artist_ids[x[0]]) for x in listens)
+            )
+
+            query = """
+            INSERT INTO listens (
+                user,
+                song,
+                time
+            )
+            VALUES (?, ?, ?)
+            ON CONFLICT (user, song, time)
+            DO NOTHING;
+            """
+            params = [
+                (user, song_ids[(song_name, artist_ids[artist_name])], time)
+                for artist_name, song_name, time in listens
+            ]
+            self.db.cursor.executemany(query, params)
+
+            if listens:
+                cursor = min(int(x[2]) for x in listens)
+                if window is None:
+                    query = """
+                    UPDATE data_collection
+                    SET fetch_cursor = ?
+                    WHERE user = ?
+                    ;
+                    """
+                    params = (cursor, user)
+                else:
+                    query = """
+                    UPDATE listen_windows
+                    SET fetch_cursor = ?
+                    WHERE user = ? AND time_from = ?
+                    ;
+                    """
+                    params = (cursor, user, window)
+                self.db.cursor.execute(query, params)
+
+            self.commit()
+        except Exception:
+            # don't leave half a batch in the open transaction, retry_if_locked repeats the whole batch
+            self.db.connection.rollback()
+            raise
+
+        # only cache ids once they are committed, ids of a rolled back batch are reused by SQLite
+        for name, artist_id in artist_ids.items():
+            self.artist_ids.put(name, artist_id)
+        for name, album_id in album_ids.items():
+            self.album_ids.put(name, album_id)
+        for song, song_id in song_ids.items():
+            self.song_ids.put(song, song_id)
+
+    @retry_if_locked
+    @query_timer
+    def set_fetch_cursor(self, user, cursor, window=None):
+
+        """
+        Same as the fetch cursor of add_listens_batch, for listens that went to a shard (see shards.py).
+        """
+
+        if window is None:
+            query = """
+            UPDATE data_collection
+            SET fetch_cursor = ?
+            WHERE user = ?
+            ;
+            """
+            params = (cursor, user)
+        else:
+            query = """
+            UPDATE listen_windows
+            SET fetch_cursor = ?
+            WHERE user = ? AND time_from = ?
+            ;
+            """
+            params = (cursor, user, window)
+        self.db.cursor.execute(query, params)
+        self.commit()
+
+    @retry_if_locked
+    @query_timer
+    def get_artists_with_no_tags(self, n):
+
+        query = """
+        SELECT
+            id_nb,
+            name
+        FROM artists
+        WHERE tag_status = 0
+        ORDER BY id_nb
+        LIMIT ?
+        ;
+        """
+
+        self.db.cursor.execute(query, (n,))
+        artists = [
+            {"id": x["id_nb"], "name": x["name"]} for x in self.db.cursor.fetchall()
+        ]
+        return artists
+
+    @retry_if_locked
+    @query_timer
+    def claim_artists(self, n):
+
+        """
+        Moves up to n artists whose tags haven't been fetched from tag_status 0 to 1 and returns them. This is a single UPDATE, so two processes never claim the same artist.
+        """
+
+        query = """
+        UPDATE artists
+        SET tag_status = 1
+        WHERE id_nb IN (
+            SELECT id_nb
+            FROM artists
+            WHERE tag_status = 0
+            ORDER BY id_nb
+            LIMIT ?
+        )
+        RETURNING id_nb, name
+        ;
+        """
+        self.db.cursor.execute(query, (n,))
+        artists = [
+            {"id": x["id_nb"], "name": x["name"]} for x in self.db.cursor.fetchall()
+        ]
+        self.commit()
+        return sorted(artists, key=lambda x: x["id"])
+
+    @retry_if_locked
+    @query_timer
+    def update_tag_status(self, artist_ids, status):
+
+        artist_ids = list(artist_ids)
+        # chunks of 500 ids to stay below the SQLite variable limit
+        for i in range(0, len(artist_ids), 500):
+            chunk = artist_ids[i : i + 500]
+            query = f"""
+            UPDATE artists
+            SET tag_status = ?
+            WHERE id_nb IN ({", ".join(["?"] * len(chunk))})
+            ;
+            """
+            self.db.cursor.execute(query, [status] + chunk)
+        self.commit()
+
+    @retry_if_locked
+    @query_timer
+    def add_tags(self, artists):
+
+        """
+        Inserts the tags of a batch of artists and marks the artists as done in one transaction. Artists without tags get a "NONE" tag.
+
+        artists: [{"id": artist id, "tags": [{"tag": name, "weight": weight}], "status": 2 or 3 (not found)}]
+        """
+
+        query = """
+        INSERT INTO tags (
+            tag,
+            artist,
+            weight
+        )
+        VALUES (?, ?, ?)
+        ON CONFLICT (artist, tag)
+        DO NOTHING;
+        """
+        params = [
+            (t["tag"], a["id"], t["weight"])
+            for a in artists
+            for t in (a["tags"] if a["tags"] else [{"tag": "NONE", "weight": 0}])
+        ]
+        self.db.cursor.executemany(query, params)
+
+        query = """
+        UPDATE artists
+        SET tag_status = ?
+        WHERE id_nb = ?
+        ;
+        """
+        params = [(a["status"], a["id"]) for a in artists]
+        self.db.cursor.executemany(query, params)
+        self.commit()
+
+    def add_tags_to_artist(self, tags, artist_id, status=2):
+        self.add_tags(artists=[{"id": artist_id, "tags": tags, "status": status}])
+
+    @retry_if_locked
+    @query_timer
+    def update_data_is_private(self, user_id):
+
+        query = """
+        UPDATE users
+        SET history_is_private = TRUE
+        WHERE id_nb = ?;
+        """
+
+        params = [user_id]
+        self.db.cursor.execute(query, params)
+        self.commit()
+
+    @retry_if_locked
+    @query_timer
+    def reset_cancelled_fetching(self):
+
+        """
+        Hands back the units that were being fetched when a collector stopped. Units with a lease that hasn't expired yet (see coordinator.py) are still being fetched by a collector that is alive and are left alone. Expired leases are deleted.
+        """
+
+        query = """
+        DELETE FROM leases
+        WHERE expires < ?
+        ;
+        """
+        self.db.cursor.execute(query, (int(timer()),))
+
+        query = """
+        UPDATE data_collection
+        SET status = 0
+        WHERE status = 1
+        AND NOT EXISTS (SELECT 1 FROM leases WHERE kind = 'user' AND unit = CAST(data_collection.user AS TEXT))
+        ;
+        """
+        self.db.cursor.execute(query)
+
+        # split users keep their windows, only the windows that were being fetched are repeated
+        query = """
+        UPDATE listen_windows
+        SET status = 0
+        WHERE status = 1
+        AND NOT EXISTS (SELECT 1 FROM leases WHERE kind = 'window' AND unit = listen_windows.user || ':' || listen_windows.time_from)
         ;
         """
         self.db.cursor.execute(query)
 
+        # a split user whose last window was done just before the crash
         query = """
         UPDATE data_collection
-        SET status = 2
+        SET status = 4, fetch_cursor = NULL
         WHERE status = 3
+        AND user IN (SELECT user FROM listen_windows)
+        AND user NOT IN (SELECT user FROM listen_windows WHERE status < 2)
         ;
         """
         self.db.cursor.execute(query)
 
-        self.db.connection.commit()
+        query = """
+        UPDATE data_collection
+        SET status = 2
+        WHERE status = 3
+        AND user NOT IN (SELECT user FROM listen_windows)
+        AND NOT EXISTS (SELECT 1 FROM leases WHERE kind = 'user' AND unit = CAST(data_collection.user AS TEXT))
+        ;
+        """
+        self.db.cursor.execute(query)
 
-    def get_data_stats(self):
+        # an interrupted refresh starts again at the watermark, which only moves once a refresh is complete
+        query = """
+        UPDATE data_collection
+        SET status = 4, fetch_cursor = NULL
+        WHERE status = 6
+        AND NOT EXISTS (SELECT 1 FROM leases WHERE kind = 'user' AND unit = CAST(data_collection.user AS TEXT))
+        ;
+        """
+        self.db.cursor.execute(query)
 
         query = """
-        SELECT
-            COUNT(*) AS cnt
-        FROM songs
+        UPDATE artists
+        SET tag_status = 0
+        WHERE tag_status = 1
+        AND NOT EXISTS (SELECT 1 FROM leases WHERE kind = 'artist' AND unit = CAST(artists.id_nb AS TEXT))
         ;
         """
         self.db.cursor.execute(query)
-        songs = self.db.cursor.fetchone()["cnt"]
 
         query = """
-        SELECT
-            COUNT(*) AS cnt
-        FROM listens
+        UPDATE enrich_queue
+        SET status = 0
+        WHERE status = 1
+        AND NOT EXISTS (SELECT 1 FROM leases WHERE kind = 'enrich' AND unit = enrich_queue.kind || ':' || enrich_queue.id)
         ;
         """
         self.db.cursor.execute(query)
-        listens = self.db.cursor.fetchone()["cnt"]
+
+        self.commit()
+
+    @retry_if_locked
+    @query_timer
+    def add_leases(self, kind, units, holder, seconds):
+
+        query = """
+        INSERT INTO leases (kind, unit, holder, expires)
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (kind, unit)
+        DO UPDATE SET holder = excluded.holder, expires = excluded.expires
+        ;
+        """
+        expires = int(timer() + seconds)
+        params = [(kind, str(x), holder, expires) for x in units]
+        self.db.cursor.executemany(query, params)
+        self.commit()
+
+    @retry_if_locked
+    @query_timer
+    def renew_leases(self, holder, seconds):
+
+        """
+        Extends all leases of holder by seconds from now. Returns how many it holds.
+        """
+
+        query = """
+        UPDATE leases
+        SET expires = ?
+        WHERE holder = ?
+        ;
+        """
+        self.db.cursor.execute(query, (int(timer() + seconds), holder))
+        n = self.db.cursor.rowcount
+        self.commit()
+        return n
+
+    @retry_if_locked
+    @query_timer
+    def extend_leases(self, seconds):
+
+        """
+        Extends all leases by seconds, e.g. by the time the coordinator couldn't answer the heartbeats.
+        """
+
+        query = """
+        UPDATE leases
+        SET expires = expires + ?
+        ;
+        """
+        self.db.cursor.execute(query, (seconds,))
+        self.commit()
+
+    @retry_if_locked
+    @query_timer
+    def release_leases(self, kind, units):
+
+        query = """
+        DELETE FROM leases
+        WHERE kind = ?
+        AND unit = ?
+        ;
+        """
+        self.db.cursor.executemany(query, [(kind, str(x)) for x in units])
+        self.commit()
+
+    @retry_if_locked
+    @query_timer
+    def queue_enrichment(self):
+
+        """
+        Queues the artists, albums and songs without mbid that were added since the last call for the enrich stage. Their priority is the number of listens they have right now. Returns how many were queued.
+
+        The ids only grow, so everything above the highest queued id of a kind is new. Counting the listens takes one scan of the listens table.
+        """
 
         query = """
         SELECT
-            COUNT(*) AS cnt
-        FROM artists
+            kind,
+            MAX(id) AS id
+        FROM enrich_queue
+        GROUP BY kind
         ;
         """
         self.db.cursor.execute(query)
-        artists = self.db.cursor.fetchone()["cnt"]
+        queued = {x["kind"]: x["id"] for x in self.db.cursor.fetchall()}
+        after = {k: queued.get(k, 0) for k in ENRICH_TABLES}
 
         query = """
+        CREATE TEMP TABLE IF NOT EXISTS enrich_counts(
+            song INTEGER NOT NULL PRIMARY KEY,
+            listens INTEGER NOT NULL
+        );
+        """
+        self.db.cursor.execute(query)
+        self.db.cursor.execute("DELETE FROM enrich_counts")
+        # the songs of new artists and albums are new as well. listens.song is TEXT, so it's cast to compare it as a number.
+        query = """
+        INSERT INTO enrich_counts (song, listens)
         SELECT
-            COUNT(*) AS cnt
-        FROM tags
+            CAST(song AS INTEGER) AS id,
+            COUNT(*)
+        FROM listens
+        WHERE CAST(song AS INTEGER) > ?
+        GROUP BY id
         ;
         """
-        self.db.cursor.execute(query)
-        tags = self.db.cursor.fetchone()["cnt"]
+        self.db.cursor.execute(query, (after["song"],))
 
         query = """
+        INSERT OR IGNORE INTO enrich_queue (kind, id, priority)
         SELECT
-            COUNT(DISTINCT a.id_nb) AS cnt
-        FROM artists a
-        INNER JOIN tags t
-        ON t.artist = a.id_nb
+            'song',
+            s.id_nb,
+            COALESCE(c.listens, 0)
+        FROM songs s
+        LEFT JOIN enrich_counts c
+        ON c.song = s.id_nb
+        WHERE s.id_nb > ?
+        AND s.mb_id IS NULL
         ;
         """
-        self.db.cursor.execute(query)
-        missing_tags = self.db.cursor.fetchone()["cnt"]
+        self.db.cursor.execute(query, (after["song"],))
+        n = self.db.cursor.rowcount
+
+        for kind, column in [("artist", "artist"), ("album", "album")]:
+            query = f"""
+            INSERT OR IGNORE INTO enrich_queue (kind, id, priority)
+            SELECT
+                '{kind}',
+                x.id_nb,
+                COALESCE(SUM(c.listens), 0)
+            FROM {ENRICH_TABLES[kind]} x
+            LEFT JOIN songs s
+            ON s.{column} = x.id_nb
+            LEFT JOIN enrich_counts c
+            ON c.song = s.id_nb
+            WHERE x.id_nb > ?
+            AND x.mb_id IS NULL
+            GROUP BY x.id_nb
+            ;
+            """
+            self.db.cursor.execute(query, (after[kind],))
+            n += self.db.cursor.rowcount
 
-        return songs, listens, artists, tags, missing_tags
+        self.db.cursor.execute("DELETE FROM enrich_counts")
+        self.commit()
+        return n
 
     @retry_if_locked
-    @debug_timer
-    def count_artists_with_no_tags(self):
+    @query_timer
+    def claim_enrichment(self, n):
+
+        """
+        Claims the n queued artists, albums and songs with the most listens (status 0 -> 1).
+
+        Returns [{"kind", "id", "name", "artist"}], artist is the name of the artist (None for artists).
+        """
+
+        query = """
+        UPDATE enrich_queue
+        SET status = 1
+        WHERE (kind, id) IN (
+            SELECT
+                kind,
+                id
+            FROM enrich_queue
+            WHERE status = 0
+            ORDER BY priority DESC
+            LIMIT ?
+        )
+        RETURNING kind, id
+        ;
+        """
+        self.db.cursor.execute(query, (n,))
+        claimed = {}
+        for x in self.db.cursor.fetchall():
+            claimed.setdefault(x["kind"], []).append(x["id"])
+
+        items = []
+        for kind, ids in claimed.items():
+            if kind == "artist":
+                query = f"""
+                SELECT
+                    id_nb,
+                    name,
+                    NULL AS artist
+                FROM artists
+                WHERE id_nb IN ({", ".join(["?"] * len(ids))})
+                ;
+                """
+            else:
+                query = f"""
+                SELECT
+                    x.id_nb,
+                    x.name,
+                    a.name AS artist
+                FROM {ENRICH_TABLES[kind]} x
+                INNER JOIN artists a
+                ON a.id_nb = x.artist
+                WHERE x.id_nb IN ({", ".join(["?"] * len(ids))})
+                ;
+                """
+            self.db.cursor.execute(query, ids)
+            items += [
+                {
+                    "kind": kind,
+                    "id": x["id_nb"],
+                    "name": x["name"],
+                    "artist": x["artist"],
+                }
+                for x in self.db.cursor.fetchall()
+            ]
+        self.commit()
+        return items
+
+    @retry_if_locked
+    @query_timer
+    def finish_enrichment(self, items):
+
+        """
+        Stores the mbids that were found and marks the items as done.
+
+        items: [{"kind", "id", "mbid"}], mbid is None if the API doesn't know one
+        """
+
+        for kind, table in ENRICH_TABLES.items():
+            query = f"""
+            UPDATE {table}
+            SET mb_id = ?
+            WHERE id_nb = ?
+            AND mb_id IS NULL
+            ;
+            """
+            params = [
+                (x["mbid"], x["id"]) for x in items if x["kind"] == kind and x["mbid"]
+            ]
+            self.db.cursor.executemany(query, params)
+
+        query = """
+        UPDATE enrich_queue
+        SET status = 2
+        WHERE kind = ?
+        AND id = ?
+        ;
+        """
+        self.db.cursor.executemany(query, [(x["kind"], x["id"]) for x in items])
+        self.commit()
+
+    @retry_if_locked
+    @query_timer
+    def update_enrichment_status(self, items, status):
+
+        query = """
+        UPDATE enrich_queue
+        SET status = ?
+        WHERE kind = ?
+        AND id = ?
+        ;
+        """
+        self.db.cursor.executemany(query, [(status, x["kind"], x["id"]) for x in items])
+        self.commit()
+
+    @retry_if_locked
+    @query_timer
+    def get_negative_results(self, kind, names):
+
+        """
+        Returns the names of kind ("user", "artist" or "private") out of names that are known to fail and haven't expired yet.
+        """
+
+        if not names:
+            return set()
+
+        names = list(names)
+        now = int(timer())
+        known = set()
+        # chunks of 500 names to stay below the SQLite variable limit
+        for i in range(0, len(names), 500):
+            chunk = names[i : i + 500]
+            query = f"""
+            SELECT name
+            FROM negative_results
+            WHERE kind = ?
+            AND expires > ?
+            AND name IN ({", ".join(["?"] * len(chunk))})
+            ;
+            """
+            self.db.cursor.execute(query, [kind, now] + chunk)
+            known.update(x["name"] for x in self.db.cursor.fetchall())
+        return known
+
+    @retry_if_locked
+    @query_timer
+    def add_negative_results(self, kind, names, error, ttl_days):
+
+        query = """
+        INSERT INTO negative_results (
+            kind,
+            name,
+            error,
+            expires
+        )
+        VALUES (?, ?, ?, ?)
+        ON CONFLICT (kind, name)
+        DO UPDATE SET error = excluded.error, expires = excluded.expires
+        ;
+        """
+        expires = int(timer() + ttl_days * 86400)
+        params = [(kind, name, error, expires) for name in names]
+        self.db.cursor.executemany(query, params)
+        self.commit()
+
+    @retry_if_locked
+    @query_timer
+    def release_negative_results(self):
+
+        """
+        Deletes the expired negative results and undoes what they stood for: artists that couldn't be found or failed are queued for their tags again and private users are refreshed again. Users that couldn't be found were never added, so they are simply looked up again the next time they show up.
+        """
+
+        now = int(timer())
+
+        query = """
+        DELETE FROM tags
+        WHERE tag = 'NONE'
+        AND artist IN (
+            SELECT a.id_nb
+            FROM artists a
+            INNER JOIN negative_results n
+            ON n.kind = 'artist' AND n.name = a.name
+            WHERE a.tag_status = 3
+            AND n.expires <= ?
+        )
+        ;
+        """
+        self.db.cursor.execute(query, (now,))
+
+        query = """
+        UPDATE artists
+        SET tag_status = 0
+        WHERE tag_status IN (3, 4)
+        AND name IN (
+            SELECT name
+            FROM negative_results
+            WHERE kind = 'artist'
+            AND expires <= ?
+        )
+        ;
+        """
+        self.db.cursor.execute(query, (now,))
+
+        query = """
+        UPDATE users
+        SET history_is_private = FALSE
+        WHERE history_is_private
+        AND name IN (
+            SELECT name
+            FROM negative_results
+            WHERE kind = 'private'
+            AND expires <= ?
+        )
+        ;
+        """
+        self.db.cursor.execute(query, (now,))
+
+        query = """
+        DELETE FROM negative_results
+        WHERE expires <= ?
+        ;
+        """
+        self.db.cursor.execute(query, (now,))
+
+        self.commit()
+
+    def get_stats(self):
+
+        """
+        Returns the counters of the stats table (see db.py) as {name: value}. They are kept up to date by triggers, so this doesn't scan any table.
+        """
 
         query = """
         SELECT
-            COUNT(a.*)
-        FROM artists a
-        LEFT JOIN tags t
-        ON t.artist = a.id_nb
-        WHERE t.tag IS NULL
+            name,
+            value
+        FROM stats
         ;
         """
+        self.db.cursor.execute(query)
+        return {x["name"]: x["value"] for x in self.db.cursor.fetchall()}
+
+    @retry_if_locked
+    @query_timer
+    def get_remaining_listens(self):
+
+        """
+        Returns the number of users whose listens still have to be fetched (status 2 and 3) and the sum of their total_listens as reported by last.fm. Users that are still being fetched count with all of their listens.
+        """
 
+        query = """
+        SELECT
+            COUNT(*) AS users,
+            COALESCE(SUM(us.total_listens), 0) AS listens
+        FROM data_collection fd
+        INNER JOIN users us
+        ON us.id_nb = fd.user
+        WHERE fd.status IN (2, 3)
+        ;
+        """
         self.db.cursor.execute(query)
-        return self.db.cursor.fetchone()[0]
+        row = self.db.cursor.fetchone()
+        return row["users"], row["listens"]
+
+    def get_data_stats(self):
+
+        stats = self.get_stats()
+        return (
+            stats.get("songs", 0),
+            stats.get("listens", 0),
+            stats.get("artists", 0),
+            stats.get("tags", 0),
+            stats.get("artists", 0) - stats.get("tagged_artists", 0),
+        )
+
+    def count_artists_with_no_tags(self):
+
+        stats = self.get_stats()
+        return stats.get("artists", 0) - stats.get("tagged_artists", 0)
+
+    @retry_if_locked
+    @query_timer
+    def merge_db(self, path):
+
+        """
+        Merges the collection DB at path, a shard (see shards.py) or the DB of another machine, into this one in a single transaction. Returns the number of listens that were new.
+
+        The ids of the other DB mean nothing here, users, artists and albums are matched by name and songs by name and artist. Listens that are in both DBs (same user, song and time) are kept once. Of the data status of a user, the one that got further wins, users that were being fetched over there count as not fetched. An mbid that is missing here is taken from the other DB.
+
+        listen_windows, song_merges and enrich_queue are not merged, they are rebuilt where needed.
+        """
+
+        # brings the other DB to the current schema
+        DB(storage=self.config["storage"], path=path).connection.close()
+
+        # the data status by how far a user got: not fetched, friends fetched, broken, done
+        rank = "CASE {0} WHEN 0 THEN 0 WHEN 1 THEN 0 WHEN 2 THEN 1 WHEN 3 THEN 1 WHEN 5 THEN 2 ELSE 3 END"
+        queries = [
+            """
+            CREATE TEMP TABLE IF NOT EXISTS merge_users(old INTEGER PRIMARY KEY, new INTEGER NOT NULL)
+            """,
+            """
+            CREATE TEMP TABLE IF NOT EXISTS merge_artists(old INTEGER PRIMARY KEY, new INTEGER NOT NULL)
+            """,
+            """
+            CREATE TEMP TABLE IF NOT EXISTS merge_albums(old INTEGER PRIMARY KEY, new INTEGER NOT NULL)
+            """,
+            """
+            CREATE TEMP TABLE IF NOT EXISTS merge_songs(old INTEGER PRIMARY KEY, new INTEGER NOT NULL)
+            """,
+            "DELETE FROM merge_users",
+            "DELETE FROM merge_artists",
+            "DELETE FROM merge_albums",
+            "DELETE FROM merge_songs",
+            """
+            INSERT INTO main.users (name, country, registered, total_listens, history_is_private)
+            SELECT name, country, registered, total_listens, history_is_private
+            FROM src.users
+            WHERE true
+            ON CONFLICT (name)
+            DO UPDATE SET history_is_private = users.history_is_private OR excluded.history_is_private
+            """,
+            """
+            INSERT INTO merge_users (old, new)
+            SELECT s.id_nb, u.id_nb
+            FROM src.users s
+            INNER JOIN main.users u
+            ON u.name = s.name
+            """,
+            # an artist that was being tagged over there still needs its tags
+            """
+            INSERT INTO main.artists (name, mb_id, tag_status)
+            SELECT name, mb_id, CASE tag_status WHEN 1 THEN 0 ELSE tag_status END
+            FROM src.artists
+            WHERE true
+            ON CONFLICT (name)
+            DO UPDATE SET
+                mb_id = COALESCE(artists.mb_id, excluded.mb_id),
+                tag_status = CASE WHEN artists.tag_status IN (0, 1) AND excluded.tag_status > artists.tag_status THEN excluded.tag_status ELSE artists.tag_status END
+            """,
+            """
+            INSERT INTO merge_artists (old, new)
+            SELECT s.id_nb, a.id_nb
+            FROM src.artists s
+            INNER JOIN main.artists a
+            ON a.name = s.name
+            """,
+            """
+            INSERT INTO main.albums (name, mb_id, artist, released_mb, released_lfm)
+            SELECT s.name, s.mb_id, m.new, s.released_mb, s.released_lfm
+            FROM src.albums s
+            INNER JOIN merge_artists m
+            ON m.old = s.artist
+            WHERE true
+            ON CONFLICT (name)
+            DO UPDATE SET mb_id = COALESCE(albums.mb_id, excluded.mb_id)
+            """,
+            """
+            INSERT INTO merge_albums (old, new)
+            SELECT s.id_nb, a.id_nb
+            FROM src.albums s
+            INNER JOIN main.albums a
+            ON a.name = s.name
+            """,
+            """
+            INSERT INTO main.songs (name, mb_id, artist, album, released_mb, released_lfm)
+            SELECT s.name, s.mb_id, ma.new, mal.new, s.released_mb, s.released_lfm
+            FROM src.songs s
+            INNER JOIN merge_artists ma
+            ON ma.old = s.artist
+            LEFT JOIN merge_albums mal
+            ON mal.old = s.album
+            WHERE true
+            ON CONFLICT (name, artist)
+            DO UPDATE SET
+                mb_id = COALESCE(songs.mb_id, excluded.mb_id),
+                album = COALESCE(songs.album, excluded.album)
+            """,
+            """
+            INSERT INTO merge_songs (old, new)
+            SELECT s.id_nb, so.id_nb
+            FROM src.songs s
+            INNER JOIN merge_artists m
+            ON m.old = s.artist
+            INNER JOIN main.songs so
+            ON so.name = s.name AND so.artist = m.new
+            """,
+            # listens.song is TEXT, it's cast to look the song up by its id
+            """
+            INSERT INTO main.listens (user, song, time)
+            SELECT mu.new, ms.new, l.time
+            FROM src.listens l
+            INNER JOIN merge_users mu
+            ON mu.old = l.user
+            INNER JOIN merge_songs ms
+            ON ms.old = CAST(l.song AS INTEGER)
+            WHERE true
+            ON CONFLICT (user, song, time)
+            DO NOTHING
+            """,
+            """
+            INSERT INTO main.tags (tag, artist, weight)
+            SELECT t.tag, m.new, t.weight
+            FROM src.tags t
+            INNER JOIN merge_artists m
+            ON m.old = t.artist
+            WHERE true
+            ON CONFLICT (tag, artist)
+            DO NOTHING
+            """,
+            """
+            INSERT INTO main.friendships (user1, user2)
+            SELECT MIN(m1.new, m2.new), MAX(m1.new, m2.new)
+            FROM src.friendships f
+            INNER JOIN merge_users m1
+            ON m1.old = f.user1
+            INNER JOIN merge_users m2
+            ON m2.old = f.user2
+            WHERE true
+            ON CONFLICT (user1, user2)
+            DO NOTHING
+            """,
+            # the listens are in, so the set_watermark trigger sees them when a user becomes done
+            f"""
+            INSERT INTO main.data_collection (user, status, fetch_cursor, watermark, refreshed_at)
+            SELECT m.new, CASE d.status WHEN 1 THEN 0 WHEN 3 THEN 2 WHEN 6 THEN 4 ELSE d.status END, d.fetch_cursor, d.watermark, d.refreshed_at
+            FROM src.data_collection d
+            INNER JOIN merge_users m
+            ON m.old = d.user
+            WHERE true
+            ON CONFLICT (user)
+            DO UPDATE SET
+                status = CASE WHEN {rank.format("excluded.status")} > {rank.format("data_collection.status")} THEN excluded.status ELSE data_collection.status END,
+                fetch_cursor = CASE WHEN {rank.format("excluded.status")} > {rank.format("data_collection.status")} THEN excluded.fetch_cursor ELSE data_collection.fetch_cursor END,
+                watermark = MAX(COALESCE(data_collection.watermark, excluded.watermark), COALESCE(excluded.watermark, data_collection.watermark)),
+                refreshed_at = MAX(COALESCE(data_collection.refreshed_at, excluded.refreshed_at), COALESCE(excluded.refreshed_at, data_collection.refreshed_at))
+            """,
+            # done users whose listens were in a shard, also the ones that were refreshed while their new listens went to a shard
+            """
+            UPDATE main.data_collection
+            SET watermark = MAX(COALESCE(watermark, 0), (SELECT MAX(time) FROM main.listens WHERE listens.user = data_collection.user))
+            WHERE status = 4
+            AND user IN (SELECT new FROM merge_users WHERE old IN (SELECT user FROM src.listens))
+            """,
+            """
+            INSERT INTO main.negative_results (kind, name, error, expires)
+            SELECT kind, name, error, expires
+            FROM src.negative_results
+            WHERE true
+            ON CONFLICT (kind, name)
+            DO UPDATE SET expires = MAX(negative_results.expires, excluded.expires)
+            """,
+        ]
+
+        # ATTACH doesn't work inside a transaction
+        self.db.connection.commit()
+        self.db.cursor.execute("ATTACH DATABASE ? AS src", (str(path),))
+        try:
+            listens = self.get_stats().get("listens", 0)
+            for query in queries:
+                self.db.cursor.execute(query)
+            new_listens = self.get_stats().get("listens", 0) - listens
+            with metrics.timer("lastfm_db_commit_seconds"):
+                self.db.connection.commit()
+        except Exception:
+            self.db.connection.rollback()
+            raise
+        finally:
+            self.db.cursor.execute("DETACH DATABASE src")
+        return new_listens
 
 
 dbq = DataBaseQueries()
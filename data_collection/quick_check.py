@@ -1,24 +1,217 @@
 from queries import dbq as dbq
+from metrics import metrics
+from collections import deque
+import argparse
+import datetime as dt
 import time
 
 
 """
 Just for quickly checking the progress of the data collection while it's still running.
+
+    python3 data_collection/quick_check.py             refreshes every 10 seconds, rates over the last 5 minutes
+    python3 data_collection/quick_check.py --once      prints the totals once
+
+Everything is read from the stats table of the collection DB (kept up to date by triggers, see db.py) and from the metrics snapshots in data/metrics.db (see metrics.py), so watching doesn't slow down the collection. The rates per stage and per API key need metrics.enabled in config.yaml. The processes write their metrics every metrics.snapshot_seconds, so the rates need a window that is a good deal longer than that.
+
+The ETA assumes that the users whose listens are still missing have as many listens as last.fm reports for them (total_listens). Listens outside the timeframe are not fetched, so it is rather too long.
+
 """
 
-sleep_time = 100
-print(f"Counting for {sleep_time} seconds")
+STATUS_NAMES = {
+    0: "friends not fetched",
+    1: "friends being fetched",
+    2: "listens not fetched",
+    3: "listens being fetched",
+    4: "done",
+    5: "broken",
+    6: "being refreshed",
+}
+
+
+def flatten(counters, histograms):
+
+    """
+    Turns the histograms into counters (<name>_sum and <name>_count), so rates can be computed the same way for both.
+    """
+
+    values = dict(counters)
+    for (name, labels), h in histograms.items():
+        values[(f"{name}_sum", labels)] = h[-1]
+        values[(f"{name}_count", labels)] = h[-2]
+    return values
+
+
+def total(values, name, **labels):
+    return sum(
+        v
+        for (n, l), v in values.items()
+        if n == name and all(str(dict(l).get(k)) == str(x) for k, x in labels.items())
+    )
+
+
+def label_values(values, name, label):
+    return sorted(
+        {str(dict(l)[label]) for (n, l) in values if n == name and label in dict(l)}
+    )
+
+
+class Dashboard(object):
+    def __init__(self, window):
+        self.window = window
+        self.samples = deque()  # (time, metric values, stats)
+        self.run = None
+
+    def sample(self):
+        run = metrics.latest_run()
+        if run != self.run:
+            # a new run starts counting from 0 again
+            self.samples.clear()
+            self.run = run
+        values = flatten(*metrics.read(run=run)) if run else {}
+
+        now = time.time()
+        self.samples.append((now, values, dbq.get_stats()))
+        # keep one sample that is older than the window, it's the start of the window
+        while len(self.samples) > 2 and self.samples[1][0] <= now - self.window:
+            self.samples.popleft()
+
+    def seconds(self):
+        return self.samples[-1][0] - self.samples[0][0]
+
+    def per_hour(self, f):
+
+        """
+        How much f(metric values, stats) grew per hour over the window.
+        """
+
+        (t0, v0, s0), (t1, v1, s1) = self.samples[0], self.samples[-1]
+        if t1 - t0 <= 0:
+            return 0.0
+        return (f(v1, s1) - f(v0, s0)) / (t1 - t0) * 3600
+
+    def metric_per_hour(self, name, **labels):
+        return self.per_hour(lambda v, s: total(v, name, **labels))
+
+    def render(self):
+        _, values, stats = self.samples[-1]
+        seconds = self.seconds()
+        window = f"{seconds:.0f} s" if seconds < 120 else f"{seconds / 60:.0f} min"
+        lines = [
+            f"LAST.FM DATA COLLECTION    {dt.datetime.now():%Y-%m-%d %H:%M:%S}",
+            "",
+            f"Total (and per hour over the last {window}):" if seconds else "Total:",
+        ]
+        for name in ["users", "listens", "songs", "albums", "artists", "tags"]:
+            per_hour = self.per_hour(lambda v, s: s.get(name, 0))
+            lines.append(f"    {name:<28}{stats.get(name, 0):>14,}{per_hour:>14,.0f}/h")
+        no_tags = stats.get("artists", 0) - stats.get("tagged_artists", 0)
+        lines.append(f"    {'artists without tags':<28}{no_tags:>14,}")
+
+        lines += ["", "Users by status:"]
+        for status, name in STATUS_NAMES.items():
+            n = stats.get(f"status_{status}", 0)
+            lines.append(f"    {status} {name:<26}{n:>14,}")
+
+        remaining_users, remaining_listens = dbq.get_remaining_listens()
+        listens_per_hour = self.per_hour(lambda v, s: s.get("listens", 0))
+        lines += [
+            "",
+            "ETA:",
+            f"    {remaining_users:,} users with about {remaining_listens:,} listens left",
+        ]
+        if listens_per_hour > 0 and remaining_users:
+            hours = remaining_listens / listens_per_hour
+            end = dt.datetime.now() + dt.timedelta(hours=hours)
+            lines.append(
+                f"    {hours:,.1f} hours at {listens_per_hour:,.0f} listens/h (about {end:%Y-%m-%d %H:%M})"
+            )
+        elif remaining_users:
+            lines.append("    no listens fetched in the window yet")
+
+        if not values:
+            lines += ["", "No metrics yet (metrics.enabled in config.yaml)."]
+            return lines
+
+        lines += ["", f"Throughput per stage (last {window}):"]
+        for stage in label_values(values, "lastfm_items_total", "stage"):
+            for item in label_values(values, "lastfm_items_total", "item"):
+                if total(values, "lastfm_items_total", stage=stage, item=item):
+                    per_hour = self.metric_per_hour(
+                        "lastfm_items_total", stage=stage, item=item
+                    )
+                    lines.append(f"    {stage:<10}{item:<18}{per_hour:>14,.0f}/h")
+
+        lines += [
+            "",
+            f"API keys (last {window}):",
+            f"    {'key':<6}{'listens/h':>12}{'requests/s':>12}{'latency':>10}{'errors':>9}{'rate limited':>14}{'not found':>11}",
+        ]
+        for key in label_values(values, "lastfm_api_requests_total", "key"):
+            listens = self.metric_per_hour(
+                "lastfm_items_total", item="listens", key=key
+            )
+            requests = self.metric_per_hour("lastfm_api_requests_total", key=key)
+            failed = requests - sum(
+                self.metric_per_hour("lastfm_api_requests_total", key=key, result=x)
+                for x in ["ok", "cached"]
+            )
+            rate_limited = self.metric_per_hour(
+                "lastfm_api_requests_total", key=key, result="rate_limit"
+            )
+            not_found = self.metric_per_hour(
+                "lastfm_api_requests_total", key=key, result="not_found"
+            )
+            latency = self.metric_per_hour("lastfm_api_request_seconds_sum", key=key)
+            downloads = self.metric_per_hour(
+                "lastfm_api_request_seconds_count", key=key
+            )
+            lines.append(
+                f"    {key:<6}{listens:>12,.0f}{requests / 3600:>12.2f}{latency / downloads if downloads else 0:>9.2f}s{failed / requests if requests else 0:>9.1%}{rate_limited / 60:>10.1f}/min{not_found / 60:>7.1f}/min"
+            )
+
+        # all in seconds per hour
+        stage_time = self.metric_per_hour("lastfm_stage_seconds_total")
+        api_time = self.metric_per_hour("lastfm_api_request_seconds_sum")
+        query_time = self.metric_per_hour("lastfm_db_query_seconds_sum")
+        lock_time = self.metric_per_hour("lastfm_db_lock_wait_seconds_sum")
+        lock_waits = self.metric_per_hour("lastfm_db_lock_waits_total")
+        commit_time = self.metric_per_hour("lastfm_db_commit_seconds_sum")
+        commits = self.metric_per_hour("lastfm_db_commit_seconds_count")
 
-songs, listens, artists, tags, missing_tags = dbq.get_data_stats()
-time.sleep(sleep_time)
-songs2, listens2, artists2, tags2, missing_tags = dbq.get_data_stats()
+        lines += ["", f"Where the time goes (last {window}):"]
+        if stage_time > 0:
+            rest = max(1 - (api_time + query_time + lock_time) / stage_time, 0)
+            lines.append(
+                f"    API {api_time / stage_time:.0%}, DB queries {query_time / stage_time:.0%}, waiting for locks {lock_time / stage_time:.0%}, rest (Python, sleeping) {rest:.0%}"
+            )
+        lines.append(
+            f"    commits: {commits / 60:,.1f}/min, {commit_time / commits * 1000 if commits else 0:.1f} ms on average"
+        )
+        lines.append(
+            f"    lock waits: {lock_waits / 60:,.2f}/min, {lock_time / lock_waits if lock_waits else 0:.2f} s on average"
+        )
+        return lines
 
-print(
-    f"Rate per hour:\n    Songs: {int((songs2 - songs) / 100 * 3600)}\n    Listens: {int((listens2 - listens) / 100 * 3600)}\n    Artists: {int((artists2 - artists) / 100 * 3600)}\n    Tags: {int((tags2 - tags) / 100 * 3600)}"
-)
 
-print(
-    f"\nTotal:\n    Songs: {songs2}\n    Listens: {listens2}\n    Artists: {artists2}\n    Tags: {tags2}"
-)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--interval", type=float, default=10, help="seconds between refreshes"
+    )
+    parser.add_argument(
+        "--window", type=float, default=300, help="seconds over which rates are taken"
+    )
+    parser.add_argument("--once", action="store_true", help="print once and exit")
+    args = parser.parse_args()
 
-print(f"\nMissing:\n    Tags: {missing_tags}")
+    dashboard = Dashboard(window=args.window)
+    dashboard.sample()
+    if args.once:
+        print("\n".join(dashboard.render()))
+    else:
+        while True:
+            time.sleep(args.interval)
+            dashboard.sample()
+            # clear the terminal
+            print("\033[2J\033[H" + "\n".join(dashboard.render()), flush=True)
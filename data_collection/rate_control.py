@@ -0,0 +1,137 @@
+import logging
+import multiprocessing
+import random
+from time import monotonic
+from metrics import metrics, error_class
+
+"""
+Request rate and error handling of one API key (rate_control in config.yaml).
+
+The rate is adapted with AIMD, like TCP does with its window: every successful request adds a little to it (increase requests per second per second of successes) and every rate limit response (last.fm error 29) cuts it by the factor decrease. So each key settles just below the rate last.fm allows it, instead of a rate we have to guess.
+
+Network errors, server errors and malformed responses are transient most of the time. The request is retried after a short random wait (retry_delay, doubled for every further retry), the batch it belongs to only fails once all retries failed. After breaker_threshold failed requests in a row, the circuit breaker of the key opens: it sends no requests for breaker_cooldown seconds, then tries again at min_rate. While it keeps failing, the cooldown doubles up to breaker_max_cooldown.
+
+last.fm limits the requests per IP address, not per key. So all keys of a run share a HostLimiter as well, which spaces out their requests to host_max_rate in total. Every key still adapts its own rate below that.
+
+The controller doesn't sleep itself, delay() returns how long to wait before the next request. That way the processes and the asyncio engine can both use it.
+
+Observable through the log (every rate change by a rate limit and every opening of a breaker) and the metrics lastfm_api_retries_total{key, reason}, lastfm_rate_limited_total{key}, lastfm_circuit_opens_total{key} and lastfm_rate_wait_seconds_total{key}.
+
+"""
+
+# error classes (see metrics.error_class) that are worth another try
+TRANSIENT_ERRORS = {"rate_limit", "server", "network", "malformed"}
+
+
+class HostLimiter(object):
+
+    """
+    The request rate of all keys together. Shared by the processes that are started after it was created.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        # when the next request of any key is due, monotonic() is the same clock in all processes
+        self.tat = multiprocessing.Value("d", 0.0)
+
+    def reserve(self, at):
+
+        """
+        Reserves the first free slot from at on and returns its time.
+        """
+
+        with self.tat.get_lock():
+            send_at = max(at, self.tat.value)
+            self.tat.value = send_at + self.interval
+        return send_at
+
+
+class RateController(object):
+    def __init__(self, config, key, host=None):
+        self.logger = logging.getLogger("data_py_logger")
+        self.config = config
+        self.key = key
+        self.host = host  # the HostLimiter of all keys
+        self.rate = config["initial_rate"]
+        self.tat = monotonic()  # when the next request is due at the current rate
+        self.failures = 0  # failed requests in a row
+        self.cooldown = config["breaker_cooldown"]
+        self.open_until = 0
+
+    def delay(self):
+
+        """
+        Reserves the next request slot and returns how many seconds to wait for it. Up to burst requests may go out at once after an idle period.
+        """
+
+        interval = 1 / self.rate
+        now = monotonic()
+        self.tat = max(self.tat, now, self.open_until)
+        send_at = max(
+            now, self.tat - (self.config["burst"] - 1) * interval, self.open_until
+        )
+        self.tat += interval
+        if self.host:
+            send_at = self.host.reserve(send_at)
+        wait = send_at - now
+        if wait > 0:
+            metrics.inc("lastfm_rate_wait_seconds_total", wait, key=self.key)
+        return wait
+
+    def success(self):
+        self.failures = 0
+        self.cooldown = self.config["breaker_cooldown"]
+        # adds increase requests per second for every second of successful requests
+        self.rate = min(
+            self.config["max_rate"], self.rate + self.config["increase"] / self.rate
+        )
+
+    def rate_limited(self):
+        rate = self.rate
+        self.rate = max(self.config["min_rate"], self.rate * self.config["decrease"])
+        # the burst is used up, the next request waits a full interval at the new rate
+        self.tat = max(self.tat, monotonic() + self.config["burst"] / self.rate)
+        metrics.inc("lastfm_rate_limited_total", key=self.key)
+        self.logger.info(
+            f"p{self.key}    Rate limited, {rate:.2f} -> {self.rate:.2f} requests/s"
+        )
+
+    def failure(self):
+
+        """
+        Records a transient error. Opens the circuit breaker after breaker_threshold of them in a row.
+        """
+
+        self.failures += 1
+        if self.failures < self.config["breaker_threshold"]:
+            return
+        self.open_until = monotonic() + self.cooldown
+        self.rate = self.config["min_rate"]
+        metrics.inc("lastfm_circuit_opens_total", key=self.key)
+        self.logger.error(
+            f"p{self.key}    {self.failures} failed requests in a row, pausing the key for {self.cooldown:.0f}s"
+        )
+        # half open: the first request after the cooldown decides, one more failure opens the breaker again
+        self.failures = self.config["breaker_threshold"] - 1
+        self.cooldown = min(self.cooldown * 2, self.config["breaker_max_cooldown"])
+
+    def retry(self, E, attempt):
+
+        """
+        Records the error E of a request. Returns how many seconds to wait before trying it again, None if it shouldn't be retried.
+        """
+
+        reason = error_class(E)
+        if reason not in TRANSIENT_ERRORS:
+            return None
+        if reason == "rate_limit":
+            self.rate_limited()
+        else:
+            self.failure()
+        if attempt >= self.config["retries"]:
+            return None
+        metrics.inc("lastfm_api_retries_total", key=self.key, reason=reason)
+        if reason == "rate_limit":
+            # the lower rate is enough of a wait
+            return 0
+        return self.config["retry_delay"] * 2**attempt * random.uniform(0.5, 1.5)
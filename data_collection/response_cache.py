@@ -0,0 +1,171 @@
+import hashlib
+import json
+import sqlite3
+import zlib
+from pathlib import Path
+from time import time as timer
+from xml.sax.saxutils import escape
+
+"""
+On-disk cache of last.fm API responses (response_cache in config.yaml).
+
+Responses are stored zlib compressed in their own SQLite file (data/response_cache.db), keyed by a hash of the method and the parameters. The API key is not part of the key, so responses recorded with one key can be replayed with any other.
+
+Modes:
+  off     every call goes to the API
+  record  fresh responses (younger than ttl_hours) are read from the cache, everything else is fetched and stored
+  replay  everything is read from the cache, no matter how old. The API is never called, a call that was not recorded fails like an API error.
+
+Besides successful responses, we also record the errors that will never go away (e.g. "User not found" or a private listening history), so that a replay takes the same paths as the recorded run. Timeouts, rate limits and server errors are not recorded.
+
+This store only holds copies of API responses. The queries of the collection DB stay in queries.py.
+
+"""
+
+file_path = Path().absolute().joinpath("data").joinpath("response_cache.db")
+
+MODES = ("off", "record", "replay")
+
+# last.fm error codes that will be the same on the next call: 6 = invalid parameters (user, artist, ... not found), 17 = login required (private history)
+PERMANENT_ERRORS = {"6", "17"}
+
+CACHE_INIT = """
+CREATE TABLE IF NOT EXISTS responses(
+    key TEXT NOT NULL PRIMARY KEY,
+    method TEXT NOT NULL,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created INTEGER NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS index_response_created
+ON responses(created);
+"""
+
+
+def request_key(method, params):
+
+    """
+    The content address of a request: the same method with the same parameters always has the same key, regardless of the order of the parameters.
+    """
+
+    items = sorted((str(k), str(v)) for k, v in params.items())
+    return hashlib.sha1(json.dumps([method, items]).encode("utf-8")).hexdigest()
+
+
+def error_response(status, details):
+
+    """
+    Builds the XML the API sends for an error, so a recorded error is raised again by api_pylast.parse_response.
+    """
+
+    return f'<?xml version="1.0" encoding="UTF-8"?>\n<lfm status="failed"><error code="{escape(str(status))}">{escape(str(details))}</error></lfm>'
+
+
+class ResponseCache(object):
+    def __init__(self, mode, ttl_hours, max_mb):
+        if mode not in MODES:
+            raise Exception(f"Unknown response_cache mode {mode}, use one of {MODES}")
+        self.mode = mode
+        self.ttl = ttl_hours * 3600
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.connect()
+
+    def connect(self):
+        file_path.parent.mkdir(exist_ok=True)
+        self.connection = sqlite3.connect(file_path)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute("PRAGMA busy_timeout = 30000")
+        self.cursor.execute("PRAGMA journal_mode = WAL")
+        # it's a cache, losing the last responses after a crash doesn't hurt
+        self.cursor.execute("PRAGMA synchronous = OFF")
+        self.cursor.executescript(CACHE_INIT)
+        self.cursor.execute("SELECT COALESCE(SUM(size), 0) FROM responses")
+        self.size = self.cursor.fetchone()[0]
+
+    def get(self, method, params):
+
+        """
+        Returns the recorded response text or None.
+        """
+
+        query = """
+        SELECT
+            body,
+            created
+        FROM responses
+        WHERE key = ?
+        ;
+        """
+        self.cursor.execute(query, (request_key(method, params),))
+        row = self.cursor.fetchone()
+
+        if row is None or (self.mode == "record" and row[1] < timer() - self.ttl):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return str(zlib.decompress(row[0]), "utf-8")
+
+    def put(self, method, params, response):
+
+        if self.mode != "record":
+            return
+
+        body = zlib.compress(response.encode("utf-8"))
+        query = """
+        INSERT OR REPLACE INTO responses
+            (key, method, body, size, created)
+        VALUES (?, ?, ?, ?, ?)
+        ;
+        """
+        params = (request_key(method, params), method, body, len(body), int(timer()))
+        self.cursor.execute(query, params)
+        self.connection.commit()
+
+        self.size += len(body)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def put_error(self, method, params, status, details):
+        if str(status) in PERMANENT_ERRORS:
+            self.put(method, params, error_response(status, details))
+
+    def evict(self):
+
+        """
+        Deletes the oldest responses until the cache is below 90% of its size limit. Other processes write to the same file, so the size is read from the DB first.
+        """
+
+        self.cursor.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM responses")
+        self.size, count = self.cursor.fetchone()
+        while self.size > self.max_bytes * 0.9 and count > 0:
+            query = """
+            DELETE FROM responses
+            WHERE key IN (
+                SELECT key
+                FROM responses
+                ORDER BY created
+                LIMIT ?
+            )
+            RETURNING size
+            ;
+            """
+            params = (max(count // 10, 1),)
+            self.cursor.execute(query, params)
+            deleted = self.cursor.fetchall()
+            self.size -= sum(x[0] for x in deleted)
+            count -= len(deleted)
+        self.connection.commit()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "mode": self.mode,
+            "mb": round(self.size / 1024 / 1024, 2),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
@@ -1,13 +1,23 @@
 from api_pylast import DataCollector
+from async_engine import AsyncCollector
+from writer import QueuedQueries, run_writer, STOP
+from shards import ShardedQueries, merge_shards, remove_db, shard_paths
+from coordinator import RemoteQueries
+from metrics import metrics
+from pipeline import StageScheduler
+from rate_control import HostLimiter
 import json
 import pylast
-from multiprocessing import Process
+from multiprocessing import Array, Process, Queue
 import time
 import yaml
 from queries import dbq as dbq
 import logging
 from pathlib import Path
 
+# the stages that write listens, only they use the shards
+SHARDED_STEPS = ("get_listens", "get_refresh")
+
 
 class LastFM(object):
     def __init__(self):
@@ -65,8 +75,19 @@ class LastFM(object):
 
         self.logger.info("\n\n======== LAST.FM DATA DOWNLOADER =======\n\n")
 
-        # reset the status of eventual entities that were marked as "being fetched" and cancelled before the fetching finished
-        dbq.reset_cancelled_fetching()
+        # with a coordinator, it owns the collection DB and the units the other collectors are working on (see coordinator.py)
+        coordinator = self.config["coordinator"]["url"]
+        if not coordinator:
+            # reset the status of eventual entities that were marked as "being fetched" and cancelled before the fetching finished
+            dbq.reset_cancelled_fetching()
+            # calls that failed for good are tried again once their negative result expired
+            dbq.release_negative_results()
+
+        if self.config["metrics"]["enabled"] and self.config["metrics"]["port"]:
+            metrics.serve(port=self.config["metrics"]["port"])
+            self.logger.info(
+                f"Metrics at http://127.0.0.1:{self.config['metrics']['port']}/metrics"
+            )
 
         # for each API key, we start a process in parallel. Fetching data of one type must finish before the next step starts.
         if self.config["speedtest"]:
@@ -77,9 +98,79 @@ class LastFM(object):
             DataCollector(network=network, config=self.config, pid=0).get_listens()
             return
 
-        for f in self.config["fetch"]:
+        if coordinator and self.config["engine"] == "asyncio":
+            self.logger.error("The coordinator only works with engine: processes.")
+            return
+        if coordinator and (
+            self.config["pipeline"]["enabled"]
+            or self.config["single_writer"]["enabled"]
+        ):
+            self.logger.info(
+                "The pipeline and the single writer don't work with the coordinator, they are switched off."
+            )
+            self.config["pipeline"]["enabled"] = False
+            self.config["single_writer"]["enabled"] = False
+
+        if self.config["engine"] == "asyncio" and (
+            not self.config["listen_metadata"]["inline"]
+            or self.config["listen_metadata"]["mbid_fallback"]
+        ):
+            # a lookup per new artist, album and song would hold up the other tasks, use the enrich stage instead
+            self.logger.error(
+                "The asyncio engine only works with listen_metadata.inline: True and mbid_fallback: False."
+            )
+            return
+
+        if self.config["engine"] == "asyncio":
+            AsyncCollector(accounts=self.accounts, config=self.config).run()
+            return
+
+        # in single writer mode, one process owns the DB and the fetchers send it their queries
+        writer = None
+        requests = None
+        replies = {}
+        if self.config["single_writer"]["enabled"]:
+            requests = Queue(maxsize=self.config["single_writer"]["queue_size"])
+            replies = {pid: Queue() for pid, a in enumerate(self.accounts)}
+            writer = Process(
+                target=run_writer,
+                args=(
+                    dbq,
+                    requests,
+                    replies,
+                    self.config["single_writer"]["max_batch"],
+                ),
+            )
+            writer.start()
+
+        # with sharding, every process writes its listens to a file of its own (see shards.py)
+        # with a coordinator, the listens always go to the shards of this machine
+        sharding = self.config["sharding"]["enabled"] or bool(coordinator)
+        if sharding and (
+            self.config["pipeline"]["enabled"]
+            or self.config["single_writer"]["enabled"]
+        ):
+            self.logger.info(
+                "Sharding doesn't work with the pipeline or the single writer, it is switched off."
+            )
+            sharding = False
+        if sharding:
+            # shards that weren't merged because the last run was cancelled
+            self.merge_shards()
+
+        # with the pipeline, all stages run at the same time (see pipeline.py)
+        steps = ["get_" + f for f in self.config["fetch"]]
+        active = None
+        if self.config["pipeline"]["enabled"]:
+            steps = ["pipeline"]
+            active = Array("i", [len(self.accounts)] * len(self.config["fetch"]))
+
+        # last.fm limits the requests per IP address, the processes of all keys share one limit
+        self.host_limiter = HostLimiter(
+            rate=self.config["rate_control"]["host_max_rate"]
+        )
 
-            f = "get_" + f
+        for f in steps:
 
             processes = []
 
@@ -98,67 +189,147 @@ class LastFM(object):
                         self.accounts[a],
                         pid,
                         f,
+                        requests,
+                        replies.get(pid),
+                        active,
+                        sharding and f in SHARDED_STEPS,
                     ),
                 )
                 p.start()
                 processes.append(p)
-                time.sleep(self.config["sleep"]["between_process_inits"])
 
             for p in processes:
                 p.join()
 
-    def runner(self, credentials, pid, f):
+            # the next stages need the listens, songs and artists in the DB
+            if sharding and f in SHARDED_STEPS:
+                self.merge_shards()
+
+        if writer:
+            requests.put(STOP)
+            writer.join()
+
+    def runner(
+        self,
+        credentials,
+        pid,
+        f,
+        requests=None,
+        replies=None,
+        active=None,
+        sharding=False,
+    ):
 
         network = pylast.LastFMNetwork(
             api_key=credentials["key"], api_secret=credentials["secret"]
         )
 
-        dc = DataCollector(network=network, config=self.config, pid=pid)
+        queries = None
+        if self.config["coordinator"]["url"]:
+            queries = RemoteQueries(config=self.config, pid=pid)
+        if requests:
+            queries = QueuedQueries(
+                requests=requests, replies=replies, wid=pid, config=self.config
+            )
+        elif sharding:
+            queries = ShardedQueries(config=self.config, pid=pid, state=queries)
 
-        f = getattr(dc, f)
+        dc = DataCollector(
+            network=network,
+            config=self.config,
+            pid=pid,
+            dbq=queries,
+            host_limiter=self.host_limiter,
+        )
 
-        self.loop(f, pid)
+        if f == "pipeline":
+            self.pipeline(dc, pid, active)
+        else:
+            self.loop(getattr(dc, f), pid)
+        metrics.snapshot()
+
+    def merge_shards(self):
+        paths = shard_paths(self.config)
+        if not paths:
+            return
+        if self.config["coordinator"]["url"]:
+            # the shards of this machine are merged into the first one, which goes to the coordinator's DB
+            if len(paths) > 1:
+                merge_shards(
+                    paths=paths[1:],
+                    target=paths[0],
+                    jobs=self.config["sharding"]["merge_jobs"],
+                    remove=True,
+                )
+            new_listens = RemoteQueries(config=self.config, pid="merge").merge(paths[0])
+            remove_db(paths[0])
+        else:
+            new_listens = merge_shards(
+                paths=paths, jobs=self.config["sharding"]["merge_jobs"], remove=True
+            )
+        self.logger.info(f"Merged {len(paths)} shards, {new_listens} new listens.")
 
     def loop(self, f, pid):
 
-        i = 0
-        timeout_counter = 0
         action = "repeat"
-        while action == "repeat":
+        while action in ("repeat", "wait"):
+            if action == "wait":
+                # other processes are still working on something that creates work for us
+                time.sleep(self.config["sleep"]["wait_for_work"])
+            action = self.step(f, pid)
 
-            i += 1
+    def pipeline(self, dc, pid, active):
 
-            try:
-                action = f()
-            except pylast.NetworkError as e:
-                print(
-                    "222", e.__class__.__name__, e.__class__.__qualname__, e.__context__
-                )
-                # 222 NetworkError NetworkError _ssl.c:1114: The handshake operation timed out
-                self.logger.error(f" p{pid}    Caught exception: {e},")
+        """
+        Runs all stages of config["fetch"] at the same time, see pipeline.py
+        """
 
-                self.logger.info(
-                    f" p{pid}    sleeping {self.config['sleep']['sleep_short']}s"
-                )
-                time.sleep(self.config["sleep"]["sleep_short"])
-
-                # if we get timed out multiple times, wait 10 minutes before we try again. This is aimed at circumventing multiple possible reasons for exceptions e.g. internet problems, server downtime, server overload or rate limitations. The optimum sleep time must be found empirically.
-                timeout_counter += 1
-                if (
-                    timeout_counter
-                    > self.config["sleep"]["n_timeouts_until_long_sleep"]
-                ):
-                    self.logger.info(
-                        f" p{pid}    sleeping {self.config['sleep']['sleep_long']}s"
-                    )
-                    time.sleep(self.config["sleep"]["sleep_long"])
-                    timeout_counter = 0
+        scheduler = StageScheduler(
+            stages=self.config["fetch"],
+            weights=self.config["pipeline"]["weights"],
+            active=active,
+        )
+        while not scheduler.is_finished():
+            stage = scheduler.next_stage()
+            if stage is None:
+                time.sleep(self.config["sleep"]["wait_for_work"])
+                scheduler.wake()
+                continue
+
+            upstream_finished = scheduler.upstream_finished(stage)
+            calls = dc.api_calls
+            action = self.step(getattr(dc, "get_" + stage), pid)
+            scheduler.update(
+                stage=stage,
+                action=action,
+                calls=dc.api_calls - calls,
+                upstream_finished=upstream_finished,
+            )
+
+    def step(self, f, pid):
+
+        """
+        Runs one batch of a stage. Network errors that remained after the retries of the rate controller are caught here and the batch is repeated. If the key keeps failing, its circuit breaker holds back the next requests (see rate_control.py).
+        """
+
+        try:
+            with metrics.stage_timer(stage=f.__name__[4:]):
+                return f()
+        except pylast.NetworkError as e:
+            print("222", e.__class__.__name__, e.__class__.__qualname__, e.__context__)
+            # 222 NetworkError NetworkError _ssl.c:1114: The handshake operation timed out
+            self.logger.error(f" p{pid}    Caught exception: {e},")
+            return "repeat"
 
     def test_credentials(self, network, credentials):
 
+        # a replay only answers from the recorded responses and has no call for the check
+        if self.config["response_cache"]["mode"] == "replay":
+            return
         try:
-            my_user = network.get_user(credentials["username"])
-            my_user.get_registered()
+            DataCollector(network=network, config=self.config, pid=0)._request(
+                "user.getInfo", {"user": credentials["username"]}
+            )
         except Exception:
             raise Exception(
                 f"Invalid user credentials on user {credentials['username']}"
@@ -0,0 +1,170 @@
+from queries import DataBaseQueries, dbq as default_dbq
+import db
+import argparse
+import logging
+import socket
+from multiprocessing import Pool
+from pathlib import Path
+
+"""
+Sharded collection (sharding.enabled in config.yaml, only with engine: processes, without the pipeline and the single writer).
+
+Every process writes the listens it fetches, and the artists, albums and songs they need, to its own shard: a file with the schema of lastfm_raw.db in sharding.directory, with ids of its own. So the processes never wait for each other's write lock, and the shards can be put on different disks. Claiming users, their data status and everything the other stages need stay in lastfm_raw.db. A shard gets a copy of the users whose listens it holds.
+
+After the listens (refresh) stage, the shards are merged into lastfm_raw.db (DataBaseQueries.merge_db). Until then, the counts of quick_check.py don't include their listens. The shards are merged in pairs by up to sharding.merge_jobs processes at once, then the pairs in pairs, and so on, and only the last one into lastfm_raw.db.
+
+Shards, or whole collection DBs, from other machines can be merged the same way:
+
+    python3 data_collection/shards.py                        merges data/shards/*.db into data/lastfm_raw.db
+    python3 data_collection/shards.py a.db b.db --remove     merges a.db and b.db and deletes them afterwards
+
+With several files, they are merged into each other first: the first file of every pair gets the data of the second.
+
+"""
+
+logger = logging.getLogger("data_py_logger")
+
+# what the shard of a process handles, all other queries go to lastfm_raw.db
+SHARD_METHODS = {
+    "add_artist",
+    "add_album",
+    "add_song",
+    "get_artist_id_from_name",
+    "get_album_id_from_name",
+    "get_song_id_from_name",
+    "get_cache_stats",
+    "clear_id_caches",
+}
+
+
+def shard_path(config, pid):
+
+    # the host name keeps the shards of several machines apart when they are collected in one place
+    return (
+        Path(config["sharding"]["directory"])
+        .absolute()
+        .joinpath(f"shard_{socket.gethostname()}_{pid}.db")
+    )
+
+
+def shard_paths(config):
+    directory = Path(config["sharding"]["directory"]).absolute()
+    return sorted(directory.glob("*.db")) if directory.exists() else []
+
+
+class ShardedQueries(object):
+
+    """
+    Stands in for dbq in the fetcher processes with sharding.enabled.
+    """
+
+    def __init__(self, config, pid, state=None):
+        # the collection DB, or the coordinator (see coordinator.py)
+        self.state = state if state else default_dbq
+        path = shard_path(config, pid)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.shard = DataBaseQueries(path=path)
+        self.users = set()  # users that are in the shard already
+
+    def __getattr__(self, name):
+        if name in SHARD_METHODS:
+            return getattr(self.shard, name)
+        return getattr(self.state, name)
+
+    def copy_user(self, user):
+        if user not in self.users:
+            self.shard.copy_users(self.state.get_users_by_id([user]))
+            self.users.add(user)
+
+    def add_listening(self, user, song, time):
+        self.copy_user(user)
+        self.shard.add_listening(user=user, song=song, time=time)
+
+    def add_listens_batch(self, user, artists, albums, songs, listens, window=None):
+        self.copy_user(user)
+        self.shard.add_listens_batch(
+            user=user,
+            artists=artists,
+            albums=albums,
+            songs=songs,
+            listens=listens,
+            window=window,
+        )
+        # the cursor only moves once the listens are committed to the shard
+        if listens:
+            self.state.set_fetch_cursor(
+                user=user, cursor=min(int(x[2]) for x in listens), window=window
+            )
+
+
+def remove_db(path):
+    for suffix in ["", "-wal", "-shm", "-journal"]:
+        f = Path(f"{path}{suffix}")
+        if f.exists():
+            f.unlink()
+
+
+def merge_pair(target, source, remove):
+    new_listens = DataBaseQueries(path=target).merge_db(source)
+    if remove:
+        remove_db(source)
+    return new_listens
+
+
+def merge_shards(paths, target=None, jobs=1, remove=False):
+
+    """
+    Merges the DBs at paths into target (default: lastfm_raw.db). Returns the number of listens that were new in target.
+    """
+
+    paths = [Path(x).absolute() for x in paths]
+    if not paths:
+        return 0
+    target = Path(target).absolute() if target else db.file_path
+
+    # a pair at a time per process, until one is left
+    if len(paths) > 1:
+        with Pool(max(jobs, 1)) as pool:
+            while len(paths) > 1:
+                pairs = [(paths[i], paths[i + 1]) for i in range(0, len(paths) - 1, 2)]
+                logger.info(f"Merging {len(paths)} shards in {len(pairs)} pairs.")
+                pool.starmap(merge_pair, [(a, b, remove) for a, b in pairs])
+                paths = [a for a, b in pairs] + paths[2 * len(pairs) :]
+    return merge_one(target, paths[0], remove)
+
+
+def merge_one(target, source, remove):
+    logger.info(f"Merging {source} into {target}.")
+    if target == db.file_path:
+        # the connection of this process
+        new_listens = default_dbq.merge_db(source)
+        if remove:
+            remove_db(source)
+    else:
+        new_listens = merge_pair(target, source, remove)
+    logger.info(f"{new_listens} new listens.")
+    return new_listens
+
+
+if __name__ == "__main__":
+    logger.setLevel(logging.INFO)
+    logger.addHandler(logging.StreamHandler())
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "paths", nargs="*", help="the DBs to merge (default: the shards of config.yaml)"
+    )
+    parser.add_argument("--target", help="merge into this DB (default: lastfm_raw.db)")
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=default_dbq.config["sharding"]["merge_jobs"],
+        help="pairs that are merged at the same time",
+    )
+    parser.add_argument(
+        "--remove", action="store_true", help="delete the DBs once they are merged"
+    )
+    args = parser.parse_args()
+
+    paths = args.paths if args.paths else shard_paths(default_dbq.config)
+    merge_shards(paths=paths, target=args.target, jobs=args.jobs, remove=args.remove)
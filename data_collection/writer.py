@@ -0,0 +1,155 @@
+from queue import Empty
+import logging
+import traceback
+from id_cache import IdCache
+from metrics import metrics
+
+"""
+Single writer for the collection DB (single_writer.enabled in config.yaml).
+
+With several API keys, every process used to write to lastfm_raw.db on its own and the processes kept locking each other out. In single writer mode, the fetcher processes don't touch the DB. They send their queries as records to a queue instead. One writer process owns the DB connection, executes the records in the order they arrive and commits them in groups. Queries that return something (counts, users to fetch, id resolution) are answered back through a reply queue per fetcher.
+
+If a record that isn't answered fails (e.g. add_listens_batch), the writer drops the later unanswered records of that fetcher, like the status 4 of the user whose listens were lost, and answers its next query with the error. So nothing is marked as done without its data, and the fetcher stops.
+
+"""
+
+STOP = "stop"
+
+# these only write and return nothing, so the fetcher doesn't have to wait for them
+FIRE_AND_FORGET = {
+    "add_friendship",
+    "add_friendships",
+    "add_listen_windows",
+    "add_listening",
+    "add_listens_batch",
+    "add_negative_results",
+    "add_tags",
+    "add_tags_to_artist",
+    "finish_enrichment",
+    "finish_listen_window",
+    "finish_refresh",
+    "update_data_is_private",
+    "update_data_status",
+    "update_enrichment_status",
+    "update_tag_status",
+}
+
+
+class QueuedQueries(object):
+
+    """
+    Stands in for dbq in the fetcher processes. Every method call is sent to the writer.
+    """
+
+    def __init__(self, requests, replies, wid, config):
+        self.requests = requests
+        self.replies = replies
+        self.wid = wid
+        self.call_id = 0
+        # ids never change once they are assigned, so the fetcher can remember them too
+        self.id_caches = {
+            "get_artist_id_from_name": IdCache(
+                "artists", config["id_cache"]["artists_mb"]
+            ),
+            "get_song_id_from_name": IdCache("songs", config["id_cache"]["songs_mb"]),
+            "get_album_id_from_name": IdCache(
+                "albums", config["id_cache"]["albums_mb"]
+            ),
+        }
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+
+            if name in FIRE_AND_FORGET:
+                self.requests.put((self.wid, None, name, args, kwargs))
+                return None
+
+            cache = self.id_caches.get(name)
+            if cache is not None:
+                key = (args, tuple(sorted(kwargs.items())))
+                result = cache.get(key)
+                if result:
+                    return result
+
+            self.call_id += 1
+            self.requests.put((self.wid, self.call_id, name, args, kwargs))
+            call_id, ok, result = self.replies.get()
+            if not ok:
+                raise Exception(f"Query {name} failed in the writer: {result}")
+
+            if cache is not None:
+                cache.put(key, result)
+            return result
+
+        return call
+
+    def get_cache_stats(self):
+        return [x.stats() for x in self.id_caches.values()]
+
+
+def run_writer(dbq, requests, replies, max_batch):
+
+    """
+    The loop of the writer process. It takes everything that is waiting in the queue (up to max_batch records), executes it in one transaction and sends the answers once the transaction is committed.
+    """
+
+    logger = logging.getLogger("data_py_logger")
+
+    # don't use a connection that was inherited from the parent process
+    dbq.db.connect()
+
+    failed = {}  # fetcher -> the error of its failed record, until the fetcher is told
+    stop = False
+    while not stop:
+        batch = [requests.get()]
+        while len(batch) < max_batch:
+            try:
+                batch.append(requests.get_nowait())
+            except Empty:
+                break
+
+        if STOP in batch:
+            stop = True
+            batch = [x for x in batch if x != STOP]
+
+        dbq.autocommit = False
+        failed_before = dict(failed)
+        try:
+            results = [execute(dbq, x, failed) for x in batch]
+            with metrics.timer("lastfm_db_commit_seconds"):
+                dbq.db.connection.commit()
+        except Exception:
+            # something in the group failed. Roll back and repeat the records one by one so that only the broken one is lost.
+            dbq.db.connection.rollback()
+            dbq.clear_id_caches()
+            dbq.autocommit = True
+            failed = failed_before
+            results = []
+            for x in batch:
+                try:
+                    results.append(execute(dbq, x, failed))
+                except Exception as e:
+                    logger.error(f"Writer: {x[2]} failed: {e}")
+                    traceback.print_exc()
+                    if x[1] is None:
+                        failed[x[0]] = f"{x[2]} failed: {e}"
+                    results.append((x[0], x[1], False, str(e)))
+        dbq.autocommit = True
+
+        for wid, call_id, ok, result in results:
+            if call_id is not None:
+                replies[wid].put((call_id, ok, result))
+
+    metrics.snapshot()
+
+
+def execute(dbq, record, failed):
+    wid, call_id, name, args, kwargs = record
+    if wid in failed:
+        if call_id is None:
+            logging.getLogger("data_py_logger").error(
+                f"Writer: {name} of p{wid} dropped after {failed[wid]}"
+            )
+            return wid, call_id, False, None
+        return wid, call_id, False, f"an earlier record was lost, {failed.pop(wid)}"
+    return wid, call_id, True, getattr(dbq, name)(*args, **kwargs)